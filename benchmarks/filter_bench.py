@@ -0,0 +1,113 @@
+"""Latency of metadata-filtered Chroma queries
+
+For each collection size, compares
+  - unfiltered query (whole collection)
+  - filtered query with a `where` clause evaluated inside Chroma
+  - post-filtering in Python (over-fetch unfiltered, then drop non-matching)
+and reports how often post-filtering came back with fewer than k hits.
+
+Collections are built in a temporary directory with random unit vectors and
+metadata spread over --docs documents and three file types.
+
+Usage: python benchmarks/filter_bench.py [--sizes 10000,100000,1000000] [--dim 384] [--queries 50]
+(1M chunks takes a while and several GB of disk; start with the smaller sizes.)
+"""
+import argparse
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import chromadb
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag.filters import matches, normalize_filters, to_where  # noqa: E402
+
+FILE_TYPES = ["application/pdf", "text/plain", "text/markdown"]
+INSERT_BATCH = 5000
+
+
+def _build(client, n, dim, docs, rng):
+    collection = client.create_collection(f"bench_{n}", metadata={"hnsw:space": "cosine"})
+    for start in range(0, n, INSERT_BATCH):
+        count = min(INSERT_BATCH, n - start)
+        vectors = rng.standard_normal((count, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        doc_ids = rng.integers(0, docs, count)
+        collection.add(
+            ids=[str(start + i) for i in range(count)],
+            embeddings=vectors,
+            metadatas=[
+                {"doc_id": f"doc{d}", "filename": f"doc{d}.txt", "file_type": FILE_TYPES[d % len(FILE_TYPES)]}
+                for d in doc_ids
+            ]
+        )
+    return collection
+
+
+def _timed(func, queries):
+    latencies = []
+    results = []
+    for query in queries:
+        started = time.perf_counter()
+        results.append(func(query))
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies, results
+
+
+def _summary(latencies):
+    ordered = sorted(latencies)
+    return f"p50 {statistics.median(ordered):7.2f} ms  p95 {ordered[int(len(ordered) * 0.95) - 1]:7.2f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--docs", type=int, default=1000, help="Distinct doc_ids in each collection")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--overfetch", type=int, default=100, help="Results fetched for Python post-filtering")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    path = tempfile.mkdtemp(prefix="filter_bench_")
+    try:
+        client = chromadb.PersistentClient(path=path)
+        for n in (int(size) for size in args.sizes.split(",")):
+            started = time.perf_counter()
+            collection = _build(client, n, args.dim, args.docs, rng)
+            print(f"\n{n} chunks (built in {time.perf_counter() - started:.0f}s)")
+
+            queries = rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+            filters = normalize_filters({"doc_id": [f"doc{d}" for d in range(3)]})
+            where = to_where(filters)
+
+            def unfiltered(q):
+                return collection.query(query_embeddings=q.reshape(1, -1), n_results=args.k)
+
+            def pushed_down(q):
+                return collection.query(query_embeddings=q.reshape(1, -1), n_results=args.k, where=where)
+
+            def post_filtered(q):
+                results = collection.query(query_embeddings=q.reshape(1, -1), n_results=args.overfetch)
+                return [m for m in results["metadatas"][0] if matches(filters, m)][:args.k]
+
+            for name, func in (("unfiltered", unfiltered), ("where (pushed down)", pushed_down), ("python post-filter", post_filtered)):
+                latencies, results = _timed(func, queries)
+                line = f"  {name:22s} {_summary(latencies)}"
+                if name == "python post-filter":
+                    short = sum(1 for result in results if len(result) < args.k)
+                    line += f"  short results: {short}/{len(results)}"
+                print(line)
+            client.delete_collection(collection.name)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Memory and recall of embedding representations
+
+Compares Python list-of-lists against contiguous float32 arrays, and the
+recall@k of float16 / int8 storage against exact float32 search.
+
+Usage: python benchmarks/quantization_bench.py [--vectors 20000] [--dim 384]
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag.quantization import STORAGE_DTYPES, decode_vectors, encode_vectors  # noqa: E402
+
+
+def _clustered_vectors(rng, n, dim, clusters=200):
+    """Unit vectors around random centroids, closer to real embeddings than pure noise"""
+    centroids = rng.standard_normal((clusters, dim)).astype(np.float32)
+    vectors = centroids[rng.integers(0, clusters, n)] + 0.5 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _top_k(matrix, queries, k):
+    scores = queries @ matrix.T
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+
+def _traced_bytes(build):
+    tracemalloc.start()
+    value = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(42)
+    matrix = _clustered_vectors(rng, args.vectors, args.dim)
+    queries = _clustered_vectors(rng, args.queries, args.dim)
+
+    _, list_bytes = _traced_bytes(lambda: matrix.tolist())
+    print(f"{args.vectors} x {args.dim} vectors")
+    print(f"  list[list[float]]   {list_bytes / 2**20:8.1f} MiB")
+    print(f"  float32 ndarray     {matrix.nbytes / 2**20:8.1f} MiB")
+
+    exact = _top_k(matrix, queries, args.k)
+    print(f"recall@{args.k} vs exact float32 search ({args.queries} queries)")
+    for dtype in STORAGE_DTYPES:
+        data, scales = encode_vectors(matrix, dtype)
+        stored = data.nbytes + (scales.nbytes if scales is not None else 0)
+        approx = _top_k(decode_vectors(data, scales), queries, args.k)
+        recall = np.mean([len(set(a) & set(b)) / args.k for a, b in zip(exact, approx)])
+        print(f"  {dtype:8s} {stored / 2**20:8.1f} MiB   recall {recall:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -15,8 +15,145 @@ ALLOWED_MIME_TYPES = [
 ANTHROPIC_TIMEOUT = int(os.getenv("ANTHROPIC_TIMEOUT", 30))  # 30 seconds
 OPENAI_TIMEOUT = int(os.getenv("OPENAI_TIMEOUT", 30))  # 30 seconds
 API_MAX_RETRIES = int(os.getenv("API_MAX_RETRIES", 3))  # 3 retries
+RETRY_INITIAL_DELAY = float(os.getenv("RETRY_INITIAL_DELAY", 0.5))  # backoff cap of the first retry, seconds
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 8))  # seconds
+CLAUDE_DEADLINE = float(os.getenv("CLAUDE_DEADLINE", 45))  # one Claude answer, queueing and retries included
+EMBEDDING_DEADLINE = float(os.getenv("EMBEDDING_DEADLINE", 40))  # one embedding sub-batch, retries included
+
+# Circuit breaker: consecutive timeouts/connection errors/5xx before failing fast
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))  # seconds open before a trial call
+
+# Admission control: per-pod limits on concurrent upstream calls; callers beyond
+# the queue, or waiting longer than the queue timeout, get 503 + Retry-After
+CLAUDE_MAX_CONCURRENCY = int(os.getenv("CLAUDE_MAX_CONCURRENCY", 32))
+CLAUDE_MAX_QUEUE = int(os.getenv("CLAUDE_MAX_QUEUE", 64))
+CLAUDE_QUEUE_TIMEOUT = float(os.getenv("CLAUDE_QUEUE_TIMEOUT", 5))  # seconds
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", 16))  # OpenAI embedding calls
+OPENAI_MAX_QUEUE = int(os.getenv("OPENAI_MAX_QUEUE", 64))
+OPENAI_QUEUE_TIMEOUT = float(os.getenv("OPENAI_QUEUE_TIMEOUT", 5))  # seconds
+
+# Shared Anthropic HTTP connection pool
+ANTHROPIC_MAX_CONNECTIONS = int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", 100))
+ANTHROPIC_MAX_KEEPALIVE = int(os.getenv("ANTHROPIC_MAX_KEEPALIVE", 20))
+ANTHROPIC_KEEPALIVE_EXPIRY = float(os.getenv("ANTHROPIC_KEEPALIVE_EXPIRY", 30))  # seconds an idle connection is kept
+ANTHROPIC_CONNECT_TIMEOUT = float(os.getenv("ANTHROPIC_CONNECT_TIMEOUT", 5))
+ANTHROPIC_HTTP2 = os.getenv("ANTHROPIC_HTTP2", "auto").lower()  # auto (if h2 is installed), true, false
+ANTHROPIC_PROMPT_CACHING = os.getenv("ANTHROPIC_PROMPT_CACHING", "true").lower() == "true"  # cache breakpoints on system + context
 
 # Chunking settings
 DEFAULT_CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1000))
 DEFAULT_CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))
 
+
+# Embedding cache settings
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 10000))
+EMBEDDING_CACHE_PERSIST = os.getenv("EMBEDDING_CACHE_PERSIST", "true").lower() == "true"  # on-disk tier under CHROMA_DB_PATH
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 32 * 1024 * 1024))  # in-process tier, 32MB default
+EMBEDDING_CACHE_DISK_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_DISK_MAX_ENTRIES", 50000))  # on-disk tier, oldest written dropped first
+EMBEDDING_CACHE_DISK_TTL = float(os.getenv("EMBEDDING_CACHE_DISK_TTL", 30 * 24 * 3600))  # seconds
+
+# Interval of the background purge of expired rows in the on-disk stores
+# (embedding cache, SQLite answer cache, conversations, ingestion jobs)
+STORE_PURGE_INTERVAL = float(os.getenv("STORE_PURGE_INTERVAL", 3600))  # seconds
+
+# Storage encoding for embedding vectors kept by this service: float32 (lossless),
+# float16 or int8 (per-vector scale) where some recall loss is acceptable
+EMBEDDING_STORAGE_DTYPE = os.getenv("EMBEDDING_STORAGE_DTYPE", "float32").lower()
+
+# Hash-based embedding fallback: "fast" (vectorized) or "compat" (reproduces
+# vectors of collections built before the vectorized engine)
+HASH_EMBEDDING_MODE = os.getenv("HASH_EMBEDDING_MODE", "fast").lower()
+
+# Query embedding micro-batching (0 ms window disables batching)
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", 5))
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", 32))
+
+# Embedding sub-batching for large inputs
+EMBEDDING_TIMEOUT = int(os.getenv("EMBEDDING_TIMEOUT", OPENAI_TIMEOUT))  # per sub-batch, seconds
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 4))  # sub-batches in flight per call
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 0))  # 0 = provider default below
+OPENAI_EMBEDDING_BATCH_SIZE = 256  # well under the 2048 inputs / 300k tokens request limits
+LOCAL_EMBEDDING_BATCH_SIZE = 64
+HASH_EMBEDDING_BATCH_SIZE = 1024
+
+# Local sentence-transformers inference: worker processes (0 = one dedicated thread in-process)
+EMBEDDING_WORKER_PROCESSES = int(os.getenv("EMBEDDING_WORKER_PROCESSES", 0))
+
+# Components that must be warm before /ready reports ready
+READINESS_COMPONENTS = [
+    name.strip() for name in os.getenv("READINESS_COMPONENTS", "embeddings,chroma,anthropic").split(",") if name.strip()
+]
+WARMUP_RETRY_INTERVAL = float(os.getenv("WARMUP_RETRY_INTERVAL", 5))  # seconds before re-warming failed components
+
+# Embedding provider: auto (OpenAI -> sentence-transformers -> hash), openai,
+# sentence-transformers or hash. Each provider/model stores into its own collection.
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "auto").lower()
+
+# Retrieval result cache (invalidated on every upload/delete)
+RETRIEVAL_CACHE_ENABLED = os.getenv("RETRIEVAL_CACHE_ENABLED", "true").lower() == "true"
+RETRIEVAL_CACHE_MAX_ENTRIES = int(os.getenv("RETRIEVAL_CACHE_MAX_ENTRIES", 1000))
+RETRIEVAL_CACHE_TTL = float(os.getenv("RETRIEVAL_CACHE_TTL", 300))  # seconds
+
+# Answer cache: identical question + identical context -> cached Claude answer
+ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND", "memory").lower()  # memory, sqlite or none
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1000))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 3600))  # seconds
+
+# Conversation memory (per conversation_id)
+CONVERSATION_BACKEND = os.getenv("CONVERSATION_BACKEND", "memory").lower()  # memory or sqlite (write-through)
+CONVERSATION_MAX_ENTRIES = int(os.getenv("CONVERSATION_MAX_ENTRIES", 10000))
+CONVERSATION_MAX_BYTES = int(os.getenv("CONVERSATION_MAX_BYTES", 32 * 1024 * 1024))  # in-process tier, 32MB default
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", 24 * 3600))  # idle seconds before a conversation is dropped
+CONVERSATION_RECENT_TURNS = int(os.getenv("CONVERSATION_RECENT_TURNS", 4))  # turns kept verbatim
+CONVERSATION_HISTORY_TOKENS = int(os.getenv("CONVERSATION_HISTORY_TOKENS", 1000))  # cap on history sent to Claude
+
+# Semantic cache: paraphrased questions reuse an earlier answer (skips retrieval and Claude)
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))  # minimum cosine similarity of query embeddings
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 500))  # per collection
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", 3600))  # seconds
+
+# Retrieval mode: dense (Chroma only), hybrid (BM25 + Chroma fused with reciprocal
+# rank fusion) or auto (hybrid when the hash fallback embeddings are active)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "auto").lower()
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))  # candidates taken from each ranking
+RRF_K = int(os.getenv("RRF_K", 60))
+BM25_K1 = float(os.getenv("BM25_K1", 1.5))
+BM25_B = float(os.getenv("BM25_B", 0.75))
+
+# Post-retrieval diversification: mmr (maximal marginal relevance over over-fetched
+# candidates, then merging of overlapping chunks of the same document) or none
+RETRIEVAL_DIVERSITY = os.getenv("RETRIEVAL_DIVERSITY", "mmr").lower()
+MMR_CANDIDATES = int(os.getenv("MMR_CANDIDATES", 20))
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", 0.7))  # 1.0 = relevance only, 0.0 = diversity only
+MERGED_CHUNK_MAX_CHARS = int(os.getenv("MERGED_CHUNK_MAX_CHARS", 2 * DEFAULT_CHUNK_SIZE))  # cap on merged overlapping chunks
+
+# Vector backend: chroma (HNSW) or mmap (exact brute-force search over memory-mapped
+# files, for collections up to a few hundred thousand chunks)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma").lower()
+MMAP_SEARCH_BLOCK_ROWS = int(os.getenv("MMAP_SEARCH_BLOCK_ROWS", 65536))  # rows per matmul block
+MMAP_COMPACTION_RATIO = float(os.getenv("MMAP_COMPACTION_RATIO", 0.25))  # deleted share that triggers compaction
+
+# Batch retrieval endpoint
+RETRIEVE_BATCH_MAX_QUERIES = int(os.getenv("RETRIEVE_BATCH_MAX_QUERIES", 1000))
+RETRIEVE_BATCH_SLICE = int(os.getenv("RETRIEVE_BATCH_SLICE", 64))  # queries embedded/searched together
+RETRIEVE_BATCH_STREAM_THRESHOLD = int(os.getenv("RETRIEVE_BATCH_STREAM_THRESHOLD", 100))  # stream NDJSON above this
+
+# Adaptive relevance policy applied to retrieved chunks before calling Claude
+# Minimum cosine similarity; empty = the embedding provider's default (none for hash)
+RELEVANCE_MIN_SIMILARITY = os.getenv("RELEVANCE_MIN_SIMILARITY", "")
+RELEVANCE_GAP = float(os.getenv("RELEVANCE_GAP", 0.15))  # cut at a similarity drop at least this large (0 = off)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 4000))  # default cap on chunk text, applied by the packer
+
+# Prompt packing: estimated input tokens per Claude request (prompt + context)
+PROMPT_INPUT_TOKEN_BUDGET = int(os.getenv("PROMPT_INPUT_TOKEN_BUDGET", 6000))
+CONTEXT_MIN_TRIM_TOKENS = int(os.getenv("CONTEXT_MIN_TRIM_TOKENS", 50))  # below this, a chunk that doesn't fit is dropped, not trimmed
+
+# Background ingestion jobs: uploads are stored under CHROMA_DB_PATH/uploads and
+# processed by a bounded worker pool; job state persists across restarts
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", 2))
+INGESTION_MAX_PENDING = int(os.getenv("INGESTION_MAX_PENDING", 100))  # queued + running jobs before uploads get 503
+INGESTION_MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", 3))  # tries per job when upstreams are overloaded or down
+INGESTION_JOB_TTL = float(os.getenv("INGESTION_JOB_TTL", 7 * 24 * 3600))  # seconds a finished job stays queryable
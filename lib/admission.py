@@ -0,0 +1,126 @@
+"""Per-pod admission control for upstream API calls
+
+Each upstream (Claude, OpenAI embeddings) gets its own limiter: at most
+max_concurrent calls run at once and at most max_queue callers wait for a
+slot, each for no longer than queue_timeout. A caller that finds the queue
+full, or whose wait runs past the deadline, gets AdmissionRejected at once
+instead of piling up behind the upstream; the app turns it into a 503 with
+Retry-After.
+"""
+import asyncio
+import logging
+import math
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+
+from config import (
+    CLAUDE_MAX_CONCURRENCY,
+    CLAUDE_MAX_QUEUE,
+    CLAUDE_QUEUE_TIMEOUT,
+    OPENAI_MAX_CONCURRENCY,
+    OPENAI_MAX_QUEUE,
+    OPENAI_QUEUE_TIMEOUT,
+)
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """No capacity for an upstream call; retry after retry_after seconds"""
+
+    def __init__(self, upstream: str, reason: str, retry_after: int):
+        super().__init__(f"{upstream} is at capacity ({reason}); retry after {retry_after}s")
+        self.upstream = upstream
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Semaphore with a bounded wait queue and queue-time deadline"""
+
+    def __init__(self, name: str, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._avg_hold = 1.0  # seconds a slot is held, moving average
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Semaphores are bound to one event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+            self._loop = loop
+            self.in_flight = self.waiting = 0
+        return self._semaphore
+
+    def retry_after(self) -> int:
+        """Seconds until a queued caller would likely get a slot"""
+        return max(1, math.ceil(self._avg_hold * (self.waiting + 1) / self.max_concurrent))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        metrics.increment(f"admission.{self.name}.rejected")
+        metrics.increment(f"admission.{self.name}.rejected_{reason}")
+        logger.warning(f"[ADMISSION] Rejected {self.name} call: {reason} (in flight {self.in_flight}, queued {self.waiting})")
+        return AdmissionRejected(self.name, reason, self.retry_after())
+
+    def _export(self) -> None:
+        metrics.set_gauge(f"admission.{self.name}.in_flight", self.in_flight)
+        metrics.set_gauge(f"admission.{self.name}.queue_depth", self.waiting)
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Hold one of the upstream's slots for the duration of the block"""
+        semaphore = self._get_semaphore()
+        started = time.monotonic()
+        if semaphore.locked():
+            if self.waiting >= self.max_queue:
+                raise self._reject("queue_full")
+            self.waiting += 1
+            self._export()
+            try:
+                await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._reject("queue_timeout") from None
+            finally:
+                self.waiting -= 1
+        else:
+            await semaphore.acquire()
+        acquired = time.monotonic()
+        metrics.observe(f"admission.{self.name}.wait_ms", (acquired - started) * 1000)
+        self.in_flight += 1
+        self._export()
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            semaphore.release()
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * (time.monotonic() - acquired)
+            self._export()
+
+
+_LIMITS = {
+    "claude": (CLAUDE_MAX_CONCURRENCY, CLAUDE_MAX_QUEUE, CLAUDE_QUEUE_TIMEOUT),
+    "embeddings": (OPENAI_MAX_CONCURRENCY, OPENAI_MAX_QUEUE, OPENAI_QUEUE_TIMEOUT),
+}
+_controllers: Dict[str, AdmissionController] = {}
+
+
+def get_controller(name: str) -> AdmissionController:
+    """Controller for an upstream ("claude" or "embeddings")"""
+    controller = _controllers.get(name)
+    if controller is None:
+        max_concurrent, max_queue, queue_timeout = _LIMITS[name]
+        controller = _controllers[name] = AdmissionController(name, max_concurrent, max_queue, queue_timeout)
+    return controller
+
+
+def admit(name: str):
+    """Async context manager holding a slot of the named upstream"""
+    return get_controller(name).slot()
@@ -1,56 +1,276 @@
-"""Retry utility with exponential backoff"""
+"""Retry policy for upstream API calls
+
+retry_with_backoff retries only errors worth retrying (timeouts, connection
+errors, 408/409/429 and 5xx), sleeping a full-jitter exponential delay or
+the server's Retry-After. All attempts share one Deadline, so a request never
+runs past its overall budget however many retries it has left. A
+per-upstream CircuitBreaker counts consecutive outages (timeouts, connection
+errors, 5xx) and, once open, fails calls at once with CircuitOpen until a
+trial call succeeds.
+"""
 import asyncio
 import logging
-from typing import Callable, TypeVar, Optional
-from functools import wraps
+import math
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import httpx
+
+from config import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT
+from lib import metrics
+from lib.admission import AdmissionRejected
 
 logger = logging.getLogger(__name__)
 
 T = TypeVar('T')
 
+# Error classes
+OUTAGE = "outage"  # provider unreachable or failing: retry, counts toward the circuit breaker
+THROTTLED = "throttled"  # provider asked us to back off: retry only
+FATAL = "fatal"  # retrying cannot help (bad request, auth, missing key, overload of this pod)
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+_CONNECTION_ERROR_NAMES = {"APIConnectionError", "APITimeoutError"}  # anthropic / openai SDKs
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's overall deadline passed"""
+
+
+class CircuitOpen(AdmissionRejected):
+    """The upstream is failing; calls are refused until the breaker lets a trial through"""
+
+    def __init__(self, upstream: str, retry_after: int):
+        super().__init__(upstream, "circuit_open", retry_after)
+
+
+class Deadline:
+    """Point in time by which a request, retries included, must be done"""
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def timeout(self, cap: float) -> float:
+        """Timeout for one attempt: cap, shortened to what is left of the deadline"""
+        return min(cap, self.remaining())
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+def status_code_of(exc: BaseException) -> Optional[int]:
+    """HTTP status of an SDK or httpx error, if it carries one"""
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        response = getattr(exc, "response", None)
+        status = getattr(response, "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def classify(exc: BaseException) -> str:
+    """OUTAGE, THROTTLED or FATAL"""
+    if isinstance(exc, AdmissionRejected):
+        return FATAL
+    if isinstance(exc, (TimeoutError, asyncio.TimeoutError, ConnectionError, httpx.TimeoutException, httpx.NetworkError)):
+        return OUTAGE
+    status = status_code_of(exc)
+    if status is not None:
+        if status in RETRYABLE_STATUS_CODES:
+            return THROTTLED
+        return OUTAGE if status >= 500 else FATAL
+    if any(cls.__name__ in _CONNECTION_ERROR_NAMES for cls in type(exc).__mro__):
+        return OUTAGE
+    return FATAL
+
+
+def retry_after_of(exc: BaseException) -> Optional[float]:
+    """Seconds the server asked us to wait (retry-after-ms / Retry-After headers)"""
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def full_jitter(attempt: int, initial_delay: float, max_delay: float, exponential_base: float = 2.0) -> float:
+    """Uniform delay in [0, min(max_delay, initial_delay * base ** attempt)]"""
+    return random.uniform(0, min(max_delay, initial_delay * exponential_base ** attempt))
+
+
+class CircuitBreaker:
+    """Consecutive-outage breaker: closed -> open -> half-open (one trial) -> closed"""
+
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        metrics.set_gauge(f"circuit.{self.name}.open", 1 if state == self.OPEN else 0)
+
+    def before_call(self) -> None:
+        """Raise CircuitOpen unless a call may go through now"""
+        with self._lock:
+            if self.state == self.OPEN:
+                waited = time.monotonic() - self._opened_at
+                if waited < self.reset_timeout:
+                    metrics.increment(f"circuit.{self.name}.rejected")
+                    raise CircuitOpen(self.name, max(1, math.ceil(self.reset_timeout - waited)))
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._trial_in_flight:
+                    metrics.increment(f"circuit.{self.name}.rejected")
+                    raise CircuitOpen(self.name, 1)
+                self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info(f"[CIRCUIT] {self.name} recovered, closing circuit")
+            self.failures = 0
+            self._trial_in_flight = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self) -> None:
+        """Count an outage; opens the circuit at the threshold or on a failed trial"""
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"[CIRCUIT] {self.name} opened after {self.failures} failures")
+                    metrics.increment(f"circuit.{self.name}.opened")
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def release(self) -> None:
+        """End a call that said nothing about the upstream's health"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record(self, exc: BaseException) -> None:
+        """Record a failed call according to its error class"""
+        if classify(exc) == OUTAGE:
+            self.record_failure()
+        else:
+            self.release()
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Circuit breaker of an upstream ("claude" or "embeddings")"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
 
 async def retry_with_backoff(
-    func: Callable[[], T],
+    func: Callable[[], Awaitable[T]],
     max_retries: int = 3,
     initial_delay: float = 1.0,
     max_delay: float = 60.0,
     exponential_base: float = 2.0,
-    exceptions: tuple = (Exception,)
+    deadline: Optional[Deadline] = None,
+    breaker: Optional[CircuitBreaker] = None,
+    classifier: Callable[[BaseException], str] = classify
 ) -> T:
     """
-    Retry a function with exponential backoff
-    
+    Call func, retrying retryable errors with full-jitter exponential backoff
+
     Args:
         func: Async function to retry
         max_retries: Maximum number of retry attempts
-        initial_delay: Initial delay in seconds
+        initial_delay: Backoff cap of the first retry in seconds
         max_delay: Maximum delay in seconds
         exponential_base: Base for exponential backoff
-        exceptions: Tuple of exceptions to catch and retry on
-    
+        deadline: Overall deadline shared by all attempts; each attempt is cut off at it
+        breaker: Circuit breaker of the upstream; outages are recorded on it
+        classifier: Maps an error to OUTAGE, THROTTLED or FATAL
+
     Returns:
         Result of the function call
-    
+
     Raises:
-        Last exception if all retries fail
+        CircuitOpen if the breaker refuses the call, DeadlineExceeded if the
+        deadline passed before an attempt, otherwise the last error
     """
-    delay = initial_delay
-    
+    name = breaker.name if breaker is not None else "call"
+
     for attempt in range(max_retries + 1):
+        if deadline is not None and deadline.expired:
+            metrics.increment(f"retry.{name}.deadline_exceeded")
+            raise DeadlineExceeded(f"{name} deadline exceeded after {attempt} attempts")
+        if breaker is not None:
+            breaker.before_call()
         try:
-            return await func()
-        except exceptions as e:
+            if deadline is None:
+                result = await func()
+            else:
+                result = await asyncio.wait_for(func(), timeout=deadline.remaining())
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.release()
+            raise
+        except Exception as e:
+            kind = classifier(e)
+            if breaker is not None:
+                if kind == OUTAGE:
+                    breaker.record_failure()
+                else:
+                    breaker.release()
+            if kind == FATAL:
+                raise
             if attempt == max_retries:
                 logger.error(f"All {max_retries + 1} attempts failed. Last error: {str(e)}")
                 raise
-            
+
+            retry_after = retry_after_of(e)
+            delay = min(max_delay, retry_after) if retry_after is not None else full_jitter(
+                attempt, initial_delay, max_delay, exponential_base
+            )
+            if deadline is not None and delay >= deadline.remaining():
+                metrics.increment(f"retry.{name}.deadline_exceeded")
+                logger.error(f"Attempt {attempt + 1} failed: {str(e)}. No time left for a retry within the deadline")
+                raise
+
+            metrics.increment(f"retry.{name}.retries")
             logger.warning(
-                f"Attempt {attempt + 1}/{max_retries + 1} failed: {str(e)}. "
+                f"Attempt {attempt + 1}/{max_retries + 1} failed ({kind}): {str(e)}. "
                 f"Retrying in {delay:.2f} seconds..."
             )
             await asyncio.sleep(delay)
-            delay = min(delay * exponential_base, max_delay)
-    
+        else:
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
     # Should never reach here, but for type safety
     raise Exception("Retry logic failed unexpectedly")
-
@@ -39,6 +39,17 @@ limiter = Limiter(key_func=get_remote_address)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
+# Admission control: upstream capacity exhausted -> fast 503 the client can retry
+from lib.admission import AdmissionRejected
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
 # CORS for Next.js frontend
 allowed_origins = os.getenv("ALLOWED_ORIGINS", "http://localhost:3000").split(",")
 logger.info(f"[CORS] Allowed origins: {allowed_origins}")
@@ -61,6 +72,30 @@ async def health_check():
         "timestamp": datetime.utcnow().isoformat()
     }
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe: 200 only once the embedding model, Chroma and Anthropic client are warm"""
+    from rag.warmup import get_readiness
+    readiness = get_readiness()
+    return JSONResponse(
+        status_code=200 if readiness["ready"] else 503,
+        content={
+            "status": "ready" if readiness["ready"] else "not_ready",
+            **readiness
+        }
+    )
+
+@app.get("/metrics")
+async def get_metrics():
+    """In-process counters, gauges and summaries for this pod"""
+    from lib import metrics
+    from rag import embedding_cache, retrieval_cache
+    return {
+        **metrics.snapshot(),
+        "embedding_cache": embedding_cache.get_cache_stats(),
+        "retrieval_cache": retrieval_cache.get_cache_stats()
+    }
+
 @app.get("/")
 async def root():
     return {
@@ -69,42 +104,10 @@ async def root():
         "model": "claude-sonnet-4-20250514"
     }
 
-# Initialize clients (lazy - will be created when needed)
-anthropic_client = None
-
 def get_anthropic_client():
-    """Get or create Anthropic client"""
-    global anthropic_client
-    if anthropic_client is None:
-        from anthropic import Anthropic
-        api_key = os.getenv("ANTHROPIC_API_KEY")
-        if not api_key:
-            raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
-        
-        # Temporarily unset proxy environment variables to prevent Anthropic/httpx from using them
-        # Anthropic 0.39.0 doesn't support 'proxies' parameter in constructor
-        original_proxies = {}
-        proxy_vars = [
-            'HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 
-            'ALL_PROXY', 'all_proxy', 'NO_PROXY', 'no_proxy'
-        ]
-        
-        for var in proxy_vars:
-            if var in os.environ:
-                original_proxies[var] = os.environ.pop(var)
-        
-        try:
-            # Only pass api_key - Anthropic 0.39.0 doesn't support additional parameters like proxies
-            anthropic_client = Anthropic(api_key=api_key)
-            logger.info("Anthropic client initialized successfully (proxies disabled)")
-        except Exception as e:
-            logger.error(f"Failed to initialize Anthropic client: {e}")
-            raise
-        finally:
-            # Restore proxy environment variables if they were set
-            for var, value in original_proxies.items():
-                os.environ[var] = value
-    return anthropic_client
+    """Get the shared async Anthropic client (managed by rag.claude_chain)"""
+    from rag.claude_chain import get_client
+    return get_client()
 
 # ChromaDB client is now managed by rag.chroma_client module
 from rag.chroma_client import get_chroma_collection
@@ -129,6 +132,33 @@ async def startup_event():
         logger.info("✅ OPENAI_API_KEY found - will use OpenAI embeddings")
     else:
         logger.info("ℹ️  OPENAI_API_KEY not set - will use hash-based embeddings (lightweight, no API key required)")
+    
+    # One pooled Anthropic client shared by all requests
+    if os.getenv("ANTHROPIC_API_KEY"):
+        get_anthropic_client()
+    
+    # Preload embedding model, Chroma index and Anthropic client in the background;
+    # /ready reports 503 until they are warm
+    from rag.warmup import start_warmup
+    start_warmup()
+    
+    # Background ingestion workers; jobs interrupted by the last shutdown resume here
+    from rag import ingestion
+    await ingestion.start()
+    
+    # Periodic purge of expired rows in the on-disk caches and stores
+    from rag import maintenance
+    maintenance.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background tasks and embedding workers and close the Anthropic client"""
+    from rag import embedding_workers, ingestion, maintenance
+    from rag.claude_chain import close_client
+    await maintenance.stop()
+    await ingestion.stop()
+    embedding_workers.shutdown()
+    await close_client()
 
 # Import routers (after health check is defined)
 try:
@@ -0,0 +1,202 @@
+"""Cache of Claude answers for identical questions over identical context
+
+The key covers everything that determines the answer: model, prompt template
+version, normalized question and a hash of the ordered (chunk id, text)
+pairs sent as context. Entries expire after ANSWER_CACHE_TTL and are dropped
+as soon as one of the documents they were answered from is deleted.
+
+ANSWER_CACHE_BACKEND selects the store: "memory" (in-process LRU), "sqlite"
+(CHROMA_DB_PATH/answer_cache.sqlite3, shared across restarts) or "none".
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Set
+
+from config import ANSWER_CACHE_BACKEND, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL
+from lib import metrics
+from lib.cache import LRUCache, SQLiteStore
+from rag.retrieval_cache import normalize_query
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryAnswerStore:
+    """In-process LRU of answers with a doc_id -> keys index for invalidation"""
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: Optional[float] = ANSWER_CACHE_TTL):
+        self._cache = LRUCache(max_entries=max_entries, ttl=ttl)
+        self._by_doc: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        return self._cache.get(key)
+
+    def set(self, key: str, entry: Dict[str, Any], doc_ids: Iterable[str]) -> None:
+        self._cache.set(key, entry)
+        with self._lock:
+            for doc_id in doc_ids:
+                self._by_doc.setdefault(doc_id, set()).add(key)
+            # Evicted entries leave keys behind in the index; prune now and then
+            if sum(len(keys) for keys in self._by_doc.values()) > 2 * self._cache.max_entries:
+                live = set(self._cache.keys())
+                self._by_doc = {
+                    doc_id: keys & live for doc_id, keys in self._by_doc.items() if keys & live
+                }
+
+    def invalidate_doc(self, doc_id: str) -> int:
+        with self._lock:
+            keys = self._by_doc.pop(doc_id, set())
+        for key in keys:
+            self._cache.delete(key)
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._by_doc.clear()
+        self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+
+class SQLiteAnswerStore(SQLiteStore):
+    """Answers persisted in SQLite, with a table linking each entry to its documents"""
+
+    def __init__(self, path: str, ttl: Optional[float] = ANSWER_CACHE_TTL):
+        super().__init__(path, table="answers")
+        self.ttl = ttl
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS answer_docs (doc_id TEXT NOT NULL, key TEXT NOT NULL, "
+                "PRIMARY KEY (doc_id, key))"
+            )
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = super().get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key: str, entry: Dict[str, Any], doc_ids: Iterable[str]) -> None:
+        super().set(key, json.dumps(entry).encode("utf-8"), ttl=self.ttl)
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO answer_docs (doc_id, key) VALUES (?, ?)",
+                [(doc_id, key) for doc_id in set(doc_ids)]
+            )
+            self._conn.commit()
+
+    def invalidate_doc(self, doc_id: str) -> int:
+        with self._lock:
+            cursor = self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM answer_docs WHERE doc_id = ?)",
+                (doc_id,)
+            )
+            self._conn.execute("DELETE FROM answer_docs WHERE doc_id = ?", (doc_id,))
+            self._conn.commit()
+            return cursor.rowcount
+
+    def purge_expired(self) -> int:
+        removed = super().purge_expired()
+        with self._lock:
+            self._conn.execute(f"DELETE FROM answer_docs WHERE key NOT IN (SELECT key FROM {self.table})")
+            self._conn.commit()
+        return removed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.table}")
+            self._conn.execute("DELETE FROM answer_docs")
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                f"SELECT COUNT(*) FROM {self.table} WHERE expires_at IS NULL OR expires_at > ?",
+                (time.time(),)
+            ).fetchone()[0]
+
+
+_store = None
+
+
+def get_store():
+    """Configured answer store (None when the cache is disabled)"""
+    global _store
+    if _store is None and ANSWER_CACHE_BACKEND != "none":
+        if ANSWER_CACHE_BACKEND == "sqlite":
+            chroma_db_path = os.getenv("CHROMA_DB_PATH", "./chroma_db")
+            try:
+                _store = SQLiteAnswerStore(os.path.join(chroma_db_path, "answer_cache.sqlite3"))
+            except Exception as e:
+                logger.warning(f"[ANSWER_CACHE] SQLite store unavailable, using memory: {e}")
+        if _store is None:
+            _store = MemoryAnswerStore()
+    return _store
+
+
+def answer_key(model: str, template_version: str, query: str, context: List[Dict[str, Any]], history: str = "") -> str:
+    """Cache key for a question answered from the given ordered context (and conversation history)"""
+    digest = hashlib.sha256(history.encode("utf-8") + b"\x02")
+    for chunk in context:
+        digest.update(str(chunk.get("id", "")).encode("utf-8") + b"\x00")
+        digest.update(chunk.get("text", "").encode("utf-8") + b"\x01")
+    return f"{model}:{template_version}:{hashlib.sha256(normalize_query(query).encode('utf-8')).hexdigest()}:{digest.hexdigest()}"
+
+
+def context_doc_ids(context: List[Dict[str, Any]]) -> Set[str]:
+    """Documents the context was taken from"""
+    return {chunk["metadata"]["doc_id"] for chunk in context if chunk.get("metadata", {}).get("doc_id")}
+
+
+def lookup(key: str) -> Optional[Dict[str, Any]]:
+    """Cached {"answer", "sources"} or None"""
+    store = get_store()
+    if store is None:
+        return None
+    try:
+        entry = store.get(key)
+    except Exception as e:
+        logger.warning(f"[ANSWER_CACHE] Lookup failed: {e}")
+        entry = None
+    metrics.increment("answer_cache.hits" if entry is not None else "answer_cache.misses")
+    return entry
+
+
+def store(key: str, answer: str, sources: List[Dict[str, Any]], doc_ids: Iterable[str]) -> None:
+    """Remember an answer and the documents it came from"""
+    cache = get_store()
+    if cache is None:
+        return
+    try:
+        cache.set(key, {"answer": answer, "sources": sources}, doc_ids)
+    except Exception as e:
+        logger.warning(f"[ANSWER_CACHE] Write failed: {e}")
+
+
+def invalidate_documents(doc_ids: Iterable[str]) -> int:
+    """Drop every cached answer that used one of the documents"""
+    cache = get_store()
+    if cache is None:
+        return 0
+    removed = 0
+    for doc_id in set(doc_ids):
+        removed += cache.invalidate_doc(doc_id)
+    if removed:
+        metrics.increment("answer_cache.invalidated", removed)
+        logger.info(f"[ANSWER_CACHE] Invalidated {removed} answers")
+    return removed
+
+
+def purge_expired() -> int:
+    """Drop expired answers from the SQLite store (the memory store expires them on access)"""
+    cache = get_store()
+    return cache.purge_expired() if isinstance(cache, SQLiteAnswerStore) else 0
+
+
+def clear() -> None:
+    if _store is not None:
+        _store.clear()
@@ -0,0 +1,294 @@
+"""Incremental BM25 inverted index, persisted next to the Chroma data
+
+One index per collection. Postings live in memory; on disk every document
+has its own append-only segment file under CHROMA_DB_PATH/bm25/<collection>/,
+so adding a batch appends a few lines and deleting a document removes one
+file, with no rewrite of the whole index.
+"""
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from config import BM25_B, BM25_K1
+from rag.filters import FILTERABLE_FIELDS, matches
+
+logger = logging.getLogger(__name__)
+
+# Written once the index holds every chunk the collection had when the index was created
+BOOTSTRAP_MARKER = ".bootstrapped"
+
+# Words, plus compound tokens such as part numbers and error codes (XJ-9000, E_1042, v2.3.1)
+_TOKEN_RE = re.compile(r"\w+(?:[-./]\w+)*")
+_PART_RE = re.compile(r"[-./_]")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms; compound tokens are indexed whole and by their parts"""
+    tokens = []
+    for match in _TOKEN_RE.finditer(text.lower()):
+        token = match.group()
+        tokens.append(token)
+        if _PART_RE.search(token):
+            tokens.extend(part for part in _PART_RE.split(token) if part)
+    return tokens
+
+
+class BM25Index:
+    """Okapi BM25 over chunk ids with incremental add/remove"""
+
+    def __init__(self, directory: Optional[str] = None, k1: float = BM25_K1, b: float = BM25_B):
+        self.directory = directory
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[str, int]] = defaultdict(dict)  # term -> {chunk_id: tf}
+        self._lengths: Dict[str, int] = {}  # chunk_id -> number of terms
+        self._chunk_terms: Dict[str, List[str]] = {}  # chunk_id -> distinct terms (for removal)
+        self._doc_chunks: Dict[str, List[str]] = defaultdict(list)  # doc_id -> chunk ids
+        self._chunk_doc: Dict[str, str] = {}
+        self._doc_fields: Dict[str, Dict[str, Any]] = {}  # doc_id -> filterable metadata
+        self._total_length = 0
+        # Term statistics derived from the postings, rebuilt lazily after a change
+        self._idf: Dict[str, float] = {}
+        self._norms: Dict[str, float] = {}
+        self._lock = threading.RLock()
+        self.bootstrapped = False
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.bootstrapped = os.path.exists(os.path.join(directory, BOOTSTRAP_MARKER))
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self._lengths
+
+    def mark_bootstrapped(self) -> None:
+        self.bootstrapped = True
+        if self.directory:
+            with open(os.path.join(self.directory, BOOTSTRAP_MARKER), "w", encoding="utf-8"):
+                pass
+
+    def _segment_path(self, doc_id: str) -> str:
+        digest = hashlib.sha1(doc_id.encode("utf-8")).hexdigest()[:20]
+        return os.path.join(self.directory, f"{digest}.jsonl")
+
+    def _load(self) -> None:
+        segments = [name for name in os.listdir(self.directory) if name.endswith(".jsonl")]
+        for name in segments:
+            with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    self._index_chunk(record["doc"], record["id"], record["tf"], record["len"], record.get("f"))
+        if segments:
+            logger.info(f"[BM25] Loaded {len(self._lengths)} chunks from {len(segments)} segments in {self.directory}")
+
+    def _index_chunk(
+        self, doc_id: str, chunk_id: str, term_freqs: Dict[str, int], length: int, fields: Optional[Dict[str, Any]] = None
+    ) -> None:
+        if chunk_id in self._lengths:
+            self._unindex_chunk(chunk_id)
+        self._doc_fields[doc_id] = {**self._doc_fields.get(doc_id, {}), **(fields or {}), "doc_id": doc_id}
+        for term, tf in term_freqs.items():
+            self._postings[term][chunk_id] = tf
+        self._chunk_terms[chunk_id] = list(term_freqs)
+        self._lengths[chunk_id] = length
+        self._total_length += length
+        self._doc_chunks[doc_id].append(chunk_id)
+        self._chunk_doc[chunk_id] = doc_id
+
+    def _unindex_chunk(self, chunk_id: str) -> None:
+        for term in self._chunk_terms.pop(chunk_id, []):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._lengths.pop(chunk_id, 0)
+        doc_id = self._chunk_doc.pop(chunk_id, None)
+        if doc_id is not None:
+            chunks = self._doc_chunks.get(doc_id)
+            if chunks is not None:
+                chunks.remove(chunk_id)
+                if not chunks:
+                    del self._doc_chunks[doc_id]
+                    self._doc_fields.pop(doc_id, None)
+
+    def _invalidate_stats(self) -> None:
+        self._idf.clear()
+        self._norms.clear()
+
+    def add_chunks(
+        self, doc_id: str, chunk_ids: Sequence[str], texts: Sequence[str], metadata: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Index chunks of a document (may be called once per stored batch)
+
+        The filterable fields of metadata (filename, file_type) are kept per
+        document so searches can be restricted like the Chroma query.
+        """
+        fields = {field: metadata[field] for field in FILTERABLE_FIELDS if metadata and field in metadata and field != "doc_id"}
+        records = []
+        with self._lock:
+            for chunk_id, text in zip(chunk_ids, texts):
+                tokens = tokenize(text)
+                term_freqs = dict(Counter(tokens))
+                self._index_chunk(doc_id, chunk_id, term_freqs, len(tokens), fields)
+                records.append({"doc": doc_id, "id": chunk_id, "len": len(tokens), "tf": term_freqs, "f": fields})
+            self._invalidate_stats()
+            if self.directory and records:
+                with open(self._segment_path(doc_id), "a", encoding="utf-8") as f:
+                    f.writelines(json.dumps(record, separators=(",", ":")) + "\n" for record in records)
+
+    def add_records(self, chunk_ids: Sequence[str], texts: Sequence[str], metadatas: Sequence[Optional[dict]]) -> None:
+        """Index Chroma records, grouped by the doc_id in their metadata"""
+        by_doc: Dict[str, Tuple[List[str], List[str], Dict[str, Any]]] = {}
+        for chunk_id, text, metadata in zip(chunk_ids, texts, metadatas):
+            doc_id = (metadata or {}).get("doc_id") or chunk_id.rsplit("_", 1)[0]
+            doc_chunk_ids, doc_texts, _ = by_doc.setdefault(doc_id, ([], [], metadata or {}))
+            doc_chunk_ids.append(chunk_id)
+            doc_texts.append(text or "")
+        for doc_id, (doc_chunk_ids, doc_texts, metadata) in by_doc.items():
+            self.add_chunks(doc_id, doc_chunk_ids, doc_texts, metadata)
+
+    def remove_chunks(self, chunk_ids: Iterable[str]) -> None:
+        """Remove chunks; segments of affected documents are rewritten or deleted"""
+        with self._lock:
+            affected = set()
+            for chunk_id in chunk_ids:
+                doc_id = self._chunk_doc.get(chunk_id)
+                if doc_id is None:
+                    continue
+                self._unindex_chunk(chunk_id)
+                affected.add(doc_id)
+            self._invalidate_stats()
+            if self.directory:
+                for doc_id in affected:
+                    self._rewrite_segment(doc_id)
+
+    def remove_document(self, doc_id: str) -> None:
+        with self._lock:
+            self.remove_chunks(list(self._doc_chunks.get(doc_id, [])))
+
+    def _rewrite_segment(self, doc_id: str) -> None:
+        path = self._segment_path(doc_id)
+        remaining = self._doc_chunks.get(doc_id)
+        if not remaining:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        fields = {key: value for key, value in self._doc_fields.get(doc_id, {}).items() if key != "doc_id"}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for chunk_id in remaining:
+                term_freqs = {term: self._postings[term][chunk_id] for term in self._chunk_terms[chunk_id]}
+                record = {"doc": doc_id, "id": chunk_id, "len": self._lengths[chunk_id], "tf": term_freqs, "f": fields}
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+        os.replace(tmp_path, path)
+
+    def _term_idf(self, term: str) -> float:
+        idf = self._idf.get(term)
+        if idf is None:
+            df = len(self._postings.get(term, ()))
+            n = len(self._lengths)
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            self._idf[term] = idf
+        return idf
+
+    def _chunk_norm(self, chunk_id: str, avg_length: float) -> float:
+        norm = self._norms.get(chunk_id)
+        if norm is None:
+            norm = self.k1 * (1 - self.b + self.b * self._lengths[chunk_id] / avg_length)
+            self._norms[chunk_id] = norm
+        return norm
+
+    def search(
+        self, query: str, top_k: int, filters: Optional[Dict[str, List[str]]] = None
+    ) -> List[Tuple[str, float]]:
+        """Top-k (chunk_id, score) for a query, best first
+
+        filters (normalized, see rag.filters) restrict the search to matching
+        documents; corpus statistics still cover the whole index.
+        """
+        with self._lock:
+            if not self._lengths:
+                return []
+            allowed = None
+            if filters:
+                allowed = {doc_id for doc_id, fields in self._doc_fields.items() if matches(filters, fields)}
+                if not allowed:
+                    return []
+            avg_length = self._total_length / len(self._lengths) or 1.0
+            scores: Dict[str, float] = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = self._term_idf(term)
+                for chunk_id, tf in postings.items():
+                    if allowed is not None and self._chunk_doc[chunk_id] not in allowed:
+                        continue
+                    scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + self._chunk_norm(chunk_id, avg_length))
+            return heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+
+
+_indexes: Dict[str, BM25Index] = {}
+_indexes_lock = threading.Lock()
+_bootstrap_lock = threading.Lock()
+
+
+def get_bm25_index(collection_name: str) -> BM25Index:
+    """Get or load the BM25 index of a collection"""
+    with _indexes_lock:
+        index = _indexes.get(collection_name)
+        if index is None:
+            chroma_db_path = os.getenv("CHROMA_DB_PATH", "./chroma_db")
+            index = BM25Index(os.path.join(chroma_db_path, "bm25", collection_name))
+            _indexes[collection_name] = index
+        return index
+
+
+def ensure_index(collection) -> BM25Index:
+    """BM25 index of a Chroma collection, built once from the collection if it predates the index
+
+    Call this before any incremental write to the index: completion of the
+    one-time build is recorded by a marker file, not inferred from the index
+    being non-empty, so chunks stored before the index existed are never missed.
+    """
+    index = get_bm25_index(collection.name)
+    if index.bootstrapped:
+        return index
+    with _bootstrap_lock:
+        if not index.bootstrapped:
+            if collection.count() > 0:
+                logger.info(f"[BM25] Building index for existing collection {collection.name}")
+                offset, page_size = 0, 1000
+                while True:
+                    page = collection.get(limit=page_size, offset=offset, include=["documents", "metadatas"])
+                    if not page["ids"]:
+                        break
+                    # Chunks indexed by earlier incremental writes are already there
+                    missing = [i for i, chunk_id in enumerate(page["ids"]) if chunk_id not in index]
+                    if missing:
+                        index.add_records(
+                            [page["ids"][i] for i in missing],
+                            [page["documents"][i] for i in missing],
+                            [page["metadatas"][i] for i in missing]
+                        )
+                    offset += page_size
+            index.mark_bootstrapped()
+    return index
+
+
+def reset() -> None:
+    """Forget loaded indexes (used by tests)"""
+    with _indexes_lock:
+        _indexes.clear()
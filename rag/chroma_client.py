@@ -1,10 +1,15 @@
 """Singleton ChromaDB client to avoid multiple connections"""
 import chromadb
 import os
-from typing import Optional
+from typing import Dict, Optional
+
+import config
+
+# Collection used before collections were named after their embedding identity
+LEGACY_COLLECTION_NAME = "documents"
 
 _chroma_client: Optional[chromadb.PersistentClient] = None
-_collection: Optional[chromadb.Collection] = None
+_collections: Dict[str, chromadb.Collection] = {}
 
 
 def get_chroma_client() -> chromadb.PersistentClient:
@@ -16,14 +21,40 @@ def get_chroma_client() -> chromadb.PersistentClient:
     return _chroma_client
 
 
-def get_chroma_collection() -> chromadb.Collection:
-    """Get or create ChromaDB collection (singleton pattern)"""
-    global _collection
-    if _collection is None:
-        client = get_chroma_client()
-        _collection = client.get_or_create_collection(
-            name="documents",
-            metadata={"hnsw:space": "cosine"}
-        )
-    return _collection
+def get_chroma_collection(name: Optional[str] = None) -> chromadb.Collection:
+    """Get or create a ChromaDB collection (one instance per name)
+
+    Without a name, returns the collection of the active embedding provider,
+    so stored and queried vectors always come from the same model. With
+    VECTOR_BACKEND=mmap the collection is a rag.mmap_store.MmapCollection,
+    which offers the same add/upsert/get/query/delete/count interface.
+    """
+    metadata = {"hnsw:space": "cosine"}
+    if name is None:
+        from rag.embeddings import get_embedding_identity
+        identity = get_embedding_identity()
+        name = identity.collection_name
+        metadata.update({
+            "embedding_provider": identity.provider,
+            "embedding_model": identity.model,
+            "embedding_dimension": identity.dimension
+        })
+
+    collection = _collections.get(name)
+    if collection is None:
+        if config.VECTOR_BACKEND == "mmap":
+            from rag.mmap_store import get_mmap_collection
+            collection = get_mmap_collection(name, metadata)
+        else:
+            client = get_chroma_client()
+            collection = client.get_or_create_collection(name=name, metadata=metadata)
+        _collections[name] = collection
+    return collection
+
 
+def open_collection(name: str) -> chromadb.Collection:
+    """An existing collection of the configured backend; raises ValueError if missing"""
+    if config.VECTOR_BACKEND == "mmap":
+        from rag.mmap_store import open_mmap_collection
+        return open_mmap_collection(name)
+    return get_chroma_client().get_collection(name)
@@ -1,139 +1,238 @@
-from anthropic import Anthropic
-import os
+from anthropic import AsyncAnthropic
 import asyncio
+import httpx
+import os
+import importlib.util
 import logging
-from typing import List, Dict, Any
-from config import ANTHROPIC_TIMEOUT, API_MAX_RETRIES
-from lib.retry import retry_with_backoff
+from typing import AsyncIterator, List, Dict, Any, Optional
+from config import (
+    ANTHROPIC_CONNECT_TIMEOUT,
+    ANTHROPIC_HTTP2,
+    ANTHROPIC_KEEPALIVE_EXPIRY,
+    ANTHROPIC_MAX_CONNECTIONS,
+    ANTHROPIC_MAX_KEEPALIVE,
+    ANTHROPIC_PROMPT_CACHING,
+    ANTHROPIC_TIMEOUT,
+    API_MAX_RETRIES,
+    CLAUDE_DEADLINE,
+    RETRY_INITIAL_DELAY,
+    RETRY_MAX_DELAY,
+)
+from lib import metrics
+from lib.admission import AdmissionRejected, admit
+from lib.retry import Deadline, get_breaker, retry_with_backoff
+from rag import answer_cache
+from rag.context_packer import pack_context
+from rag.tokens import estimate_tokens
 
 logger = logging.getLogger(__name__)
 
-# Lazy client initialization
+CLAUDE_MODEL = "claude-sonnet-4-20250514"
+MAX_TOKENS = 1500
+TEMPERATURE = 0.3
+# Bump whenever build_system / build_messages change so cached answers of the old prompt are not reused
+PROMPT_TEMPLATE_VERSION = "2"
+# Answer when relevant chunks exist but none fit the prompt's token budget
+CONTEXT_BUDGET_ANSWER = (
+    "The relevant passages from your documents don't fit within the context token budget of this request. "
+    "Try a larger max_context_tokens."
+)
+
+# Shared client, created at startup (or lazily on first use) and closed on shutdown
 _client = None
 
-def get_client():
-    """Get or create Anthropic client"""
+def _http2_enabled() -> bool:
+    if ANTHROPIC_HTTP2 == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return ANTHROPIC_HTTP2 == "true"
+
+def _build_http_client() -> httpx.AsyncClient:
+    """Pooled httpx client for all Claude calls
+    
+    trust_env=False ignores proxy env vars (Anthropic 0.39.0 doesn't support
+    'proxies' and httpx auto-detecting them breaks the client).
+    """
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(ANTHROPIC_TIMEOUT, connect=ANTHROPIC_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=ANTHROPIC_MAX_CONNECTIONS,
+            max_keepalive_connections=ANTHROPIC_MAX_KEEPALIVE,
+            keepalive_expiry=ANTHROPIC_KEEPALIVE_EXPIRY
+        ),
+        http2=_http2_enabled(),
+        trust_env=False
+    )
+
+def get_client() -> AsyncAnthropic:
+    """Get or create the shared async Anthropic client"""
     global _client
     if _client is None:
         api_key = os.getenv("ANTHROPIC_API_KEY")
         if not api_key:
             raise ValueError("ANTHROPIC_API_KEY environment variable is not set")
-        
-        # Temporarily unset proxy environment variables to prevent Anthropic/httpx from using them
-        # Anthropic 0.39.0 doesn't support 'proxies' parameter in constructor
-        # httpx (used by Anthropic) auto-detects proxies from env vars, which causes issues
-        original_proxies = {}
-        proxy_vars = [
-            'HTTP_PROXY', 'HTTPS_PROXY', 'http_proxy', 'https_proxy', 
-            'ALL_PROXY', 'all_proxy', 'NO_PROXY', 'no_proxy'
-        ]
-        
-        for var in proxy_vars:
-            if var in os.environ:
-                original_proxies[var] = os.environ.pop(var)
-                logger.debug(f"Temporarily unset {var} to prevent proxy issues")
-        
-        try:
-            # Only pass api_key - Anthropic 0.39.0 doesn't support timeout or proxies in constructor
-            # Timeout is handled via asyncio.wait_for in _call_claude()
-            _client = Anthropic(api_key=api_key)
-            logger.info("Anthropic client initialized successfully (proxies disabled)")
-        except Exception as e:
-            logger.error(f"Failed to initialize Anthropic client: {e}")
-            raise
-        finally:
-            # Restore proxy environment variables if they were set
-            for var, value in original_proxies.items():
-                os.environ[var] = value
-                logger.debug(f"Restored {var}")
+        # Retries are handled by retry_with_backoff around each call
+        _client = AsyncAnthropic(api_key=api_key, http_client=_build_http_client(), max_retries=0)
+        logger.info(
+            f"Anthropic client initialized (pool {ANTHROPIC_MAX_CONNECTIONS}, "
+            f"keepalive {ANTHROPIC_MAX_KEEPALIVE}, http2 {_http2_enabled()})"
+        )
     return _client
 
+async def close_client() -> None:
+    """Close the shared client and its connections"""
+    global _client
+    if _client is not None:
+        client, _client = _client, None
+        await client.close()
+        logger.info("Anthropic client closed")
+
+SYSTEM_PROMPT = """You are a helpful AI assistant answering questions based on provided documents.
+
+Instructions:
+1. Answer based ONLY on the provided context
+2. If the answer isn't in the context, say so clearly
+3. Cite sources using [Source N] notation
+4. Be concise but comprehensive
+5. If multiple sources support your answer, mention all
+6. If the context doesn't contain enough information, acknowledge this honestly"""
+
+_CACHE_BREAKPOINT = {"type": "ephemeral"}
+
+def build_context_text(context: List[Dict[str, Any]]) -> str:
+    """Retrieved chunks as numbered sources"""
+    context_text = "\n\n".join([
+        f"[Source {i+1}: {chunk.get('metadata', {}).get('filename', 'Unknown')}]\n{chunk.get('text', '')}"
+        for i, chunk in enumerate(context)
+    ])
+    return f"Context from documents:\n{context_text}"
+
+def build_question_text(query: str) -> str:
+    return f"User question: {query}\n\nAnswer:"
+
+def build_system() -> List[Dict[str, Any]]:
+    """Static instructions, cached as the first prompt prefix"""
+    block = {"type": "text", "text": SYSTEM_PROMPT}
+    if ANTHROPIC_PROMPT_CACHING:
+        block["cache_control"] = _CACHE_BREAKPOINT
+    return [block]
+
+def build_messages(query: str, context: List[Dict[str, Any]], history: str = "") -> List[Dict[str, Any]]:
+    """User turn: the document context (second cache breakpoint), the conversation history, then the question
+    
+    Only history and question vary between follow-ups over the same retrieved
+    chunks, so system + context form a prefix the provider can serve from its cache.
+    """
+    context_block = {"type": "text", "text": build_context_text(context)}
+    if ANTHROPIC_PROMPT_CACHING:
+        context_block["cache_control"] = _CACHE_BREAKPOINT
+    content = [context_block]
+    if history:
+        content.append({"type": "text", "text": history})
+    content.append({"type": "text", "text": build_question_text(query)})
+    return [{"role": "user", "content": content}]
+
+def _messages_api(client: AsyncAnthropic):
+    """Messages resource: the prompt-caching beta when caching is enabled"""
+    return client.beta.prompt_caching.messages if ANTHROPIC_PROMPT_CACHING else client.messages
+
+def record_usage(usage) -> Dict[str, int]:
+    """Token counts of one call (including prompt cache reads/writes), added to metrics"""
+    counts = {
+        "input_tokens": usage.input_tokens,
+        "output_tokens": usage.output_tokens,
+        "cache_creation_input_tokens": getattr(usage, "cache_creation_input_tokens", None) or 0,
+        "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None) or 0
+    }
+    for name, value in counts.items():
+        metrics.increment(f"claude.{name}", value)
+    return counts
+
+def build_sources(context: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Source list returned alongside an answer"""
+    return [
+        {
+            "filename": chunk.get("metadata", {}).get("filename", "Unknown"),
+            "text": chunk.get("text", "")[:200] + "..." if len(chunk.get("text", "")) > 200 else chunk.get("text", ""),
+            "chunk_id": chunk.get("metadata", {}).get("chunk_id", None)
+        }
+        for chunk in context
+    ]
+
+def pack_for_prompt(
+    query: str,
+    context: List[Dict[str, Any]],
+    history: str = "",
+    max_context_tokens: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Chunks of context that fit PROMPT_INPUT_TOKEN_BUDGET together with the prompt, and the context cap"""
+    prompt_tokens = sum(
+        estimate_tokens(text) for text in (SYSTEM_PROMPT, build_context_text([]), history, build_question_text(query))
+    )
+    return pack_context(context, prompt_tokens=prompt_tokens, max_context_tokens=max_context_tokens).chunks
+
 async def generate_response(
     query: str, 
     context: List[Dict[str, Any]], 
-    conversation_id: str = None
+    conversation_id: str = None,
+    history: str = "",
+    max_context_tokens: Optional[int] = None
 ) -> Dict[str, Any]:
-    """Generate response using Claude with RAG context"""
+    """Generate response using Claude with RAG context (history: prior turns of the conversation)"""
     
+    context = pack_for_prompt(query, context, history, max_context_tokens)
     if not context:
         return {
-            "answer": "I don't have any relevant context to answer your question. Please upload some documents first.",
+            "answer": CONTEXT_BUDGET_ANSWER,
             "sources": [],
             "conversation_id": conversation_id or "new"
         }
     
-    # Build context from retrieved chunks
-    context_text = "\n\n".join([
-        f"[Source {i+1}: {chunk.get('metadata', {}).get('filename', 'Unknown')}]\n{chunk.get('text', '')}"
-        for i, chunk in enumerate(context)
-    ])
+    cache_key = answer_cache.answer_key(CLAUDE_MODEL, PROMPT_TEMPLATE_VERSION, query, context, history)
+    cached = answer_cache.lookup(cache_key)
+    if cached is not None:
+        return {**cached, "conversation_id": conversation_id or "new"}
     
-    # Prompt for Claude
-    prompt = f"""You are a helpful AI assistant answering questions based on provided documents.
-
-Context from documents:
-{context_text}
-
-User question: {query}
-
-Instructions:
-1. Answer based ONLY on the provided context
-2. If the answer isn't in the context, say so clearly
-3. Cite sources using [Source N] notation
-4. Be concise but comprehensive
-5. If multiple sources support your answer, mention all
-6. If the context doesn't contain enough information, acknowledge this honestly
-
-Answer:"""
+    system = build_system()
+    messages = build_messages(query, context, history)
+    
+    # Queueing for a slot and every retry count against one deadline
+    deadline = Deadline(CLAUDE_DEADLINE)
     
     async def _call_claude():
-        """Call Claude API with timeout"""
+        """Call Claude API; the timeout applies to this attempt's HTTP call"""
         client = get_client()
-        loop = asyncio.get_event_loop()
-        
-        def _sync_create():
-            try:
-                return client.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=1500,
-                    temperature=0.3,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-            except Exception as e:
-                logger.error(f"Anthropic API error: {str(e)}")
-                raise
-        
         try:
-            message = await asyncio.wait_for(
-                loop.run_in_executor(None, _sync_create),
-                timeout=ANTHROPIC_TIMEOUT
+            return await _messages_api(client).create(
+                model=CLAUDE_MODEL,
+                max_tokens=MAX_TOKENS,
+                temperature=TEMPERATURE,
+                system=system,
+                messages=messages,
+                timeout=deadline.timeout(ANTHROPIC_TIMEOUT)
             )
-            return message
-        except asyncio.TimeoutError:
-            logger.error(f"Anthropic API timeout after {ANTHROPIC_TIMEOUT} seconds")
-            raise Exception(f"Anthropic API request timed out after {ANTHROPIC_TIMEOUT} seconds")
+        except Exception as e:
+            logger.error(f"Anthropic API error: {str(e)}")
+            raise
     
     try:
-        # Call Claude API with retry logic
-        message = await retry_with_backoff(
-            _call_claude,
-            max_retries=API_MAX_RETRIES,
-            exceptions=(Exception,)
-        )
+        # Call Claude API with retry logic; the admission slot is held across
+        # retries so they don't add to the pod's concurrent upstream calls
+        async with admit("claude"):
+            message = await retry_with_backoff(
+                _call_claude,
+                max_retries=API_MAX_RETRIES,
+                initial_delay=RETRY_INITIAL_DELAY,
+                max_delay=RETRY_MAX_DELAY,
+                deadline=deadline,
+                breaker=get_breaker("claude")
+            )
         
         answer = message.content[0].text
+        record_usage(message.usage)
         
         # Extract sources
-        sources = [
-            {
-                "filename": chunk.get("metadata", {}).get("filename", "Unknown"),
-                "text": chunk.get("text", "")[:200] + "..." if len(chunk.get("text", "")) > 200 else chunk.get("text", ""),
-                "chunk_id": chunk.get("metadata", {}).get("chunk_id", None)
-            }
-            for chunk in context
-        ]
+        sources = build_sources(context)
+        answer_cache.store(cache_key, answer, sources, answer_cache.context_doc_ids(context))
         
         return {
             "answer": answer,
@@ -141,7 +240,78 @@ Answer:"""
             "conversation_id": conversation_id or "new"
         }
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"Failed to call Claude API after retries: {str(e)}")
         raise Exception(f"Error calling Claude API: {str(e)}")
 
+async def stream_response(
+    query: str,
+    context: List[Dict[str, Any]],
+    conversation_id: str = None,
+    history: str = "",
+    max_context_tokens: Optional[int] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """Stream an answer as events: sources, then text deltas, then usage
+    
+    Each event is {"event": name, "data": {...}}. Closing the iterator early
+    (e.g. the client disconnected) leaves the stream context, which closes
+    the HTTP response so Claude stops generating tokens nobody reads.
+    """
+    
+    conversation_id = conversation_id or "new"
+    context = pack_for_prompt(query, context, history, max_context_tokens)
+    if not context:
+        # Nothing fits the budget: answer as generate_response does, without a Claude call
+        yield {"event": "sources", "data": {"sources": [], "conversation_id": conversation_id}}
+        yield {"event": "delta", "data": {"text": CONTEXT_BUDGET_ANSWER}}
+        yield {
+            "event": "usage",
+            "data": {"input_tokens": 0, "output_tokens": 0, "stop_reason": None, "conversation_id": conversation_id}
+        }
+        return
+    
+    # The slot is taken before the first event, so a rejection surfaces before any output
+    async with admit("claude"):
+        # Streams are not retried, but their outcome still feeds the circuit breaker
+        breaker = get_breaker("claude")
+        breaker.before_call()
+        completed = False
+        try:
+            yield {"event": "sources", "data": {"sources": build_sources(context), "conversation_id": conversation_id}}
+            
+            client = get_client()
+            async with _messages_api(client).stream(
+                model=CLAUDE_MODEL,
+                max_tokens=MAX_TOKENS,
+                temperature=TEMPERATURE,
+                system=build_system(),
+                messages=build_messages(query, context, history),
+                timeout=ANTHROPIC_TIMEOUT
+            ) as stream:
+                async for text in stream.text_stream:
+                    yield {"event": "delta", "data": {"text": text}}
+                message = await stream.get_final_message()
+            completed = True
+            breaker.record_success()
+            yield {
+                "event": "usage",
+                "data": {
+                    **record_usage(message.usage),
+                    "stop_reason": message.stop_reason,
+                    "conversation_id": conversation_id
+                }
+            }
+        except (GeneratorExit, asyncio.CancelledError):
+            if not completed:
+                metrics.increment("claude.streams_cancelled")
+                logger.info("Claude stream closed before completion")
+            raise
+        except Exception as e:
+            breaker.record(e)
+            metrics.increment("claude.stream_errors")
+            raise
+        finally:
+            if not completed:
+                breaker.release()
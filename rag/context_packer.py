@@ -0,0 +1,95 @@
+"""Pack retrieved chunks into the prompt's input token budget
+
+This is the only token budgeting of chunk text. The room for chunks is the
+smaller of PROMPT_INPUT_TOKEN_BUDGET minus the rest of the prompt, and the
+context cap (the request's max_context_tokens, default CONTEXT_TOKEN_BUDGET).
+
+Chunks are taken in retrieval order, which already ranks them by value
+(RRF / MMR); raw similarity scores are not comparable across retrieval modes.
+A chunk that fits is packed whole; one that doesn't is trimmed to the
+sentences that fit, and later, smaller chunks may still fill the rest.
+Sizes are estimated with rag.tokens, so no tokenizer round trip is needed.
+"""
+import logging
+import re
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from config import CONTEXT_MIN_TRIM_TOKENS, CONTEXT_TOKEN_BUDGET, PROMPT_INPUT_TOKEN_BUDGET
+from lib import metrics
+from rag.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+
+
+class PackedContext(NamedTuple):
+    chunks: List[Dict[str, Any]]
+    tokens: int  # estimated tokens of the packed chunks
+    available: int  # budget left for chunks after the prompt itself
+
+
+def split_sentences(text: str) -> List[str]:
+    """Sentences (and paragraphs) of text, each keeping its trailing whitespace"""
+    pieces, start = [], 0
+    for match in _SENTENCE_END.finditer(text):
+        pieces.append(text[start:match.end()])
+        start = match.end()
+    if start < len(text):
+        pieces.append(text[start:])
+    return pieces
+
+
+def trim_to_sentences(text: str, max_tokens: int) -> str:
+    """Longest prefix of whole sentences within max_tokens ("" if not even one fits)"""
+    kept, used = [], 0
+    for sentence in split_sentences(text):
+        tokens = estimate_tokens(sentence)
+        if used + tokens > max_tokens:
+            break
+        kept.append(sentence)
+        used += tokens
+    return "".join(kept).rstrip()
+
+
+def _chunk_overhead(chunk: Dict[str, Any]) -> int:
+    # "[Source N: filename]\n" header plus the blank line between chunks
+    return estimate_tokens(f"[Source 10: {chunk.get('metadata', {}).get('filename', 'Unknown')}]\n\n\n")
+
+
+def pack_context(
+    chunks: List[Dict[str, Any]],
+    prompt_tokens: int = 0,
+    budget: Optional[int] = None,
+    max_context_tokens: Optional[int] = None
+) -> PackedContext:
+    """Chunks, in retrieval order, that fit budget (default PROMPT_INPUT_TOKEN_BUDGET) minus
+    prompt_tokens and the context cap (default CONTEXT_TOKEN_BUDGET)"""
+    budget = PROMPT_INPUT_TOKEN_BUDGET if budget is None else budget
+    cap = CONTEXT_TOKEN_BUDGET if max_context_tokens is None else max_context_tokens
+    available = max(min(budget - prompt_tokens, cap), 0)
+    packed, used, trimmed = [], 0, 0
+    for chunk in chunks:
+        remaining = available - used - _chunk_overhead(chunk)
+        text = chunk.get("text", "")
+        tokens = estimate_tokens(text)
+        if tokens > remaining:
+            if remaining < CONTEXT_MIN_TRIM_TOKENS:
+                continue
+            text = trim_to_sentences(text, remaining)
+            if not text:
+                continue
+            chunk = {**chunk, "text": text, "trimmed": True}
+            tokens = estimate_tokens(text)
+            trimmed += 1
+        packed.append(chunk)
+        used += tokens + _chunk_overhead(chunk)
+
+    metrics.observe("context.packed_tokens", used)
+    metrics.observe("context.available_tokens", available)
+    metrics.increment("context.chunks_trimmed", trimmed)
+    metrics.increment("context.chunks_dropped", len(chunks) - len(packed))
+    logger.info(
+        f"[CONTEXT] Packed {len(packed)}/{len(chunks)} chunks, {used}/{available} tokens ({trimmed} trimmed)"
+    )
+    return PackedContext(packed, used, available)
@@ -0,0 +1,196 @@
+"""Conversation memory keyed by conversation_id
+
+Each conversation keeps its most recent turns verbatim plus a compact
+summary of older ones. After every turn, the oldest turns are folded into
+the summary (first sentence of question and answer) until the history
+fits CONVERSATION_HISTORY_TOKENS, and the summary keeps its newest lines.
+What is sent to Claude per request is therefore bounded no matter how long
+a conversation runs.
+
+Conversations are held as JSON in an LRU bounded by entry count and bytes
+(CONVERSATION_MAX_ENTRIES / CONVERSATION_MAX_BYTES) with an idle TTL; with
+CONVERSATION_BACKEND=sqlite they are also written through to
+CHROMA_DB_PATH/conversations.sqlite3 so they survive restarts and LRU
+eviction.
+"""
+import json
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional
+
+from config import (
+    CONVERSATION_BACKEND,
+    CONVERSATION_HISTORY_TOKENS,
+    CONVERSATION_MAX_BYTES,
+    CONVERSATION_MAX_ENTRIES,
+    CONVERSATION_RECENT_TURNS,
+    CONVERSATION_TTL,
+)
+from lib import metrics
+from lib.cache import LRUCache, SQLiteStore
+from rag.context_packer import split_sentences
+from rag.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_LINE_CHARS = 240
+FOLLOW_UP_MAX_WORDS = 6
+_ANAPHORA = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|their|he|she|his|her|there|above|previous)\b"
+    r"|^\s*(and|also|what about|how about)\b",
+    re.IGNORECASE
+)
+
+
+def empty_conversation() -> Dict[str, Any]:
+    return {"summary": [], "turns": []}
+
+
+class ConversationStore:
+    """LRU of serialized conversations with an optional SQLite write-through tier"""
+
+    def __init__(
+        self,
+        max_entries: int = CONVERSATION_MAX_ENTRIES,
+        max_bytes: int = CONVERSATION_MAX_BYTES,
+        ttl: Optional[float] = CONVERSATION_TTL,
+        path: Optional[str] = None
+    ):
+        self.ttl = ttl
+        self._memory = LRUCache(max_entries=max_entries, ttl=ttl, max_bytes=max_bytes, sizeof=len)
+        self._disk = SQLiteStore(path, table="conversations") if path else None
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id: str) -> Dict[str, Any]:
+        blob = self._memory.get(conversation_id)
+        if blob is None and self._disk is not None:
+            try:
+                blob = self._disk.get(conversation_id)
+            except Exception as e:
+                logger.warning(f"[CONVERSATIONS] Disk lookup failed: {e}")
+            if blob is not None:
+                self._memory.set(conversation_id, blob)
+        return json.loads(blob) if blob is not None else empty_conversation()
+
+    def put(self, conversation_id: str, conversation: Dict[str, Any]) -> None:
+        blob = json.dumps(conversation).encode("utf-8")
+        self._memory.set(conversation_id, blob)
+        if self._disk is not None:
+            try:
+                self._disk.set(conversation_id, blob, ttl=self.ttl)
+            except Exception as e:
+                logger.warning(f"[CONVERSATIONS] Disk write failed: {e}")
+        metrics.set_gauge("conversations.entries", len(self._memory))
+        metrics.set_gauge("conversations.bytes", self._memory.total_bytes)
+
+    def add_turn(self, conversation_id: str, user: str, assistant: str) -> Dict[str, Any]:
+        """Append a turn and compact the conversation; returns the stored conversation"""
+        with self._lock:
+            conversation = self.get(conversation_id)
+            conversation["turns"].append({"user": user, "assistant": assistant})
+            compact(conversation)
+            self.put(conversation_id, conversation)
+            return conversation
+
+    def purge_expired(self) -> int:
+        """Drop expired conversations from the disk tier"""
+        return self._disk.purge_expired() if self._disk is not None else 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "sqlite" if self._disk is not None else "memory",
+            "entries": len(self._memory),
+            "bytes": self._memory.total_bytes,
+            "max_bytes": self._memory.max_bytes
+        }
+
+    def clear(self) -> None:
+        self._memory.clear()
+
+
+def _first_sentence(text: str) -> str:
+    sentences = split_sentences(" ".join(text.split()))
+    sentence = sentences[0].strip() if sentences else ""
+    return sentence if len(sentence) <= SUMMARY_LINE_CHARS else sentence[:SUMMARY_LINE_CHARS - 3].rstrip() + "..."
+
+
+def summarize_turn(turn: Dict[str, str]) -> str:
+    """One summary line for a turn"""
+    return f"Q: {_first_sentence(turn['user'])} A: {_first_sentence(turn['assistant'])}"
+
+
+def history_text(conversation: Optional[Dict[str, Any]]) -> str:
+    """History block for the prompt ("" for a new conversation)"""
+    if not conversation or not (conversation["summary"] or conversation["turns"]):
+        return ""
+    parts = []
+    if conversation["summary"]:
+        parts.append("Summary of earlier conversation:\n" + "\n".join(f"- {line}" for line in conversation["summary"]))
+    if conversation["turns"]:
+        parts.append("Recent conversation:\n" + "\n".join(
+            f"User: {turn['user']}\nAssistant: {turn['assistant']}" for turn in conversation["turns"]
+        ))
+    return "\n\n".join(parts)
+
+
+def compact(conversation: Dict[str, Any], max_tokens: int = CONVERSATION_HISTORY_TOKENS) -> None:
+    """Fold old turns into the summary until the history fits max_tokens (in place)"""
+    turns = conversation["turns"]
+    while turns and (
+        len(turns) > CONVERSATION_RECENT_TURNS or estimate_tokens(history_text(conversation)) > max_tokens
+    ):
+        conversation["summary"].append(summarize_turn(turns.pop(0)))
+        metrics.increment("conversations.turns_summarized")
+    # Oldest summary lines go first when even the summary is over the cap
+    while conversation["summary"] and estimate_tokens(history_text(conversation)) > max_tokens:
+        conversation["summary"].pop(0)
+
+
+def is_follow_up(query: str) -> bool:
+    """Heuristic: short questions and questions referring back ("it", "that", "what about") need history"""
+    return len(query.split()) <= FOLLOW_UP_MAX_WORDS or _ANAPHORA.search(query) is not None
+
+
+def rewrite_query(query: str, conversation: Optional[Dict[str, Any]]) -> str:
+    """Retrieval query for a turn: follow-ups are expanded with the previous question"""
+    if not conversation or not is_follow_up(query):
+        return query
+    previous: List[str] = [turn["user"] for turn in conversation["turns"]]
+    if not previous:
+        return query
+    metrics.increment("conversations.queries_rewritten")
+    return f"{previous[-1]} {query}"
+
+
+_store: Optional[ConversationStore] = None
+
+
+def get_store() -> ConversationStore:
+    """Configured conversation store"""
+    global _store
+    if _store is None:
+        path = None
+        if CONVERSATION_BACKEND == "sqlite":
+            path = os.path.join(os.getenv("CHROMA_DB_PATH", "./chroma_db"), "conversations.sqlite3")
+        try:
+            _store = ConversationStore(path=path)
+        except Exception as e:
+            logger.warning(f"[CONVERSATIONS] SQLite store unavailable, using memory only: {e}")
+            _store = ConversationStore()
+    return _store
+
+
+def purge_expired() -> int:
+    return get_store().purge_expired()
+
+
+def load(conversation_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Conversation for an id (None when the request has no conversation_id)"""
+    return get_store().get(conversation_id) if conversation_id else None
+
+
+def record_turn(conversation_id: Optional[str], user: str, assistant: str) -> None:
+    if conversation_id:
+        get_store().add_turn(conversation_id, user, assistant)
@@ -0,0 +1,132 @@
+"""Post-retrieval diversification: maximal marginal relevance and overlap merging
+
+Adjacent chunks of a document share CHUNK_OVERLAP characters, so a plain
+top-k often returns the same passage several times. Candidates are reordered
+with MMR (relevance traded against similarity to what was already picked) and
+chunks whose character ranges overlap within one doc_id are merged into one.
+"""
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+def mmr_order(relevance: np.ndarray, embeddings: np.ndarray, k: int, lambda_mult: float = 0.7) -> List[int]:
+    """Indices of up to k candidates in MMR order
+
+    relevance is one score per candidate (higher is better); embeddings holds
+    one row per candidate. Pairwise cosine similarities are computed once as a
+    matrix and the running max-similarity to the selected set is updated with
+    one vectorized step per pick.
+    """
+    n = len(relevance)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms == 0, 1.0, norms)
+    similarity = vectors @ vectors.T
+
+    relevance = np.asarray(relevance, dtype=np.float32)
+    max_similarity = np.full(n, -np.inf, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    selected = []
+    for _ in range(k):
+        if selected:
+            scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        else:
+            scores = relevance.copy()
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
+
+
+def _span(chunk: Dict[str, Any]) -> Optional[tuple]:
+    metadata = chunk.get("metadata") or {}
+    start, end = metadata.get("char_start"), metadata.get("char_end")
+    if start is None or end is None or not metadata.get("doc_id"):
+        return None
+    return metadata["doc_id"], int(start), int(end)
+
+
+def _merge_into(kept: Dict[str, Any], chunk: Dict[str, Any]) -> None:
+    """Extend kept with the part of chunk's text outside kept's character range"""
+    kept_meta, meta = kept["metadata"], chunk["metadata"]
+    start, end = kept_meta["char_start"], kept_meta["char_end"]
+    other_start, other_end = meta["char_start"], meta["char_end"]
+    text = kept["text"]
+    if other_start < start:
+        text = chunk["text"][:start - other_start] + text
+        start = other_start
+    if other_end > end:
+        text = text + chunk["text"][len(chunk["text"]) - (other_end - end):]
+        end = other_end
+    kept["text"] = text
+    kept["metadata"] = {**kept_meta, "char_start": start, "char_end": end}
+
+
+def _union_length(a: tuple, b: tuple) -> int:
+    return max(a[2], b[2]) - min(a[1], b[1])
+
+
+def merge_overlapping(
+    chunks: List[Dict[str, Any]],
+    limit: Optional[int] = None,
+    max_chars: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Merge chunks whose character ranges overlap (or touch) within the same doc_id
+
+    A chunk fully inside an earlier one is dropped; a partially overlapping
+    chunk extends the earlier one, which keeps its rank, unless the merged
+    range would exceed max_chars, in which case the overlapping chunk is
+    dropped. Chunks without char_start/char_end metadata (stored before
+    offsets were recorded) pass through unchanged. Stops once limit distinct
+    chunks have been produced.
+    """
+    result: List[Dict[str, Any]] = []
+    for chunk in chunks:
+        span = _span(chunk)
+        if span is not None:
+            doc_id, start, end = span
+            target = None
+            for kept in result:
+                kept_span = _span(kept)
+                if kept_span and kept_span[0] == doc_id and start <= kept_span[2] and end >= kept_span[1]:
+                    target = kept
+                    break
+            if target is not None:
+                if max_chars is not None and _union_length(_span(target), span) > max_chars:
+                    continue
+                _merge_into(target, chunk)
+                # The grown range may now bridge to another kept chunk of the document
+                _, start, end = _span(target)
+                for kept in list(result):
+                    kept_span = _span(kept)
+                    if kept is not target and kept_span and kept_span[0] == doc_id \
+                            and kept_span[1] <= end and kept_span[2] >= start \
+                            and (max_chars is None or _union_length(_span(target), kept_span) <= max_chars):
+                        _merge_into(target, kept)
+                        result.remove(kept)
+                continue
+        if limit is not None and len(result) >= limit:
+            break
+        result.append({**chunk, "metadata": dict(chunk.get("metadata") or {})})
+    return result
+
+
+def diversify(
+    chunks: List[Dict[str, Any]],
+    relevance: np.ndarray,
+    embeddings: np.ndarray,
+    k: int,
+    lambda_mult: float = 0.7,
+    max_chars: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """Pick k distinct chunks from the candidates: MMR order, then overlap merging"""
+    if not chunks:
+        return []
+    order = mmr_order(relevance, embeddings, len(chunks), lambda_mult)
+    return merge_overlapping([chunks[i] for i in order], limit=k, max_chars=max_chars)
@@ -0,0 +1,164 @@
+"""Content-addressed embedding cache (in-process LRU + on-disk SQLite store)
+
+Vectors are kept serialized in EMBEDDING_STORAGE_DTYPE (float32, float16 or
+int8) in both tiers, so the in-process tier costs a few bytes per dimension
+rather than a Python float object per dimension. Disk rows expire after
+EMBEDDING_CACHE_DISK_TTL and the tier is trimmed to
+EMBEDDING_CACHE_DISK_MAX_ENTRIES by purge_expired(); disk reads and writes run
+in a worker thread, off the event loop.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from config import (
+    EMBEDDING_CACHE_DISK_MAX_ENTRIES,
+    EMBEDDING_CACHE_DISK_TTL,
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_MAX_ENTRIES,
+    EMBEDDING_CACHE_MAX_BYTES,
+    EMBEDDING_CACHE_PERSIST,
+    EMBEDDING_STORAGE_DTYPE,
+)
+from lib import metrics
+from lib.cache import LRUCache, SQLiteStore
+from rag.quantization import from_bytes, to_bytes
+
+logger = logging.getLogger(__name__)
+
+_memory_cache: Optional[LRUCache] = None
+_disk_store: Optional[SQLiteStore] = None
+
+
+def cache_key(provider: str, model: str, text: str) -> str:
+    """Build the cache key for one text under one embedding model"""
+    digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    return f"{provider}:{model}:{digest}"
+
+
+def _storage_key(key: str) -> str:
+    """Disk key; quantized encodings get their own keys so dtypes never mix"""
+    if EMBEDDING_STORAGE_DTYPE == "float32":
+        return key
+    return f"{key}|{EMBEDDING_STORAGE_DTYPE}"
+
+
+def _get_memory_cache() -> LRUCache:
+    global _memory_cache
+    if _memory_cache is None:
+        _memory_cache = LRUCache(
+            max_entries=EMBEDDING_CACHE_MAX_ENTRIES,
+            max_bytes=EMBEDDING_CACHE_MAX_BYTES,
+            sizeof=len
+        )
+    return _memory_cache
+
+
+def _get_disk_store() -> Optional[SQLiteStore]:
+    global _disk_store
+    if _disk_store is None and EMBEDDING_CACHE_PERSIST:
+        chroma_db_path = os.getenv("CHROMA_DB_PATH", "./chroma_db")
+        try:
+            _disk_store = SQLiteStore(
+                os.path.join(chroma_db_path, "embedding_cache.sqlite3"),
+                table="embeddings",
+                max_entries=EMBEDDING_CACHE_DISK_MAX_ENTRIES
+            )
+        except Exception as e:
+            logger.warning(f"[EMBED_CACHE] Disk cache unavailable, using memory only: {e}")
+            return None
+    return _disk_store
+
+
+async def lookup(provider: str, model: str, texts: Sequence[str]) -> List[Optional[np.ndarray]]:
+    """Return cached float32 embeddings in input order, None for each miss"""
+    if not EMBEDDING_CACHE_ENABLED:
+        return [None] * len(texts)
+
+    memory = _get_memory_cache()
+    keys = [cache_key(provider, model, text) for text in texts]
+    blobs = [memory.get(key) for key in keys]
+    results: List[Optional[np.ndarray]] = [
+        from_bytes(blob, EMBEDDING_STORAGE_DTYPE) if blob is not None else None
+        for blob in blobs
+    ]
+
+    missing = [i for i, value in enumerate(results) if value is None]
+    memory_hits = len(texts) - len(missing)
+    disk_hits = 0
+
+    disk = _get_disk_store() if missing else None
+    if disk is not None:
+        try:
+            stored = await asyncio.to_thread(disk.get_many, [_storage_key(keys[i]) for i in missing])
+        except Exception as e:
+            logger.warning(f"[EMBED_CACHE] Disk lookup failed: {e}")
+            stored = {}
+        for i in missing:
+            blob = stored.get(_storage_key(keys[i]))
+            if blob is not None:
+                memory.set(keys[i], blob)
+                results[i] = from_bytes(blob, EMBEDDING_STORAGE_DTYPE)
+                disk_hits += 1
+
+    misses = len(missing) - disk_hits
+    metrics.increment("embedding_cache.hits_memory", memory_hits)
+    metrics.increment("embedding_cache.hits_disk", disk_hits)
+    metrics.increment("embedding_cache.misses", misses)
+    return results
+
+
+async def store(provider: str, model: str, texts: Sequence[str], embeddings: np.ndarray) -> None:
+    """Insert freshly computed embeddings into both cache tiers"""
+    if not EMBEDDING_CACHE_ENABLED or not texts:
+        return
+
+    memory = _get_memory_cache()
+    rows = []
+    for text, embedding in zip(texts, embeddings):
+        key = cache_key(provider, model, text)
+        blob = to_bytes(np.asarray(embedding, dtype=np.float32), EMBEDDING_STORAGE_DTYPE)
+        memory.set(key, blob)
+        rows.append((_storage_key(key), blob))
+
+    disk = _get_disk_store()
+    if disk is not None:
+        try:
+            await asyncio.to_thread(disk.set_many, rows, EMBEDDING_CACHE_DISK_TTL)
+        except Exception as e:
+            logger.warning(f"[EMBED_CACHE] Disk write failed: {e}")
+
+
+def purge_expired() -> int:
+    """Drop expired and surplus rows from the disk tier; returns how many"""
+    disk = _get_disk_store() if EMBEDDING_CACHE_ENABLED else None
+    return disk.purge_expired() if disk is not None else 0
+
+
+def get_cache_stats() -> dict:
+    """Hit/miss counters and current memory tier size"""
+    counters = metrics.snapshot()["counters"]
+    memory_hits = counters.get("embedding_cache.hits_memory", 0)
+    disk_hits = counters.get("embedding_cache.hits_disk", 0)
+    misses = counters.get("embedding_cache.misses", 0)
+    total = memory_hits + disk_hits + misses
+    return {
+        "enabled": EMBEDDING_CACHE_ENABLED,
+        "hits_memory": memory_hits,
+        "hits_disk": disk_hits,
+        "misses": misses,
+        "hit_rate": (memory_hits + disk_hits) / total if total else 0.0,
+        "memory_entries": len(_memory_cache) if _memory_cache is not None else 0,
+        "memory_bytes": _memory_cache.total_bytes if _memory_cache is not None else 0,
+        "storage_dtype": EMBEDDING_STORAGE_DTYPE
+    }
+
+
+def clear() -> None:
+    """Drop the in-process tier (the disk tier is left untouched)"""
+    if _memory_cache is not None:
+        _memory_cache.clear()
@@ -0,0 +1,147 @@
+"""Dedicated executors for local embedding inference
+
+Local models run either on a process pool, where each worker loads the
+model once and returns float32 arrays through shared memory, or on a
+dedicated thread. Neither uses the event loop's default executor, which
+is shared with the Anthropic calls.
+"""
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Model loaded once per worker process by _init_worker
+_worker_model = None
+
+
+def _init_worker(model_name: str) -> None:
+    global _worker_model
+    from sentence_transformers import SentenceTransformer
+    _worker_model = SentenceTransformer(model_name, device="cpu")
+
+
+def _encode_to_shared_memory(texts: List[str]) -> Tuple[str, Tuple[int, int]]:
+    """Encode in the worker and hand the matrix back by shared memory name"""
+    vectors = _worker_model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    shm = shared_memory.SharedMemory(create=True, size=max(vectors.nbytes, 1))
+    try:
+        np.ndarray(vectors.shape, dtype=np.float32, buffer=shm.buf)[...] = vectors
+        return shm.name, vectors.shape
+    finally:
+        shm.close()
+
+
+def _read_shared_array(name: str, shape: Tuple[int, int]) -> np.ndarray:
+    """Copy a worker result out of shared memory and release the segment"""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=np.float32, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _discard_shared_result(future: Future) -> None:
+    """Release the segment of a result nobody is waiting for any more"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    name, _ = future.result()
+    try:
+        segment = shared_memory.SharedMemory(name=name)
+        segment.close()
+        segment.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class EmbeddingWorkerPool:
+    """Process pool running a sentence-transformers model in every worker"""
+
+    def __init__(self, model_name: str, processes: int):
+        self.model_name = model_name
+        self.processes = processes
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, not fork: forking a process that has torch/threads loaded is unsafe
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_name,)
+            )
+            logger.info(f"[EMBED_WORKERS] Started {self.processes} worker process(es) for {self.model_name}")
+        return self._executor
+
+    async def encode(self, texts: List[str]) -> np.ndarray:
+        """Encode texts in a worker process, returning an (n, dim) float32 matrix"""
+        try:
+            future = self._get_executor().submit(_encode_to_shared_memory, list(texts))
+        except BrokenProcessPool:
+            self._reset()
+            raise
+        try:
+            name, shape = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Timed out or cancelled: the worker may still finish, so free its segment then
+            future.add_done_callback(_discard_shared_result)
+            raise
+        except BrokenProcessPool:
+            # A worker died (e.g. OOM-killed); start a fresh pool for the next attempt
+            logger.error("[EMBED_WORKERS] Worker pool broken, restarting")
+            self._reset()
+            raise
+        return _read_shared_array(name, shape)
+
+    async def warm_up(self) -> np.ndarray:
+        """Start every worker (each loads the model) and run one encode per worker"""
+        results = await asyncio.gather(*(self.encode(["warm-up"]) for _ in range(self.processes)))
+        return results[0]
+
+    def _reset(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def shutdown(self) -> None:
+        self._reset()
+
+
+_local_executor: Optional[ThreadPoolExecutor] = None
+_pool: Optional[EmbeddingWorkerPool] = None
+
+
+def get_local_executor() -> ThreadPoolExecutor:
+    """Single dedicated thread for in-process local embedding work"""
+    global _local_executor
+    if _local_executor is None:
+        _local_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+    return _local_executor
+
+
+def get_worker_pool(model_name: str, processes: int) -> EmbeddingWorkerPool:
+    """Get or create the shared worker pool"""
+    global _pool
+    if _pool is None:
+        _pool = EmbeddingWorkerPool(model_name, processes)
+    return _pool
+
+
+def shutdown() -> None:
+    """Stop worker processes and the local embedding thread"""
+    global _pool, _local_executor
+    if _pool is not None:
+        _pool.shutdown()
+        _pool = None
+    if _local_executor is not None:
+        _local_executor.shutdown(wait=False)
+        _local_executor = None
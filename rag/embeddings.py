@@ -1,141 +1,260 @@
-from typing import List
-import os
+from typing import AsyncIterator, List, Optional, Tuple
+from contextlib import nullcontext
 import asyncio
 import logging
-from config import ANTHROPIC_TIMEOUT, API_MAX_RETRIES
-from lib.retry import retry_with_backoff
+import numpy as np
+from config import (
+    API_MAX_RETRIES,
+    EMBEDDING_PROVIDER,
+    HASH_EMBEDDING_MODE,
+    EMBEDDING_DEADLINE,
+    EMBEDDING_TIMEOUT,
+    EMBEDDING_MAX_CONCURRENCY,
+    EMBEDDING_BATCH_SIZE,
+    OPENAI_EMBEDDING_BATCH_SIZE,
+    LOCAL_EMBEDDING_BATCH_SIZE,
+    HASH_EMBEDDING_BATCH_SIZE,
+    RETRY_INITIAL_DELAY,
+    RETRY_MAX_DELAY,
+)
+from lib.retry import Deadline, get_breaker, retry_with_backoff
+from lib.admission import AdmissionRejected, admit
+from rag import embedding_cache, embedding_workers
+from rag.embedding_workers import EmbeddingWorkerPool
+from rag.hash_embeddings import hash_embeddings, HASH_EMBEDDING_DIM
+from rag.providers import EmbeddingIdentity, PROVIDER_FALLBACK_ORDER, create_provider
 
 logger = logging.getLogger(__name__)
 
-# Try to use OpenAI if available, otherwise use sentence-transformers (local, free)
 _embedding_model = None
 _use_openai = None
+_embedding_identity: Optional[EmbeddingIdentity] = None  # keys the embedding cache and names the collection
 
 def _get_embedding_model():
-    """Get embedding model - prefer OpenAI, fallback to sentence-transformers"""
-    global _embedding_model, _use_openai
+    """Get the embedding model of the configured provider (EMBEDDING_PROVIDER)
+    
+    "auto" prefers OpenAI, then sentence-transformers, then hash-based
+    embeddings. A fallback is logged as a warning; since every identity has
+    its own collection, it can never mix vectors of different models.
+    """
+    global _embedding_model, _use_openai, _embedding_identity
     
     if _embedding_model is not None:
         return _embedding_model, _use_openai
     
-    # Check if OpenAI API key is available
-    openai_key = os.getenv("OPENAI_API_KEY")
-    if openai_key:
+    explicit = EMBEDDING_PROVIDER != "auto"
+    names = [EMBEDDING_PROVIDER] if explicit else PROVIDER_FALLBACK_ORDER
+    for name in names:
         try:
-            from openai import OpenAI
-            from config import OPENAI_TIMEOUT
-            _embedding_model = OpenAI(api_key=openai_key, timeout=OPENAI_TIMEOUT)
-            _use_openai = True
-            logger.info("Using OpenAI embeddings API")
-            return _embedding_model, _use_openai
+            model, identity = create_provider(name)
         except Exception as e:
-            logger.warning(f"Failed to initialize OpenAI client: {e}")
+            if explicit:
+                # An explicitly configured provider must not silently fall back
+                logger.error(f"Embedding provider '{name}' failed to initialize: {e}")
+                raise
+            logger.warning(f"Embedding provider '{name}' unavailable, trying next: {e}")
+            continue
+        _embedding_model = model
+        _use_openai = identity.provider == "openai"
+        _embedding_identity = identity
+        logger.info(
+            f"✅ Using embeddings {identity.provider}/{identity.model} ({identity.dimension} dims), "
+            f"collection '{identity.collection_name}'"
+        )
+        return _embedding_model, _use_openai
     
-    # Fallback 1: Try sentence-transformers (local, free, no API key needed)
+    raise RuntimeError("No embedding provider available")
+
+
+def set_embedding_provider(name: str) -> EmbeddingIdentity:
+    """Switch this process to an explicit provider (used by the migration command)"""
+    global _embedding_model, _use_openai, _embedding_identity
+    model, identity = create_provider(name)
+    _embedding_model = model
+    _use_openai = identity.provider == "openai"
+    _embedding_identity = identity
+    return identity
+
+
+def get_embedding_identity() -> EmbeddingIdentity:
+    """Identity (provider, model, dimension) of the active embedding provider"""
+    _get_embedding_model()
+    return _embedding_identity
+
+def _get_batch_size(model, use_openai) -> int:
+    """Texts per provider request"""
+    if EMBEDDING_BATCH_SIZE > 0:
+        return EMBEDDING_BATCH_SIZE
+    if use_openai:
+        return OPENAI_EMBEDDING_BATCH_SIZE
+    if model == "hash_based":
+        return HASH_EMBEDDING_BATCH_SIZE
+    return LOCAL_EMBEDDING_BATCH_SIZE
+
+
+def _embed_sync(model, use_openai: bool, texts: List[str]) -> np.ndarray:
+    """Embed one sub-batch with the active provider (blocking), as an (n, dim) float32 matrix"""
     try:
-        from sentence_transformers import SentenceTransformer
-        logger.info("Initializing sentence-transformers model (this may take a moment on first run)...")
-        _embedding_model = SentenceTransformer('all-MiniLM-L6-v2', device='cpu')
-        _use_openai = False
-        logger.info("✅ Using sentence-transformers (local embeddings, no API key required)")
-        return _embedding_model, _use_openai
-    except ImportError as e:
-        logger.warning(f"sentence-transformers not available: {e}")
-        logger.info("Falling back to simple hash-based embeddings")
+        if use_openai:
+            # Use OpenAI API
+            response = model.embeddings.create(
+                model="text-embedding-3-small",
+                input=texts
+            )
+            return np.array([item.embedding for item in response.data], dtype=np.float32)
+        else:
+            # Use sentence-transformers or hash-based
+            if model == "hash_based":
+                # Simple hash-based embeddings (lightweight, works but less accurate)
+                logger.debug(f"Generating hash-based embeddings for {len(texts)} texts")
+                embeddings = hash_embeddings(texts, mode=HASH_EMBEDDING_MODE)
+                logger.debug(f"Generated {len(embeddings)} hash-based embeddings, dimension: {HASH_EMBEDDING_DIM}")
+                return embeddings
+            else:
+                # Use sentence-transformers (local)
+                logger.debug(f"Generating embeddings for {len(texts)} texts using sentence-transformers")
+                embeddings = model.encode(texts, convert_to_numpy=True, show_progress_bar=False)
+                result = np.ascontiguousarray(embeddings, dtype=np.float32)
+                logger.debug(f"Generated {len(result)} embeddings, dimension: {result.shape[1] if len(result) else 0}")
+                return result
     except Exception as e:
-        logger.warning(f"Failed to initialize sentence-transformers: {e}")
-        logger.info("Falling back to simple hash-based embeddings")
-    
-    # Fallback 2: Use simple hash-based embeddings (works but less accurate)
-    logger.info("Using hash-based embeddings (lightweight fallback)")
-    _embedding_model = "hash_based"  # Marker for hash-based mode
-    _use_openai = False
-    return _embedding_model, _use_openai
+        logger.error(f"Embedding generation error: {str(e)}")
+        raise
 
-async def get_embeddings(texts: List[str]) -> List[List[float]]:
-    """Generate embeddings using OpenAI API or sentence-transformers"""
+
+async def _embed_batch(texts: List[str]) -> np.ndarray:
+    """Embed one sub-batch with its own timeout and retries
+
+    Previously computed embeddings are served from the embedding cache; only
+    cache misses are sent to the provider.
+    """
+    model, use_openai = _get_embedding_model()
+    identity = _embedding_identity
+    cached = await embedding_cache.lookup(identity.provider, identity.model, texts)
     
-    if not texts:
-        return []
+    # Embed each distinct missing text once
+    missing_texts = list(dict.fromkeys(text for text, emb in zip(texts, cached) if emb is None))
+    if not missing_texts:
+        return np.stack(cached)
+    logger.debug(f"Embedding cache: {len(texts) - len(missing_texts)} hits, {len(missing_texts)} misses")
+    
+    # All attempts for this sub-batch, admission queueing included, share one deadline
+    deadline = Deadline(EMBEDDING_DEADLINE)
     
     async def _create_embeddings():
-        model, use_openai = _get_embedding_model()
         loop = asyncio.get_event_loop()
-        
-        def _sync_create():
-            try:
-                if use_openai:
-                    # Use OpenAI API
-                    response = model.embeddings.create(
-                        model="text-embedding-3-small",
-                        input=texts
-                    )
-                    return [item.embedding for item in response.data]
-                else:
-                    # Use sentence-transformers or hash-based
-                    if model == "hash_based":
-                        # Simple hash-based embeddings (lightweight, works but less accurate)
-                        logger.debug(f"Generating hash-based embeddings for {len(texts)} texts")
-                        import hashlib
-                        import struct
-                        import numpy as np
-                        
-                        embeddings = []
-                        for text in texts:
-                            # Create deterministic embedding from text hash
-                            hash_obj = hashlib.sha256(text.encode('utf-8'))
-                            hash_bytes = hash_obj.digest()
-                            
-                            # Generate 384-dimensional vector (same as all-MiniLM-L6-v2)
-                            embedding = []
-                            for i in range(0, min(len(hash_bytes), 384 * 4), 4):
-                                if i + 4 <= len(hash_bytes):
-                                    # Convert 4 bytes to float
-                                    val = struct.unpack('>f', hash_bytes[i:i+4])[0]
-                                    # Normalize to [-1, 1]
-                                    embedding.append(max(-1.0, min(1.0, val)))
-                            
-                            # Pad to 384 dimensions
-                            while len(embedding) < 384:
-                                # Use hash of text + index for padding
-                                pad_hash = hashlib.sha256((text + str(len(embedding))).encode()).digest()
-                                pad_val = struct.unpack('>f', pad_hash[:4])[0]
-                                embedding.append(max(-1.0, min(1.0, pad_val)))
-                            
-                            embeddings.append(embedding[:384])
-                        
-                        logger.debug(f"Generated {len(embeddings)} hash-based embeddings, dimension: 384")
-                        return embeddings
-                    else:
-                        # Use sentence-transformers (local)
-                        logger.debug(f"Generating embeddings for {len(texts)} texts using sentence-transformers")
-                        embeddings = model.encode(texts, convert_to_numpy=False, show_progress_bar=False)
-                        # Convert to list of lists
-                        result = [emb.tolist() if hasattr(emb, 'tolist') else list(emb) for emb in embeddings]
-                        logger.debug(f"Generated {len(result)} embeddings, dimension: {len(result[0]) if result else 0}")
-                        return result
-            except Exception as e:
-                logger.error(f"Embedding generation error: {str(e)}")
-                raise
-        
-        # Execute in thread pool with timeout
+        if isinstance(model, EmbeddingWorkerPool):
+            call = model.encode(missing_texts)
+        else:
+            # OpenAI calls are I/O bound and use the default executor; local
+            # models get a dedicated thread so they never starve Claude calls
+            executor = None if use_openai else embedding_workers.get_local_executor()
+            call = loop.run_in_executor(executor, _embed_sync, model, use_openai, missing_texts)
+        # Execute with a per-attempt timeout, shortened to what is left of the deadline
+        timeout = deadline.timeout(EMBEDDING_TIMEOUT)
         try:
-            embeddings = await asyncio.wait_for(
-                loop.run_in_executor(None, _sync_create),
-                timeout=ANTHROPIC_TIMEOUT
-            )
-            return embeddings
+            return await asyncio.wait_for(call, timeout=timeout)
         except asyncio.TimeoutError:
-            logger.error(f"Embedding generation timeout after {ANTHROPIC_TIMEOUT} seconds")
-            raise Exception(f"Embedding generation timed out after {ANTHROPIC_TIMEOUT} seconds")
+            logger.error(f"Embedding generation timeout after {timeout:.1f} seconds")
+            raise TimeoutError(f"Embedding generation timed out after {timeout:.1f} seconds")
     
     try:
-        return await retry_with_backoff(
-            _create_embeddings,
-            max_retries=API_MAX_RETRIES,
-            exceptions=(Exception,)
-        )
+        # Bound the pod's concurrent OpenAI calls (retries included); local models are not admitted
+        async with admit("embeddings") if use_openai else nullcontext():
+            computed = await retry_with_backoff(
+                _create_embeddings,
+                max_retries=API_MAX_RETRIES,
+                initial_delay=RETRY_INITIAL_DELAY,
+                max_delay=RETRY_MAX_DELAY,
+                deadline=deadline,
+                breaker=get_breaker("embeddings") if use_openai else None
+            )
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logger.error(f"Failed to generate embeddings after retries: {str(e)}")
         raise Exception(f"Error generating embeddings: {str(e)}")
+    
+    if computed.shape[1] != identity.dimension:
+        raise ValueError(
+            f"{identity.provider}/{identity.model} returned {computed.shape[1]}-dim embeddings, "
+            f"expected {identity.dimension}"
+        )
+    await embedding_cache.store(identity.provider, identity.model, missing_texts, computed)
+    
+    # Merge cache hits and fresh embeddings back in input order
+    row_of = {text: i for i, text in enumerate(missing_texts)}
+    result = np.empty((len(texts), computed.shape[1]), dtype=np.float32)
+    for i, (text, emb) in enumerate(zip(texts, cached)):
+        result[i] = emb if emb is not None else computed[row_of[text]]
+    return result
+
+
+async def iter_embeddings(
+    texts: List[str],
+    batch_size: Optional[int] = None
+) -> AsyncIterator[Tuple[int, np.ndarray]]:
+    """Embed texts in provider-sized sub-batches, yielding (start, embeddings) as each finishes
+
+    At most EMBEDDING_MAX_CONCURRENCY sub-batches are in flight at once. Batches
+    are yielded in completion order, so callers can persist early batches while
+    later ones are still embedding.
+    """
+    if not texts:
+        return
+    
+    model, use_openai = _get_embedding_model()
+    batch_size = batch_size or _get_batch_size(model, use_openai)
+    semaphore = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+    
+    async def _run(start: int) -> Tuple[int, np.ndarray]:
+        async with semaphore:
+            return start, await _embed_batch(texts[start:start + batch_size])
+    
+    tasks = [asyncio.ensure_future(_run(start)) for start in range(0, len(texts), batch_size)]
+    logger.debug(f"Embedding {len(texts)} texts in {len(tasks)} batches of up to {batch_size}")
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        # Stop outstanding batches if a batch failed or the consumer stopped early
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
+
+async def warm_up_embeddings() -> np.ndarray:
+    """Load the embedding model and run one uncached embedding through it"""
+    model, use_openai = _get_embedding_model()
+    texts = ["warm-up"]
+    if isinstance(model, EmbeddingWorkerPool):
+        result = await asyncio.wait_for(model.warm_up(), timeout=EMBEDDING_TIMEOUT)
+    else:
+        executor = None if use_openai else embedding_workers.get_local_executor()
+        loop = asyncio.get_event_loop()
+        result = await asyncio.wait_for(
+            loop.run_in_executor(executor, _embed_sync, model, use_openai, texts),
+            timeout=EMBEDDING_TIMEOUT
+        )
+    return result[0]
+
+
+async def get_embeddings(texts: List[str]) -> np.ndarray:
+    """Generate embeddings using OpenAI API or sentence-transformers
+    
+    Returns a contiguous (len(texts), dim) float32 matrix.
+    """
+    
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    
+    model, use_openai = _get_embedding_model()
+    if len(texts) <= _get_batch_size(model, use_openai):
+        return await _embed_batch(texts)
+    
+    results: Optional[np.ndarray] = None
+    async for start, embeddings in iter_embeddings(texts):
+        if results is None:
+            results = np.empty((len(texts), embeddings.shape[1]), dtype=np.float32)
+        results[start:start + len(embeddings)] = embeddings
+    return results
@@ -0,0 +1,46 @@
+"""Structured retrieval filters and their Chroma `where` translation
+
+Filters restrict retrieval to chunks whose metadata matches, e.g.
+{"doc_id": ["3f2a..."], "file_type": "application/pdf"}. Values may be a
+single string or a list (any of). Several fields must all match.
+"""
+from typing import Any, Dict, List, Optional, Union
+
+FILTERABLE_FIELDS = ("doc_id", "filename", "file_type")
+
+FilterValue = Union[str, List[str]]
+
+
+def normalize_filters(filters: Optional[Dict[str, FilterValue]]) -> Optional[Dict[str, List[str]]]:
+    """Canonical form (sorted field -> sorted list of values), None when nothing is filtered"""
+    if not filters:
+        return None
+    normalized = {}
+    for field, value in filters.items():
+        if field not in FILTERABLE_FIELDS:
+            raise ValueError(f"Cannot filter on {field!r}. Filterable fields: {', '.join(FILTERABLE_FIELDS)}")
+        if value is None:
+            continue
+        values = [value] if isinstance(value, str) else list(value)
+        if not values:
+            raise ValueError(f"Filter {field!r} needs at least one value")
+        normalized[field] = sorted(set(values))
+    return dict(sorted(normalized.items())) or None
+
+
+def to_where(filters: Optional[Dict[str, List[str]]]) -> Optional[Dict[str, Any]]:
+    """Chroma where clause for normalized filters, evaluated inside Chroma during the search"""
+    if not filters:
+        return None
+    clauses = [
+        {field: values[0]} if len(values) == 1 else {field: {"$in": values}}
+        for field, values in filters.items()
+    ]
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def matches(filters: Optional[Dict[str, List[str]]], fields: Dict[str, Any]) -> bool:
+    """Whether a record's metadata fields satisfy normalized filters"""
+    if not filters:
+        return True
+    return all(fields.get(field) in values for field, values in filters.items())
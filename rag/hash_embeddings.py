@@ -0,0 +1,72 @@
+"""Batched hash-based embeddings (lightweight fallback when no model is available)"""
+import hashlib
+from typing import Sequence
+
+import numpy as np
+
+HASH_EMBEDDING_DIM = 384  # same as all-MiniLM-L6-v2
+
+# Model names used in the embedding identity, so vectors from the two modes never mix
+HASH_MODEL_NAMES = {
+    "fast": "shake256-384",
+    "compat": "sha256-384",
+}
+
+
+def hash_embeddings(texts: Sequence[str], mode: str = "fast", dim: int = HASH_EMBEDDING_DIM) -> np.ndarray:
+    """Embed texts into an (n_texts x dim) float32 matrix
+
+    mode="fast" hashes each text once and stretches the digest with SHAKE-256
+    into the whole vector. mode="compat" reproduces the vectors of the original
+    per-dimension implementation, so collections built with it stay queryable.
+    """
+    if mode == "fast":
+        return _fast_embeddings(texts, dim)
+    if mode == "compat":
+        return _compat_embeddings(texts, dim)
+    raise ValueError(f"Unknown hash embedding mode: {mode}")
+
+
+def _fast_embeddings(texts: Sequence[str], dim: int) -> np.ndarray:
+    if not texts:
+        return np.zeros((0, dim), dtype=np.float32)
+
+    # One digest per text, expanded to dim * 4 bytes by the XOF
+    buffer = b"".join(
+        hashlib.shake_256(hashlib.sha256(text.encode("utf-8")).digest()).digest(dim * 4)
+        for text in texts
+    )
+    raw = np.frombuffer(buffer, dtype="<u4").reshape(len(texts), dim)
+
+    # Map the top 24 bits of each word onto [-1, 1): exact in float32, so the
+    # result can never contain NaN or inf
+    vectors = (raw >> 8).astype(np.float32) * np.float32(2.0 ** -23) - np.float32(1.0)
+
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    np.maximum(norms, np.float32(1e-12), out=norms)
+    vectors /= norms
+    return vectors
+
+
+def _compat_embeddings(texts: Sequence[str], dim: int) -> np.ndarray:
+    if not texts:
+        return np.zeros((0, dim), dtype=np.float32)
+
+    # The original vector is the 8 big-endian floats of sha256(text) followed by
+    # the first 4 bytes of sha256(text + str(i)) for i = 8..dim-1. Hashing the
+    # text once and copying the hash state for each suffix gives identical digests.
+    suffixes = [str(i).encode("utf-8") for i in range(8, dim)]
+    parts = []
+    for text in texts:
+        base = hashlib.sha256(text.encode("utf-8"))
+        parts.append(base.digest())
+        for suffix in suffixes:
+            padded = base.copy()
+            padded.update(suffix)
+            parts.append(padded.digest()[:4])
+    raw = np.frombuffer(b"".join(parts), dtype=">f4").reshape(len(texts), dim)
+
+    # Arbitrary bit patterns include NaN and +/-inf. The original clamp
+    # max(-1, min(1, v)) mapped NaN to 1.0 and infinities to +/-1.
+    vectors = np.where(np.isnan(raw), np.float32(1.0), raw)
+    return np.clip(vectors, -1.0, 1.0).astype(np.float32)
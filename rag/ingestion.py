@@ -0,0 +1,357 @@
+"""Background ingestion jobs: parse -> chunk -> embed -> store outside the request
+
+An upload is written to CHROMA_DB_PATH/uploads and recorded as a job in
+CHROMA_DB_PATH/ingestion_jobs.sqlite3; the request returns at once. A pool of
+INGESTION_WORKERS tasks runs the pipeline, saving per-stage progress after
+every stored batch. Jobs that were queued or running when the process stopped
+are picked up again by start(): whatever an interrupted run stored is removed
+and the document is ingested from its saved file (embeddings of chunks that
+were already embedded come from the embedding cache).
+
+Jobs failing on overload (admission rejected, circuit open) are requeued
+after the suggested Retry-After, up to INGESTION_MAX_ATTEMPTS tries; so are
+resumed jobs whose partial chunks could not be removed. Job writes and file
+deletes run in worker threads.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+import uuid
+from contextlib import aclosing
+from typing import Any, Dict, List, Optional, Set
+
+from config import (
+    DEFAULT_CHUNK_OVERLAP,
+    DEFAULT_CHUNK_SIZE,
+    INGESTION_JOB_TTL,
+    INGESTION_MAX_ATTEMPTS,
+    INGESTION_MAX_PENDING,
+    INGESTION_WORKERS,
+    RETRY_MAX_DELAY,
+)
+from lib import metrics
+from lib.admission import AdmissionRejected
+from lib.cache import SQLiteStore
+from rag.embeddings import iter_embeddings
+from rag.vector_store import remove_document, store_documents
+from services.chunker import chunk_spans
+from services.parser import parse_content
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("parse", "chunk", "embed", "store")
+FINISHED = ("succeeded", "failed")
+
+
+class JobStore(SQLiteStore):
+    """Jobs as JSON; unfinished jobs never expire, finished ones after INGESTION_JOB_TTL"""
+
+    def __init__(self, path: str):
+        super().__init__(path, table="jobs")
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        value = self.get(job_id)
+        return json.loads(value) if value is not None else None
+
+    def put_job(self, job: Dict[str, Any]) -> None:
+        ttl = INGESTION_JOB_TTL if job["status"] in FINISHED else None
+        self.set(job["job_id"], json.dumps(job).encode("utf-8"), ttl=ttl)
+
+    def unfinished(self) -> List[Dict[str, Any]]:
+        """Queued and running jobs, oldest first"""
+        with self._lock:
+            rows = self._conn.execute(f"SELECT value FROM {self.table} WHERE expires_at IS NULL").fetchall()
+        return sorted((json.loads(value) for (value,) in rows), key=lambda job: job["created_at"])
+
+
+_store: Optional[JobStore] = None
+_queue: Optional[asyncio.Queue] = None
+_workers: List[asyncio.Task] = []
+_pending: Set[str] = set()  # queued or running in this process
+_avg_duration = 10.0  # seconds per job, moving average
+
+
+def _data_dir() -> str:
+    return os.getenv("CHROMA_DB_PATH", "./chroma_db")
+
+
+def get_store() -> JobStore:
+    global _store
+    if _store is None:
+        _store = JobStore(os.path.join(_data_dir(), "ingestion_jobs.sqlite3"))
+    return _store
+
+
+def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    return get_store().get_job(job_id)
+
+
+def purge_expired() -> int:
+    """Drop finished jobs older than INGESTION_JOB_TTL"""
+    return get_store().purge_expired()
+
+
+def public_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Job as reported by the API (without server paths)"""
+    return {key: value for key, value in job.items() if key != "path"}
+
+
+def _new_stages() -> Dict[str, Dict[str, Any]]:
+    return {stage: {"status": "pending"} for stage in STAGES}
+
+
+def _progress(job: Dict[str, Any]) -> float:
+    """Overall completion in [0, 1]; embed and store count per chunk"""
+    done = 0.0
+    for stage in job["stages"].values():
+        if stage["status"] == "done":
+            done += 1
+        elif stage.get("total"):
+            done += stage.get("done", 0) / stage["total"]
+    return round(done / len(STAGES), 3)
+
+
+async def _save(job: Dict[str, Any]) -> None:
+    job["progress"] = 1.0 if job["status"] == "succeeded" else _progress(job)
+    job["updated_at"] = time.time()
+    await asyncio.to_thread(get_store().put_job, job)
+
+
+def _export() -> None:
+    metrics.set_gauge("ingestion.pending", len(_pending))
+    if _queue is not None:
+        metrics.set_gauge("ingestion.queue_depth", _queue.qsize())
+
+
+def _enqueue(job_id: str) -> None:
+    if _queue is not None:
+        _queue.put_nowait(job_id)
+    _export()
+
+
+def retry_after() -> int:
+    """Seconds until a worker would likely be free for a new job"""
+    return max(1, math.ceil(_avg_duration * len(_pending) / max(1, INGESTION_WORKERS)))
+
+
+def _write_file(path: str, content: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _delete_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def submit(filename: str, content_type: Optional[str], content: bytes) -> Dict[str, Any]:
+    """Save an upload and queue its ingestion; raises AdmissionRejected when too many jobs are pending"""
+    if len(_pending) >= INGESTION_MAX_PENDING:
+        metrics.increment("ingestion.rejected")
+        raise AdmissionRejected("ingestion", "queue_full", retry_after())
+
+    job_id = str(uuid.uuid4())
+    path = os.path.join(_data_dir(), "uploads", job_id + os.path.splitext(filename)[1].lower())
+    await asyncio.to_thread(_write_file, path, content)
+    now = time.time()
+    job = {
+        "job_id": job_id,
+        "doc_id": str(uuid.uuid4()),
+        "filename": filename,
+        "content_type": content_type,
+        "size": len(content),
+        "path": path,
+        "status": "queued",
+        "stage": None,
+        "stages": _new_stages(),
+        "attempts": 0,
+        "chunks": None,
+        "error": None,
+        "created_at": now,
+    }
+    await _save(job)
+    _pending.add(job_id)
+    _enqueue(job_id)
+    metrics.increment("ingestion.jobs_submitted")
+    logger.info(f"[INGESTION] Queued job {job_id} for {filename} ({len(content)} bytes)")
+    return job
+
+
+async def _start_stage(job: Dict[str, Any], stage: str, **fields: Any) -> None:
+    job["stage"] = stage
+    job["stages"][stage] = {"status": "running", **fields}
+    await _save(job)
+
+
+async def _finish_stage(job: Dict[str, Any], stage: str, **fields: Any) -> None:
+    job["stages"][stage].update(status="done", **fields)
+    await _save(job)
+
+
+async def _run_pipeline(job: Dict[str, Any]) -> None:
+    await _start_stage(job, "parse")
+    content = await asyncio.to_thread(_read_file, job["path"])
+    text = await asyncio.to_thread(parse_content, job["filename"], content)
+    if not text or not text.strip():
+        raise ValueError("Document appears to be empty or could not be parsed")
+    await _finish_stage(job, "parse", characters=len(text))
+
+    await _start_stage(job, "chunk")
+    spans = await asyncio.to_thread(chunk_spans, text, chunk_size=DEFAULT_CHUNK_SIZE, overlap=DEFAULT_CHUNK_OVERLAP)
+    chunks = [text[start:end] for start, end in spans]
+    if not chunks:
+        raise ValueError("No chunks generated from document")
+    job["chunks"] = len(chunks)
+    await _finish_stage(job, "chunk", chunks=len(chunks))
+
+    # Embedding and storing overlap: each batch is stored as soon as it is embedded
+    job["stages"]["store"] = {"status": "running", "done": 0, "total": len(chunks)}
+    await _start_stage(job, "embed", done=0, total=len(chunks))
+    async with aclosing(iter_embeddings(chunks)) as batches:
+        async for start, embeddings in batches:
+            job["stages"]["embed"]["done"] += len(embeddings)
+            job["stage"] = "store"
+            await store_documents(
+                doc_id=job["doc_id"],
+                chunks=chunks[start:start + len(embeddings)],
+                embeddings=embeddings,
+                metadata={"filename": job["filename"], "file_type": job["content_type"]},
+                start_index=start,
+                chunk_metadatas=[
+                    {"char_start": char_start, "char_end": char_end}
+                    for char_start, char_end in spans[start:start + len(embeddings)]
+                ]
+            )
+            job["stages"]["store"]["done"] += len(embeddings)
+            job["stage"] = "embed"
+            await _save(job)
+    job["stages"]["embed"]["status"] = "done"
+    await _finish_stage(job, "store")
+
+
+async def _remove_partial(job: Dict[str, Any]) -> None:
+    """Remove chunks a failed run stored, so a failed or retried job leaves no half document"""
+    if not job["stages"]["store"].get("done"):
+        return
+    try:
+        await remove_document(job["doc_id"])
+    except Exception as e:
+        logger.error(f"[INGESTION] Could not remove partial document {job['doc_id']}: {e}")
+
+
+async def _finish(job: Dict[str, Any], status: str, error: Optional[str] = None) -> None:
+    job["status"] = status
+    job["error"] = error
+    await _save(job)
+    await asyncio.to_thread(_delete_file, job["path"])
+    _pending.discard(job["job_id"])
+    _export()
+    metrics.increment(f"ingestion.jobs_{status}")
+
+
+async def process_job(job_id: str) -> Optional[Dict[str, Any]]:
+    """Run (or resume) a job's pipeline; returns the job in its final or requeued state"""
+    global _avg_duration
+    job = await asyncio.to_thread(get_job, job_id)
+    if job is None or job["status"] in FINISHED:
+        _pending.discard(job_id)
+        return job
+
+    if job["status"] == "running":
+        # Interrupted by a restart: the last batches stored may not be recorded, so start the document over
+        logger.info(f"[INGESTION] Resuming job {job_id}, removing partially stored chunks")
+        try:
+            await remove_document(job["doc_id"])
+        except Exception as e:
+            # Stays "running" so the next try removes the chunks again
+            logger.error(f"[INGESTION] Could not remove partial document of job {job_id}: {e}")
+            job.update(attempts=job["attempts"] + 1, error=str(e))
+            if job["attempts"] < INGESTION_MAX_ATTEMPTS:
+                await _save(job)
+                asyncio.get_running_loop().call_later(RETRY_MAX_DELAY, _enqueue, job_id)
+            else:
+                await _finish(job, "failed", str(e))
+            return job
+    job.update(status="running", attempts=job["attempts"] + 1, error=None, stages=_new_stages())
+    await _save(job)
+    _pending.add(job_id)
+    _export()
+
+    started = time.monotonic()
+    try:
+        await _run_pipeline(job)
+    except AdmissionRejected as e:
+        await _remove_partial(job)
+        if job["attempts"] < INGESTION_MAX_ATTEMPTS:
+            job.update(status="queued", error=str(e), stage=None)
+            job["stages"] = _new_stages()
+            await _save(job)
+            logger.warning(f"[INGESTION] Job {job_id} deferred {e.retry_after}s: {e}")
+            asyncio.get_running_loop().call_later(e.retry_after, _enqueue, job_id)
+            return job
+        await _finish(job, "failed", str(e))
+        return job
+    except Exception as e:
+        logger.error(f"[INGESTION] Job {job_id} failed in stage {job['stage']}: {e}", exc_info=True)
+        await _remove_partial(job)
+        await _finish(job, "failed", str(e))
+        return job
+
+    duration = time.monotonic() - started
+    _avg_duration = 0.9 * _avg_duration + 0.1 * duration
+    metrics.observe("ingestion.duration_ms", duration * 1000)
+    job["stage"] = None
+    await _finish(job, "succeeded")
+    logger.info(f"[INGESTION] Job {job_id} stored {job['chunks']} chunks in {duration:.1f}s")
+    return job
+
+
+async def _worker(index: int) -> None:
+    while True:
+        job_id = await _queue.get()
+        try:
+            await process_job(job_id)
+        except Exception as e:
+            logger.error(f"[INGESTION] Worker {index} could not process job {job_id}: {e}", exc_info=True)
+        finally:
+            _queue.task_done()
+            _export()
+
+
+async def start() -> int:
+    """Start the worker pool and requeue unfinished jobs; returns how many were resumed"""
+    global _queue
+    if _workers:
+        return 0
+    _queue = asyncio.Queue()
+    _workers.extend(asyncio.create_task(_worker(i)) for i in range(max(1, INGESTION_WORKERS)))
+    resumed = await asyncio.to_thread(get_store().unfinished)
+    for job in resumed:
+        _pending.add(job["job_id"])
+        _queue.put_nowait(job["job_id"])
+    _export()
+    if resumed:
+        logger.info(f"[INGESTION] Resuming {len(resumed)} unfinished jobs")
+    return len(resumed)
+
+
+async def stop() -> None:
+    """Stop the workers; running jobs stay "running" and are resumed by the next start()"""
+    global _queue
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    _pending.clear()
+    _queue = None
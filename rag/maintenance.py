@@ -0,0 +1,63 @@
+"""Periodic purge of the on-disk stores
+
+SQLite rows carry an expiry but are only skipped, not deleted, when read. A
+background task calls each store's purge_expired() every STORE_PURGE_INTERVAL
+seconds (and once at startup) in a worker thread, so expired embeddings,
+answers, conversations and finished jobs do not pile up on disk.
+"""
+import asyncio
+import logging
+from typing import Callable, Dict, Optional
+
+from config import STORE_PURGE_INTERVAL
+from lib import metrics
+
+logger = logging.getLogger(__name__)
+
+_task: Optional[asyncio.Task] = None
+
+
+def _purgers() -> Dict[str, Callable[[], int]]:
+    from rag import answer_cache, conversations, embedding_cache, ingestion
+    return {
+        "embedding_cache": embedding_cache.purge_expired,
+        "answer_cache": answer_cache.purge_expired,
+        "conversations": conversations.purge_expired,
+        "ingestion_jobs": ingestion.purge_expired,
+    }
+
+
+def purge_once() -> Dict[str, int]:
+    """Purge every store; returns rows removed per store"""
+    removed: Dict[str, int] = {}
+    for name, purge in _purgers().items():
+        try:
+            removed[name] = purge()
+        except Exception as e:
+            logger.warning(f"[PURGE] {name} purge failed: {e}")
+            continue
+        if removed[name]:
+            metrics.increment(f"purge.{name}.removed", removed[name])
+            logger.info(f"[PURGE] Removed {removed[name]} rows from {name}")
+    return removed
+
+
+async def _run() -> None:
+    while True:
+        await asyncio.to_thread(purge_once)
+        await asyncio.sleep(STORE_PURGE_INTERVAL)
+
+
+def start() -> None:
+    """Start the purge task (no-op when already running or STORE_PURGE_INTERVAL <= 0)"""
+    global _task
+    if _task is None and STORE_PURGE_INTERVAL > 0:
+        _task = asyncio.create_task(_run())
+
+
+async def stop() -> None:
+    global _task
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
@@ -0,0 +1,101 @@
+"""Re-embed an existing collection into another provider's collection
+
+Usage:
+    python -m rag.migrate --provider sentence-transformers
+    python -m rag.migrate --source documents --provider openai --batch-size 64 --delay 1.0
+
+Chunks are read from the source collection page by page, re-embedded with
+the target provider and upserted with the same ids, texts and metadata into
+the target provider's collection. Chunks already present in the target are
+skipped, so an interrupted migration can simply be re-run.
+"""
+import argparse
+import asyncio
+import logging
+import time
+from typing import Any, Dict
+
+from dotenv import load_dotenv
+
+# Load .env before the rag modules read their configuration
+load_dotenv()
+
+from rag import embeddings
+from rag.bm25 import ensure_index, get_bm25_index
+from rag.chroma_client import LEGACY_COLLECTION_NAME, get_chroma_collection, open_collection
+
+logger = logging.getLogger(__name__)
+
+
+async def migrate_collection(
+    source_name: str,
+    provider: str,
+    batch_size: int = 64,
+    delay: float = 0.5
+) -> Dict[str, Any]:
+    """Copy every chunk of source_name into the provider's collection with fresh embeddings"""
+    identity = embeddings.set_embedding_provider(provider)
+    source = open_collection(source_name)
+    target = get_chroma_collection()
+    if source.name == target.name:
+        raise ValueError(f"Source and target are the same collection: {source.name}")
+    # Bring the target's lexical index up to date before adding to it
+    ensure_index(target)
+
+    total = source.count()
+    logger.info(f"[MIGRATE] {source.name} ({total} chunks) -> {target.name} ({identity.provider}/{identity.model})")
+
+    migrated = skipped = 0
+    started = time.perf_counter()
+    for offset in range(0, total, batch_size):
+        page = source.get(limit=batch_size, offset=offset, include=["documents", "metadatas"])
+        ids = page["ids"]
+        if not ids:
+            break
+
+        existing = set(target.get(ids=ids, include=[])["ids"])
+        todo = [i for i, chunk_id in enumerate(ids) if chunk_id not in existing]
+        skipped += len(ids) - len(todo)
+        if todo:
+            texts = [page["documents"][i] for i in todo]
+            vectors = await embeddings.get_embeddings(texts)
+            await asyncio.to_thread(
+                target.upsert,
+                ids=[ids[i] for i in todo],
+                documents=texts,
+                embeddings=vectors,
+                metadatas=[page["metadatas"][i] for i in todo]
+            )
+            get_bm25_index(target.name).add_records(
+                [ids[i] for i in todo], texts, [page["metadatas"][i] for i in todo]
+            )
+            migrated += len(todo)
+            # Throttle so a migration doesn't starve live traffic or hit provider rate limits
+            await asyncio.sleep(delay)
+
+        logger.info(f"[MIGRATE] {min(offset + len(ids), total)}/{total} chunks processed")
+
+    return {
+        "source": source.name,
+        "target": target.name,
+        "migrated": migrated,
+        "skipped": skipped,
+        "seconds": round(time.perf_counter() - started, 1)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Re-embed a collection into another embedding provider's collection")
+    parser.add_argument("--source", default=LEGACY_COLLECTION_NAME, help="Source collection name")
+    parser.add_argument("--provider", required=True, help="Target provider (openai, sentence-transformers, hash)")
+    parser.add_argument("--batch-size", type=int, default=64, help="Chunks per embedding call")
+    parser.add_argument("--delay", type=float, default=0.5, help="Seconds to sleep between batches")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    result = asyncio.run(migrate_collection(args.source, args.provider, args.batch_size, args.delay))
+    logger.info(f"[MIGRATE] Done: {result}")
+
+
+if __name__ == "__main__":
+    main()
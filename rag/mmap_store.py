@@ -0,0 +1,503 @@
+"""Memory-mapped exact-search vector store (VECTOR_BACKEND=mmap)
+
+A drop-in alternative to a Chroma collection for small and mid-sized corpora.
+It exposes the subset of the collection API the service uses: add, upsert,
+get, query, delete and count. Search is exact: one blocked matrix product of
+the normalized query against all stored vectors, then argpartition for top-k.
+There is no HNSW graph and no SQLite round-trip.
+
+Layout under CHROMA_DB_PATH/mmap/<collection>/:
+    manifest.json      name, dimension, storage dtype, collection metadata, generation
+    gen_<k>/vectors.bin    append-only rows of normalized vectors (EMBEDDING_STORAGE_DTYPE)
+    gen_<k>/scales.bin     per-row float32 scales (int8 storage only)
+    gen_<k>/texts.bin      append-only UTF-8 chunk texts
+    gen_<k>/records.jsonl  one line per row: id, metadata, text offset/length
+    gen_<k>/tombstones.bin int64 rows deleted since the last compaction
+
+records.jsonl is written last and is the commit point: on load, rows beyond
+its last line are truncated away. Deletes only append tombstones; once they
+exceed MMAP_COMPACTION_RATIO of the rows a background thread writes a new
+generation without them and switches the manifest to it atomically.
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from config import EMBEDDING_STORAGE_DTYPE, MMAP_COMPACTION_RATIO, MMAP_SEARCH_BLOCK_ROWS
+from rag.filters import FILTERABLE_FIELDS
+from rag.quantization import decode_vectors, encode_vectors
+
+logger = logging.getLogger(__name__)
+
+_GET_INCLUDE = ("metadatas", "documents")
+_QUERY_INCLUDE = ("metadatas", "documents", "distances")
+
+
+class _Rows:
+    """Row data of one generation; replaced wholesale on compaction"""
+
+    def __init__(self):
+        self.vectors: Optional[np.ndarray] = None  # (n, dim) memmap
+        self.scales: Optional[np.ndarray] = None   # (n,) memmap, int8 storage only
+        self.texts: Optional[np.ndarray] = None    # uint8 memmap of texts.bin
+        self.alive = np.zeros(0, dtype=bool)
+        self.ids: List[str] = []
+        self.metadatas: List[Dict[str, Any]] = []
+        self.text_spans: List[tuple] = []  # (offset, length) into texts.bin
+        self.row_of: Dict[str, int] = {}
+        # field -> value -> rows, for fast where clauses on the filterable fields
+        self.field_rows: Dict[str, Dict[Any, List[int]]] = {field: {} for field in FILTERABLE_FIELDS}
+        self.text_bytes = 0
+        self.deleted = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+
+def _intern(metadata: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    # Filenames, types and doc ids repeat on every chunk of a document
+    return {key: sys.intern(value) if isinstance(value, str) else value for key, value in (metadata or {}).items()}
+
+
+class MmapCollection:
+    """Exact-search collection backed by memory-mapped append-only files"""
+
+    def __init__(self, directory: str, name: str, metadata: Optional[Dict[str, Any]] = None):
+        self.directory = directory
+        self.name = name
+        self._lock = threading.RLock()
+        self._compacting = False
+        os.makedirs(directory, exist_ok=True)
+        manifest_path = os.path.join(directory, "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                self._manifest = json.load(f)
+        else:
+            self._manifest = {
+                "name": name,
+                "dimension": None,
+                "dtype": EMBEDDING_STORAGE_DTYPE,
+                "metadata": metadata or {},
+                "generation": 0
+            }
+            self._write_manifest()
+        self.metadata = self._manifest["metadata"]
+        self._rows = self._load(self._manifest["generation"])
+
+    # -- files ---------------------------------------------------------------
+
+    @property
+    def _dtype(self) -> np.dtype:
+        return np.dtype(np.int8 if self._manifest["dtype"] == "int8" else self._manifest["dtype"])
+
+    def _path(self, generation: int, filename: str) -> str:
+        return os.path.join(self.directory, f"gen_{generation}", filename)
+
+    def _write_manifest(self) -> None:
+        path = os.path.join(self.directory, "manifest.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f)
+        os.replace(path + ".tmp", path)
+
+    def _map(self, rows: _Rows, generation: int) -> None:
+        """(Re)map the vector, scale and text files to the committed row count"""
+        n, dim = len(rows), self._manifest["dimension"]
+        if n == 0 or dim is None:
+            rows.vectors = rows.scales = rows.texts = None
+            return
+        # Vectors are swapped in last: a reader that sees n vector rows also sees
+        # scales, texts and alive flags covering at least n rows
+        if self._manifest["dtype"] == "int8":
+            rows.scales = np.memmap(self._path(generation, "scales.bin"), dtype=np.float32, mode="r", shape=(n,))
+        rows.texts = (
+            np.memmap(self._path(generation, "texts.bin"), dtype=np.uint8, mode="r", shape=(rows.text_bytes,))
+            if rows.text_bytes else None
+        )
+        rows.vectors = np.memmap(self._path(generation, "vectors.bin"), dtype=self._dtype, mode="r", shape=(n, dim))
+
+    def _load(self, generation: int) -> _Rows:
+        os.makedirs(os.path.join(self.directory, f"gen_{generation}"), exist_ok=True)
+        rows = _Rows()
+        records_path = self._path(generation, "records.jsonl")
+        if os.path.exists(records_path):
+            with open(records_path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break  # torn final line of an interrupted write
+                    record = json.loads(line)
+                    self._append_row(rows, record["id"], record["meta"], (record["off"], record["len"]))
+        rows.alive = np.ones(len(rows), dtype=bool)
+        tombstones_path = self._path(generation, "tombstones.bin")
+        if os.path.exists(tombstones_path):
+            dead = np.fromfile(tombstones_path, dtype=np.int64)
+            dead = dead[dead < len(rows)]
+            rows.alive[dead] = False
+            rows.deleted = int((~rows.alive).sum())
+            for row in dead.tolist():
+                # An upserted id has a newer live row; only unmap the id if it points here
+                if rows.row_of.get(rows.ids[row]) == row:
+                    del rows.row_of[rows.ids[row]]
+
+        # Drop bytes written after the last committed record
+        dim = self._manifest["dimension"]
+        if dim is not None:
+            self._truncate(self._path(generation, "vectors.bin"), len(rows) * dim * self._dtype.itemsize)
+            if self._manifest["dtype"] == "int8":
+                self._truncate(self._path(generation, "scales.bin"), len(rows) * 4)
+        self._truncate(self._path(generation, "texts.bin"), rows.text_bytes)
+        self._map(rows, generation)
+        if len(rows):
+            logger.info(f"[MMAP] Loaded {self.name}: {len(rows) - rows.deleted} rows ({rows.deleted} deleted)")
+        return rows
+
+    @staticmethod
+    def _truncate(path: str, size: int) -> None:
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    @staticmethod
+    def _append_row(rows: _Rows, chunk_id: str, metadata: Dict[str, Any], text_span: tuple) -> int:
+        row = len(rows.ids)
+        metadata = _intern(metadata)
+        rows.ids.append(sys.intern(chunk_id))
+        rows.metadatas.append(metadata)
+        rows.text_spans.append(text_span)
+        rows.text_bytes = max(rows.text_bytes, text_span[0] + text_span[1])
+        rows.row_of[chunk_id] = row
+        for field, index in rows.field_rows.items():
+            if field in metadata:
+                index.setdefault(metadata[field], []).append(row)
+        return row
+
+    # -- writes --------------------------------------------------------------
+
+    def _normalized(self, embeddings) -> np.ndarray:
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2:
+            raise ValueError("Embeddings must be a 2-D array")
+        dim = self._manifest["dimension"]
+        if dim is not None and matrix.shape[1] != dim:
+            raise ValueError(f"Embedding dimension {matrix.shape[1]} does not match collection dimensionality {dim}")
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1.0, norms)
+
+    def _write_rows(self, ids: List[str], documents: List[str], matrix: np.ndarray, metadatas: List[Dict[str, Any]]) -> None:
+        rows = self._rows
+        generation = self._manifest["generation"]
+        if self._manifest["dimension"] is None:
+            self._manifest["dimension"] = int(matrix.shape[1])
+            self._write_manifest()
+
+        data, scales = encode_vectors(matrix, self._manifest["dtype"])
+        with open(self._path(generation, "vectors.bin"), "ab") as f:
+            f.write(np.ascontiguousarray(data).tobytes())
+        if scales is not None:
+            with open(self._path(generation, "scales.bin"), "ab") as f:
+                f.write(scales.tobytes())
+        encoded = [(document or "").encode("utf-8") for document in documents]
+        with open(self._path(generation, "texts.bin"), "ab") as f:
+            f.write(b"".join(encoded))
+
+        offset = rows.text_bytes
+        records = []
+        for chunk_id, text, metadata in zip(ids, encoded, metadatas):
+            records.append({"id": chunk_id, "meta": metadata or {}, "off": offset, "len": len(text)})
+            offset += len(text)
+        with open(self._path(generation, "records.jsonl"), "a", encoding="utf-8") as f:
+            f.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in records))
+
+        for record in records:
+            self._append_row(rows, record["id"], record["meta"], (record["off"], record["len"]))
+        rows.alive = np.concatenate([rows.alive, np.ones(len(records), dtype=bool)])
+        self._map(rows, generation)
+
+    def add(
+        self,
+        ids: Sequence[str],
+        embeddings,
+        documents: Optional[Sequence[str]] = None,
+        metadatas: Optional[Sequence[Dict[str, Any]]] = None
+    ) -> None:
+        """Append rows; ids that already exist are ignored (as Chroma does)"""
+        ids = list(ids)
+        documents = list(documents) if documents is not None else [""] * len(ids)
+        metadatas = list(metadatas) if metadatas is not None else [{}] * len(ids)
+        matrix = self._normalized(embeddings)
+        if not len(ids) == len(documents) == len(metadatas) == len(matrix):
+            raise ValueError("ids, embeddings, documents and metadatas must have the same length")
+        with self._lock:
+            keep = [i for i, chunk_id in enumerate(ids) if chunk_id not in self._rows.row_of]
+            if len(keep) < len(ids):
+                logger.warning(f"[MMAP] Ignoring {len(ids) - len(keep)} existing ids in add to {self.name}")
+            if keep:
+                self._write_rows(
+                    [ids[i] for i in keep], [documents[i] for i in keep], matrix[keep], [metadatas[i] for i in keep]
+                )
+
+    def upsert(
+        self,
+        ids: Sequence[str],
+        embeddings,
+        documents: Optional[Sequence[str]] = None,
+        metadatas: Optional[Sequence[Dict[str, Any]]] = None
+    ) -> None:
+        """Replace existing ids (tombstone + append) and add new ones"""
+        with self._lock:
+            self._tombstone([self._rows.row_of[chunk_id] for chunk_id in ids if chunk_id in self._rows.row_of])
+            self.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def _tombstone(self, dead_rows: List[int]) -> None:
+        rows = self._rows
+        dead_rows = [row for row in dead_rows if rows.alive[row]]
+        if not dead_rows:
+            return
+        with open(self._path(self._manifest["generation"], "tombstones.bin"), "ab") as f:
+            f.write(np.asarray(dead_rows, dtype=np.int64).tobytes())
+        rows.alive[dead_rows] = False
+        rows.deleted += len(dead_rows)
+        for row in dead_rows:
+            if rows.row_of.get(rows.ids[row]) == row:
+                del rows.row_of[rows.ids[row]]
+
+    def delete(self, ids: Optional[Sequence[str]] = None, where: Optional[Dict[str, Any]] = None) -> None:
+        """Tombstone rows by id and/or where clause; compaction runs in the background"""
+        with self._lock:
+            rows = self._rows
+            mask = rows.alive.copy()
+            if where:
+                mask &= self._where_mask(rows, where, len(rows))
+            if ids is not None:
+                selected = np.zeros(len(rows), dtype=bool)
+                selected[[rows.row_of[chunk_id] for chunk_id in ids if chunk_id in rows.row_of]] = True
+                mask &= selected
+            elif not where:
+                raise ValueError("delete() needs ids or a where clause")
+            self._tombstone(np.flatnonzero(mask).tolist())
+            if len(rows) and rows.deleted / len(rows) > MMAP_COMPACTION_RATIO and not self._compacting:
+                self._compacting = True
+                threading.Thread(target=self._compact_in_background, name=f"compact-{self.name}", daemon=True).start()
+
+    # -- compaction ----------------------------------------------------------
+
+    def _compact_in_background(self) -> None:
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error(f"[MMAP] Compaction of {self.name} failed: {e}", exc_info=True)
+        finally:
+            self._compacting = False
+
+    def compact(self) -> None:
+        """Rewrite live rows into a new generation and switch to it
+
+        Writers wait for the rewrite; queries keep reading the previous
+        generation's mappings until the switch.
+        """
+        with self._lock:
+            rows = self._rows
+            if rows.deleted == 0:
+                return
+            old_generation = self._manifest["generation"]
+            new_generation = old_generation + 1
+            new_dir = os.path.join(self.directory, f"gen_{new_generation}")
+            shutil.rmtree(new_dir, ignore_errors=True)
+            os.makedirs(new_dir)
+
+            live = np.flatnonzero(rows.alive)
+            block = MMAP_SEARCH_BLOCK_ROWS
+            with open(os.path.join(new_dir, "vectors.bin"), "wb") as f:
+                for start in range(0, len(live), block):
+                    f.write(np.ascontiguousarray(rows.vectors[live[start:start + block]]).tobytes())
+            if rows.scales is not None:
+                with open(os.path.join(new_dir, "scales.bin"), "wb") as f:
+                    f.write(np.ascontiguousarray(rows.scales[live]).tobytes())
+            offset = 0
+            with open(os.path.join(new_dir, "texts.bin"), "wb") as texts, \
+                    open(os.path.join(new_dir, "records.jsonl"), "w", encoding="utf-8") as records:
+                for row in live:
+                    text = self._text(rows, row).encode("utf-8")
+                    texts.write(text)
+                    record = {"id": rows.ids[row], "meta": rows.metadatas[row], "off": offset, "len": len(text)}
+                    records.write(json.dumps(record, separators=(",", ":")) + "\n")
+                    offset += len(text)
+
+            self._manifest["generation"] = new_generation
+            self._write_manifest()
+            self._rows = self._load(new_generation)
+            shutil.rmtree(os.path.join(self.directory, f"gen_{old_generation}"), ignore_errors=True)
+            logger.info(f"[MMAP] Compacted {self.name}: {len(live)} rows kept, {rows.deleted} removed")
+
+    # -- reads ---------------------------------------------------------------
+
+    @staticmethod
+    def _text(rows: _Rows, row: int) -> str:
+        offset, length = rows.text_spans[row]
+        if length == 0 or rows.texts is None:
+            return ""
+        return bytes(rows.texts[offset:offset + length]).decode("utf-8")
+
+    @staticmethod
+    def _visible(rows: _Rows) -> int:
+        """Rows a reader may use: those covered by the current vector mapping"""
+        vectors = rows.vectors
+        return 0 if vectors is None else len(vectors)
+
+    def _where_mask(self, rows: _Rows, where: Dict[str, Any], n: int) -> np.ndarray:
+        """First n rows' match of a Chroma-style where clause ($and, $or, $eq, $ne, $in, $nin)"""
+        mask = np.ones(n, dtype=bool)
+        for key, condition in where.items():
+            if key in ("$and", "$or"):
+                masks = [self._where_mask(rows, clause, n) for clause in condition]
+                combined = np.logical_and.reduce(masks) if key == "$and" else np.logical_or.reduce(masks)
+                mask &= combined
+                continue
+            op, value = next(iter(condition.items())) if isinstance(condition, dict) else ("$eq", condition)
+            if op not in ("$eq", "$ne", "$in", "$nin"):
+                raise ValueError(f"Unsupported where operator: {op}")
+            values = value if op in ("$in", "$nin") else [value]
+            matched = np.zeros(n, dtype=bool)
+            index = rows.field_rows.get(key)
+            if index is not None:
+                for v in values:
+                    found = np.asarray(index.get(v, []), dtype=np.int64)
+                    matched[found[found < n]] = True
+            else:
+                wanted = set(values)
+                matched[:] = [metadata.get(key) in wanted for metadata in rows.metadatas[:n]]
+            mask &= ~matched if op in ("$ne", "$nin") else matched
+        return mask
+
+    def count(self) -> int:
+        rows = self._rows
+        return len(rows) - rows.deleted
+
+    def _vectors(self, rows: _Rows, selected) -> np.ndarray:
+        data = rows.vectors[selected]
+        return decode_vectors(data, rows.scales[selected] if rows.scales is not None else None)
+
+    def get(
+        self,
+        ids: Optional[Sequence[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        limit: Optional[int] = None,
+        offset: Optional[int] = None,
+        include: Sequence[str] = _GET_INCLUDE
+    ) -> Dict[str, Any]:
+        rows = self._rows
+        n = self._visible(rows)
+        if ids is not None:
+            selected = [rows.row_of[chunk_id] for chunk_id in ids if rows.row_of.get(chunk_id, n) < n]
+            if where:
+                mask = self._where_mask(rows, where, n)
+                selected = [row for row in selected if mask[row]]
+        else:
+            mask = rows.alive[:n].copy()
+            if where:
+                mask &= self._where_mask(rows, where, n)
+            selected = np.flatnonzero(mask).tolist()
+        start = offset or 0
+        selected = selected[start:start + limit] if limit is not None else selected[start:]
+        return {
+            "ids": [rows.ids[row] for row in selected],
+            "documents": [self._text(rows, row) for row in selected] if "documents" in include else None,
+            "metadatas": [rows.metadatas[row] for row in selected] if "metadatas" in include else None,
+            "embeddings": (
+                self._vectors(rows, selected) if selected else np.empty((0, self._manifest["dimension"] or 0), np.float32)
+            ) if "embeddings" in include else None
+        }
+
+    @staticmethod
+    def _top_k(vectors: np.ndarray, scales: Optional[np.ndarray], queries: np.ndarray, k: int, valid: np.ndarray):
+        """Exact top-k rows per query: blocked matmul, argpartition per block, merge"""
+        m = len(queries)
+        best_scores = np.empty((m, 0), dtype=np.float32)
+        best_rows = np.empty((m, 0), dtype=np.int64)
+        block_rows = MMAP_SEARCH_BLOCK_ROWS
+        for start in range(0, len(vectors), block_rows):
+            end = min(start + block_rows, len(vectors))
+            block_valid = valid[start:end]
+            if not block_valid.any():
+                continue
+            block = vectors[start:end]
+            if scales is not None:
+                block = decode_vectors(block, scales[start:end])
+            elif block.dtype != np.float32:
+                block = block.astype(np.float32)
+            scores = queries @ block.T
+            scores[:, ~block_valid] = -np.inf
+            kk = min(k, end - start)
+            top = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+            best_rows = np.concatenate([best_rows, top + start], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def query(
+        self,
+        query_embeddings,
+        n_results: int = 10,
+        where: Optional[Dict[str, Any]] = None,
+        include: Sequence[str] = _QUERY_INCLUDE
+    ) -> Dict[str, Any]:
+        """Exact cosine nearest neighbours; distances are 1 - cosine similarity like Chroma's"""
+        rows = self._rows
+        vectors = rows.vectors
+        n = 0 if vectors is None else len(vectors)
+        scales = rows.scales
+        queries = self._normalized(query_embeddings) if n else np.atleast_2d(np.asarray(query_embeddings, np.float32))
+        result = {key: [] for key in ("ids", "documents", "metadatas", "distances", "embeddings")}
+        valid = rows.alive[:n].copy()
+        if where and n:
+            valid &= self._where_mask(rows, where, n)
+        hits = (np.empty((len(queries), 0)), np.empty((len(queries), 0), dtype=np.int64))
+        if n and n_results > 0 and valid.any():
+            hits = self._top_k(vectors, scales, queries, n_results, valid)
+        for scores, found in zip(*hits):
+            selected = [int(row) for score, row in zip(scores, found) if score != -np.inf]
+            result["ids"].append([rows.ids[row] for row in selected])
+            result["documents"].append([self._text(rows, row) for row in selected])
+            result["metadatas"].append([rows.metadatas[row] for row in selected])
+            result["distances"].append([float(1.0 - score) for score in scores[:len(selected)]])
+            result["embeddings"].append(
+                self._vectors(rows, selected) if selected else np.empty((0, queries.shape[1]), np.float32)
+            )
+        for key in ("documents", "metadatas", "distances", "embeddings"):
+            if key not in include:
+                result[key] = None
+        return result
+
+
+_collections: Dict[str, MmapCollection] = {}
+_collections_lock = threading.Lock()
+
+
+def _collection_dir(name: str) -> str:
+    return os.path.join(os.getenv("CHROMA_DB_PATH", "./chroma_db"), "mmap", name)
+
+
+def get_mmap_collection(name: str, metadata: Optional[Dict[str, Any]] = None) -> MmapCollection:
+    """Get or create a memory-mapped collection (one instance per name)"""
+    with _collections_lock:
+        collection = _collections.get(name)
+        if collection is None:
+            collection = MmapCollection(_collection_dir(name), name, metadata)
+            _collections[name] = collection
+        return collection
+
+
+def open_mmap_collection(name: str) -> MmapCollection:
+    """An existing memory-mapped collection; raises ValueError if there is none"""
+    if name not in _collections and not os.path.exists(os.path.join(_collection_dir(name), "manifest.json")):
+        raise ValueError(f"Collection {name} does not exist.")
+    return get_mmap_collection(name)
@@ -0,0 +1,112 @@
+"""Embedding provider registry
+
+Every provider has an explicit identity (provider, model, dimension). The
+identity keys the embedding cache and names the Chroma collection, so
+vectors from different models never end up in the same collection.
+"""
+import hashlib
+import importlib.util
+import logging
+import os
+import re
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from config import EMBEDDING_WORKER_PROCESSES, HASH_EMBEDDING_MODE, OPENAI_TIMEOUT
+from rag import embedding_workers
+from rag.hash_embeddings import HASH_EMBEDDING_DIM, HASH_MODEL_NAMES
+
+logger = logging.getLogger(__name__)
+
+# Order tried when EMBEDDING_PROVIDER=auto
+PROVIDER_FALLBACK_ORDER = ("openai", "sentence-transformers", "hash")
+
+
+class EmbeddingIdentity(NamedTuple):
+    provider: str
+    model: str
+    dimension: int
+
+    @property
+    def collection_name(self) -> str:
+        """Chroma collection for vectors of this identity (3-63 chars of [a-zA-Z0-9_-])"""
+        name = re.sub(r"[^a-zA-Z0-9_-]", "-", f"documents_{self.provider}_{self.model}_{self.dimension}")
+        if len(name) > 63:
+            digest = hashlib.sha256(name.encode("utf-8")).hexdigest()[:8]
+            name = f"{name[:54]}_{digest}"
+        return name
+
+
+class ProviderUnavailable(Exception):
+    """The provider cannot be used in this environment (missing key or package)"""
+
+
+ProviderFactory = Callable[[], Tuple[Any, EmbeddingIdentity]]
+_registry: Dict[str, ProviderFactory] = {}
+_min_similarity: Dict[str, Optional[float]] = {}
+
+
+def register_provider(
+    name: str, min_similarity: Optional[float] = None
+) -> Callable[[ProviderFactory], ProviderFactory]:
+    """Register a factory returning (model, identity) for a provider name
+
+    min_similarity is the cosine similarity below which a chunk is treated as
+    unrelated to the query for this provider's model (None: no cutoff).
+    """
+    def decorator(factory: ProviderFactory) -> ProviderFactory:
+        _registry[name] = factory
+        _min_similarity[name] = min_similarity
+        return factory
+    return decorator
+
+
+def default_min_similarity(name: str) -> Optional[float]:
+    """Relevance cutoff registered for a provider"""
+    return _min_similarity.get(name)
+
+
+def available_providers() -> List[str]:
+    return list(_registry)
+
+
+def create_provider(name: str) -> Tuple[Any, EmbeddingIdentity]:
+    """Instantiate a registered provider, raising if it is unknown or unavailable"""
+    factory = _registry.get(name)
+    if factory is None:
+        raise ValueError(f"Unknown embedding provider: {name}. Available: {', '.join(_registry)}")
+    return factory()
+
+
+# Unrelated text scores around 0.0-0.2 with text-embedding-3-small and MiniLM
+@register_provider("openai", min_similarity=0.25)
+def _create_openai() -> Tuple[Any, EmbeddingIdentity]:
+    openai_key = os.getenv("OPENAI_API_KEY")
+    if not openai_key:
+        raise ProviderUnavailable("OPENAI_API_KEY environment variable is not set")
+    from openai import OpenAI
+    # Retries (with deadline and circuit breaker) are handled by lib.retry
+    client = OpenAI(api_key=openai_key, timeout=OPENAI_TIMEOUT, max_retries=0)
+    return client, EmbeddingIdentity("openai", "text-embedding-3-small", 1536)
+
+
+@register_provider("sentence-transformers", min_similarity=0.3)
+def _create_sentence_transformers() -> Tuple[Any, EmbeddingIdentity]:
+    identity = EmbeddingIdentity("sentence-transformers", "all-MiniLM-L6-v2", 384)
+    if importlib.util.find_spec("sentence_transformers") is None:
+        raise ProviderUnavailable("sentence-transformers is not installed")
+    if EMBEDDING_WORKER_PROCESSES > 0:
+        # Worker processes load the model themselves
+        logger.info(f"Using sentence-transformers in {EMBEDDING_WORKER_PROCESSES} worker process(es)")
+        return embedding_workers.get_worker_pool(identity.model, EMBEDDING_WORKER_PROCESSES), identity
+    from sentence_transformers import SentenceTransformer
+    logger.info("Initializing sentence-transformers model (this may take a moment on first run)...")
+    return SentenceTransformer(identity.model, device='cpu'), identity
+
+
+# Hash vectors carry no meaning, so their similarity cannot tell relevant from unrelated
+@register_provider("hash", min_similarity=None)
+def _create_hash() -> Tuple[Any, EmbeddingIdentity]:
+    if HASH_EMBEDDING_MODE not in HASH_MODEL_NAMES:
+        raise ValueError(f"HASH_EMBEDDING_MODE must be one of {sorted(HASH_MODEL_NAMES)}")
+    # "hash_based" is the marker the embedding code dispatches on
+    return "hash_based", EmbeddingIdentity("hash", HASH_MODEL_NAMES[HASH_EMBEDDING_MODE], HASH_EMBEDDING_DIM)
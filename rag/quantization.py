@@ -0,0 +1,51 @@
+"""Compact storage encodings for embedding vectors
+
+float32 is lossless. float16 halves memory with a negligible effect on
+cosine ranking. int8 keeps one float32 scale per vector and quarters
+memory (see benchmarks/quantization_bench.py for measured recall).
+"""
+from typing import Optional, Tuple
+
+import numpy as np
+
+STORAGE_DTYPES = ("float32", "float16", "int8")
+
+
+def encode_vectors(matrix: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Encode an (n, dim) float32 matrix, returning (data, per-vector scales or None)"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype == "float32":
+        return matrix, None
+    if dtype == "float16":
+        return matrix.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.abs(matrix).max(axis=1) / np.float32(127.0)
+        # All-zero rows have nothing to scale; any positive scale decodes them back to zeros
+        scales[scales == 0] = np.float32(1.0)
+        data = np.rint(matrix / scales[:, None]).astype(np.int8)
+        return data, scales.astype(np.float32)
+    raise ValueError(f"Unknown storage dtype: {dtype}. Use one of {STORAGE_DTYPES}")
+
+
+def decode_vectors(data: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    """Decode stored vectors back into a float32 matrix"""
+    if scales is not None:
+        return data.astype(np.float32) * scales[:, None]
+    return data.astype(np.float32, copy=False)
+
+
+def to_bytes(vector: np.ndarray, dtype: str) -> bytes:
+    """Serialize one vector (int8 stores its float32 scale first)"""
+    data, scales = encode_vectors(vector[np.newaxis, :], dtype)
+    if scales is not None:
+        return scales.tobytes() + data.tobytes()
+    return data.tobytes()
+
+
+def from_bytes(blob: bytes, dtype: str) -> np.ndarray:
+    """Deserialize one vector written by to_bytes into float32"""
+    if dtype == "int8":
+        scale = np.frombuffer(blob[:4], dtype=np.float32)
+        data = np.frombuffer(blob[4:], dtype=np.int8)
+        return decode_vectors(data[np.newaxis, :], scale)[0]
+    return decode_vectors(np.frombuffer(blob, dtype=np.dtype(dtype)))
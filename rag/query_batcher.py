@@ -0,0 +1,88 @@
+"""Micro-batching of concurrent single-query embedding requests"""
+import asyncio
+import logging
+import time
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from config import QUERY_BATCH_WINDOW_MS, QUERY_BATCH_MAX_SIZE
+from lib import metrics
+from rag import embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class QueryEmbeddingBatcher:
+    """Coalesce query texts arriving within a short window into one get_embeddings call"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, window: float, max_batch_size: int):
+        self.loop = loop
+        self.window = window
+        self.max_batch_size = max(1, max_batch_size)
+        self._pending: List[Tuple[str, asyncio.Future, float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: Set[asyncio.Task] = set()
+
+    async def embed(self, text: str) -> np.ndarray:
+        future = self.loop.create_future()
+        self._pending.append((text, future, time.monotonic()))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = self.loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = self.loop.create_task(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future, float]]) -> None:
+        started = time.monotonic()
+        metrics.increment("query_batcher.batches")
+        metrics.observe("query_batcher.batch_size", len(batch))
+        for _, _, enqueued_at in batch:
+            metrics.observe("query_batcher.queue_delay_ms", (started - enqueued_at) * 1000)
+
+        try:
+            vectors = await embeddings.get_embeddings([text for text, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), vector in zip(batch, vectors):
+            # Callers that were cancelled while waiting are skipped
+            if not future.done():
+                future.set_result(vector)
+
+
+_batcher: Optional[QueryEmbeddingBatcher] = None
+
+
+def get_query_batcher() -> QueryEmbeddingBatcher:
+    """Get or create the batcher bound to the running event loop"""
+    global _batcher
+    loop = asyncio.get_running_loop()
+    if _batcher is None or _batcher.loop is not loop:
+        _batcher = QueryEmbeddingBatcher(
+            loop,
+            window=QUERY_BATCH_WINDOW_MS / 1000,
+            max_batch_size=QUERY_BATCH_MAX_SIZE
+        )
+    return _batcher
+
+
+async def embed_query(text: str) -> np.ndarray:
+    """Embed a single query, batched with concurrent callers"""
+    if QUERY_BATCH_WINDOW_MS <= 0:
+        return (await embeddings.get_embeddings([text]))[0]
+    return await get_query_batcher().embed(text)
@@ -0,0 +1,59 @@
+"""Adaptive relevance policy for retrieved chunks
+
+Decides how many of the retrieved chunks are worth sending to Claude:
+  1. minimum similarity: drop chunks scoring below the cutoff
+  2. gap detection: cut at the first drop in the score curve of at least RELEVANCE_GAP
+
+Token budgeting is left to rag.context_packer, which trims to whole
+sentences instead of dropping chunks that overflow.
+
+Off-topic questions therefore end up with few or no chunks. Steps 1 and 2
+need meaningful similarities; they are skipped for providers without a
+cutoff (hash embeddings) unless RELEVANCE_MIN_SIMILARITY is set explicitly.
+"""
+from typing import Any, Dict, List, Optional
+
+from config import RELEVANCE_GAP, RELEVANCE_MIN_SIMILARITY
+from lib import metrics
+from rag.embeddings import get_embedding_identity
+from rag.providers import default_min_similarity
+
+
+def resolve_min_similarity(override: Optional[float] = None) -> Optional[float]:
+    """Similarity cutoff: explicit override, then RELEVANCE_MIN_SIMILARITY, then the provider default"""
+    if override is not None:
+        return override
+    if RELEVANCE_MIN_SIMILARITY.strip():
+        return float(RELEVANCE_MIN_SIMILARITY)
+    return default_min_similarity(get_embedding_identity().provider)
+
+
+def gap_cutoff(scores: List[float], gap: float) -> Optional[float]:
+    """Lowest score kept when cutting at the first drop of at least gap (None: no cut)"""
+    if gap <= 0:
+        return None
+    ordered = sorted(scores, reverse=True)
+    for higher, lower in zip(ordered, ordered[1:]):
+        if higher - lower >= gap:
+            return higher
+    return None
+
+
+def apply_relevance_policy(
+    chunks: List[Dict[str, Any]],
+    min_similarity: Optional[float] = None,
+    gap: float = RELEVANCE_GAP
+) -> List[Dict[str, Any]]:
+    """Chunks worth sending to Claude, in retrieval order (possibly none)"""
+    selected = list(chunks)
+    min_similarity = resolve_min_similarity(min_similarity)
+    if min_similarity is not None:
+        # Chunks without a score (not produced by the retriever) are kept
+        selected = [chunk for chunk in selected if chunk.get("score") is None or chunk["score"] >= min_similarity]
+        cutoff = gap_cutoff([chunk["score"] for chunk in selected if chunk.get("score") is not None], gap)
+        if cutoff is not None:
+            selected = [chunk for chunk in selected if chunk.get("score") is None or chunk["score"] >= cutoff]
+
+    metrics.increment("relevance.chunks_in", len(chunks))
+    metrics.increment("relevance.chunks_out", len(selected))
+    return selected
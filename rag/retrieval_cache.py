@@ -0,0 +1,108 @@
+"""Retrieval result cache invalidated by collection write generations
+
+Every write to a collection (store_documents, document deletes) bumps that
+collection's generation. Cached results remember the generation they were
+computed under, captured before the query ran, and are only served while it
+is still current. A result computed concurrently with a write can therefore
+never outlive the write.
+"""
+import copy
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import RETRIEVAL_CACHE_ENABLED, RETRIEVAL_CACHE_MAX_ENTRIES, RETRIEVAL_CACHE_TTL
+from lib import metrics
+from lib.cache import LRUCache
+
+_generations: Dict[str, int] = {}
+_generation_lock = threading.Lock()
+_cache = LRUCache(max_entries=RETRIEVAL_CACHE_MAX_ENTRIES, ttl=RETRIEVAL_CACHE_TTL)
+
+
+def get_generation(collection_name: str) -> int:
+    """Current write generation of a collection"""
+    return _generations.get(collection_name, 0)
+
+
+def bump_generation(collection_name: str) -> int:
+    """Mark a collection as changed; all cached results for it become stale"""
+    with _generation_lock:
+        _generations[collection_name] = _generations.get(collection_name, 0) + 1
+        return _generations[collection_name]
+
+
+def normalize_query(query: str) -> str:
+    """Case- and whitespace-insensitive form of a query"""
+    return " ".join(query.lower().split())
+
+
+def _key(collection_name: str, query: str, top_k: int, filters: Optional[Dict[str, Any]], mode: str) -> Tuple:
+    return (
+        collection_name,
+        mode,
+        normalize_query(query),
+        top_k,
+        json.dumps(filters, sort_keys=True) if filters else None
+    )
+
+
+def lookup(
+    collection_name: str,
+    query: str,
+    top_k: int,
+    filters: Optional[Dict[str, Any]] = None,
+    mode: str = "dense"
+) -> Optional[List[Dict[str, Any]]]:
+    """Cached chunk list for the query, or None on a miss or stale entry"""
+    if not RETRIEVAL_CACHE_ENABLED:
+        return None
+    key = _key(collection_name, query, top_k, filters, mode)
+    entry = _cache.get(key)
+    if entry is None:
+        metrics.increment("retrieval_cache.misses")
+        return None
+    generation, chunks = entry
+    if generation != get_generation(collection_name):
+        _cache.delete(key)
+        metrics.increment("retrieval_cache.stale")
+        metrics.increment("retrieval_cache.misses")
+        return None
+    metrics.increment("retrieval_cache.hits")
+    return copy.deepcopy(chunks)
+
+
+def store(
+    collection_name: str,
+    query: str,
+    top_k: int,
+    filters: Optional[Dict[str, Any]],
+    chunks: List[Dict[str, Any]],
+    generation: int,
+    mode: str = "dense"
+) -> None:
+    """Cache a result computed under the given generation"""
+    if not RETRIEVAL_CACHE_ENABLED or generation != get_generation(collection_name):
+        return
+    _cache.set(_key(collection_name, query, top_k, filters, mode), (generation, copy.deepcopy(chunks)))
+    metrics.set_gauge("retrieval_cache.entries", len(_cache))
+
+
+def get_cache_stats() -> Dict[str, Any]:
+    """Hit rate and size of the retrieval cache"""
+    counters = metrics.snapshot()["counters"]
+    hits = counters.get("retrieval_cache.hits", 0)
+    misses = counters.get("retrieval_cache.misses", 0)
+    return {
+        "enabled": RETRIEVAL_CACHE_ENABLED,
+        "hits": hits,
+        "misses": misses,
+        "stale": counters.get("retrieval_cache.stale", 0),
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "entries": len(_cache),
+        "generations": dict(_generations)
+    }
+
+
+def clear() -> None:
+    _cache.clear()
@@ -1,44 +1,230 @@
-from rag.embeddings import get_embeddings
+from rag.query_batcher import embed_query
 from rag.chroma_client import get_chroma_collection
-from typing import List, Dict, Any
+from rag.embeddings import get_embedding_identity
+from rag import embeddings
+from rag.diversify import diversify
+from rag.filters import FilterValue, normalize_filters, to_where
+from rag import bm25, retrieval_cache
+from lib.admission import AdmissionRejected
+from lib.retry import CircuitOpen
+from config import HYBRID_CANDIDATES, MERGED_CHUNK_MAX_CHARS, MMR_CANDIDATES, MMR_LAMBDA, RETRIEVAL_DIVERSITY, RETRIEVAL_MODE, RRF_K
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+import asyncio
+import copy
+import numpy as np
 
-async def retrieve_relevant_chunks(query: str, top_k: int = 5) -> List[Dict[str, Any]]:
-    """Retrieve most relevant chunks for query"""
+RETRIEVAL_MODES = ("dense", "hybrid")
+
+# (chunks, relevance per chunk, embedding matrix or None)
+Candidates = Tuple[List[Dict[str, Any]], np.ndarray, Optional[np.ndarray]]
+
+
+def resolve_mode(mode: Optional[str] = None) -> str:
+    """Concrete retrieval mode for a request ("auto" means hybrid under hash embeddings)"""
+    mode = (mode or RETRIEVAL_MODE).lower()
+    if mode == "auto":
+        # Hash embeddings carry no semantics; lexical matching does the real work
+        return "hybrid" if get_embedding_identity().provider == "hash" else "dense"
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode: {mode}. Use one of: auto, {', '.join(RETRIEVAL_MODES)}")
+    return mode
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Fuse ranked id lists: score(id) = sum of 1 / (k + rank) over the lists containing it"""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, start=1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def _include(with_embeddings: bool) -> List[str]:
+    return ["documents", "metadatas", "distances"] + (["embeddings"] if with_embeddings else [])
+
+
+def _cosine_distances(query: np.ndarray, vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1) * (np.linalg.norm(query) or 1.0)
+    return 1.0 - (vectors @ query) / np.where(norms == 0, 1.0, norms)
+
+
+async def _dense_candidates(
+    collection, query_matrix: np.ndarray, n_candidates: int, with_embeddings: bool, filters
+) -> List[Candidates]:
+    """Chroma nearest neighbours for every query in one call; relevance is cosine similarity"""
+    results = await asyncio.to_thread(
+        collection.query,
+        query_embeddings=query_matrix,
+        n_results=n_candidates,
+        where=to_where(filters),
+        include=_include(with_embeddings)
+    )
+    candidates = []
+    for q in range(len(query_matrix)):
+        ids = results['ids'][q] if results['ids'] else []
+        distances = np.asarray(results['distances'][q] if ids else [], dtype=np.float32)
+        chunks = [
+            {
+                "id": chunk_id,
+                "text": results['documents'][q][i],
+                "metadata": results['metadatas'][q][i] or {},
+                "distance": float(distances[i])
+            }
+            for i, chunk_id in enumerate(ids)
+        ]
+        vectors = np.asarray(results['embeddings'][q], dtype=np.float32) if with_embeddings and ids else None
+        candidates.append((chunks, 1.0 - distances, vectors))
+    return candidates
+
+
+async def _hybrid_candidates(
+    collection, queries: List[str], query_matrix: np.ndarray, n_candidates: int, with_embeddings: bool, filters
+) -> List[Candidates]:
+    """Fuse BM25 and Chroma rankings per query
+
+    All queries share one Chroma query; BM25-only hits of every query are
+    fetched together by id afterwards.
+    """
+    n_ranked = max(n_candidates, HYBRID_CANDIDATES)
+    index = await asyncio.to_thread(bm25.ensure_index, collection)
+    lexical, results = await asyncio.gather(
+        asyncio.to_thread(lambda: [index.search(query, n_ranked, filters) for query in queries]),
+        asyncio.to_thread(
+            collection.query,
+            query_embeddings=query_matrix,
+            n_results=n_ranked,
+            where=to_where(filters),
+            include=_include(with_embeddings)
+        )
+    )
+    
+    fused_per_query = []
+    records = {}  # chunk_id -> (text, metadata, vector)
+    dense_distances = []
+    for q in range(len(queries)):
+        dense_ids = results['ids'][q] if results['ids'] else []
+        distances = {}
+        for i, chunk_id in enumerate(dense_ids):
+            vector = results['embeddings'][q][i] if with_embeddings else None
+            records[chunk_id] = (results['documents'][q][i], results['metadatas'][q][i] or {}, vector)
+            distances[chunk_id] = float(results['distances'][q][i])
+        dense_distances.append(distances)
+        fused_per_query.append(
+            reciprocal_rank_fusion([dense_ids, [chunk_id for chunk_id, _ in lexical[q]]])[:n_candidates]
+        )
+    
+    missing = list(dict.fromkeys(
+        chunk_id for fused in fused_per_query for chunk_id, _ in fused if chunk_id not in records
+    ))
+    if missing:
+        # Embeddings of lexical-only hits give them a distance like the dense hits
+        fetched = await asyncio.to_thread(
+            collection.get, ids=missing, include=["documents", "metadatas", "embeddings"]
+        )
+        for i, chunk_id in enumerate(fetched['ids']):
+            records[chunk_id] = (fetched['documents'][i], fetched['metadatas'][i] or {}, fetched['embeddings'][i])
+    
+    candidates = []
+    for q, fused in enumerate(fused_per_query):
+        # An id missing from Chroma (index lagging a delete) is dropped rather than failing the query
+        fused = [(chunk_id, score) for chunk_id, score in fused if chunk_id in records]
+        distances = dense_distances[q]
+        lexical_only = [chunk_id for chunk_id, _ in fused if chunk_id not in distances]
+        if lexical_only:
+            vectors = np.asarray([records[chunk_id][2] for chunk_id in lexical_only], dtype=np.float32)
+            distances = {**distances, **dict(zip(lexical_only, _cosine_distances(query_matrix[q], vectors).tolist()))}
+        chunks = [
+            {
+                "id": chunk_id,
+                "text": records[chunk_id][0],
+                "metadata": records[chunk_id][1],
+                "distance": distances[chunk_id]
+            }
+            for chunk_id, _ in fused
+        ]
+        scores = np.asarray([score for _, score in fused], dtype=np.float32)
+        relevance = scores / scores.max() if len(scores) else scores
+        vectors = (
+            np.asarray([records[chunk_id][2] for chunk_id, _ in fused], dtype=np.float32)
+            if with_embeddings and fused else None
+        )
+        candidates.append((chunks, relevance, vectors))
+    return candidates
+
+
+async def _search(
+    collection, queries: List[str], query_matrix: np.ndarray, top_k: int, mode: str, filters
+) -> List[List[Dict[str, Any]]]:
+    """Chunks for each query (already embedded as rows of query_matrix)"""
+    n_results = min(top_k, 10)  # Limit to 10 max
+    # Over-fetch so diversification has alternatives to adjacent, overlapping chunks
+    use_mmr = RETRIEVAL_DIVERSITY == "mmr"
+    n_candidates = max(n_results, MMR_CANDIDATES) if use_mmr else n_results
+    query_matrix = np.asarray(query_matrix, dtype=np.float32).reshape(len(queries), -1)
+    if mode == "hybrid":
+        candidates = await _hybrid_candidates(collection, queries, query_matrix, n_candidates, use_mmr, filters)
+    else:
+        candidates = await _dense_candidates(collection, query_matrix, n_candidates, use_mmr, filters)
+    for chunks, _, _ in candidates:
+        for chunk in chunks:
+            chunk["score"] = 1.0 - chunk["distance"]
+    
+    if not use_mmr:
+        return [chunks[:n_results] for chunks, _, _ in candidates]
+    return [
+        diversify(chunks, relevance, vectors, n_results, MMR_LAMBDA, MERGED_CHUNK_MAX_CHARS)
+        for chunks, relevance, vectors in candidates
+    ]
+
+
+async def retrieve_relevant_chunks(
+    query: str,
+    top_k: int = 5,
+    mode: Optional[str] = None,
+    filters: Optional[Dict[str, FilterValue]] = None
+) -> List[Dict[str, Any]]:
+    """Retrieve most relevant chunks for query
+    
+    mode is "dense" (vector similarity), "hybrid" (BM25 and vector rankings
+    fused with reciprocal rank fusion) or "auto"; defaults to RETRIEVAL_MODE.
+    filters restrict the search to chunks whose doc_id / filename / file_type
+    match; they are applied inside Chroma (and the BM25 index), not afterwards.
+    Each chunk has id, text, metadata, distance (cosine, lower is closer) and
+    score (cosine similarity, 1 - distance).
+    """
     
     if not query or not query.strip():
         return []
     
+    mode = resolve_mode(mode)
+    filters = normalize_filters(filters)
+    
     try:
-        # Generate query embedding
-        query_embeddings = await get_embeddings([query])
-        
-        if not query_embeddings:
-            return []
+        collection = get_chroma_collection()
         
-        query_embedding = query_embeddings[0]
+        # Serve repeated queries from the cache while the collection is unchanged;
+        # the generation is captured before querying so a concurrent write invalidates it
+        generation = retrieval_cache.get_generation(collection.name)
+        cached = retrieval_cache.lookup(collection.name, query, top_k, filters, mode=mode)
+        if cached is not None:
+            return cached
         
-        # Search in ChromaDB
-        collection = get_chroma_collection()
-        results = collection.query(
-            query_embeddings=[query_embedding],
-            n_results=min(top_k, 10)  # Limit to 10 max
-        )
+        # Generate query embedding (batched with concurrent queries)
+        query_embedding = await embed_query(query)
         
-        # Format results
-        chunks = []
-        if results['documents'] and len(results['documents']) > 0:
-            documents = results['documents'][0]
-            metadatas = results['metadatas'][0] if results['metadatas'] else []
-            
-            for i, doc_text in enumerate(documents):
-                chunk = {
-                    "text": doc_text,
-                    "metadata": metadatas[i] if i < len(metadatas) else {}
-                }
-                chunks.append(chunk)
+        chunks = (await _search(collection, [query], query_embedding, top_k, mode, filters))[0]
         
+        retrieval_cache.store(collection.name, query, top_k, filters, chunks, generation, mode=mode)
         return chunks
         
+    except CircuitOpen as e:
+        # The embedding provider is down: degrade to "no documents" at once, as for any other failure
+        import logging
+        logging.getLogger(__name__).warning(f"Skipping retrieval: {e}")
+        return []
+    except AdmissionRejected:
+        # Overload is reported to the client (503), not turned into "no documents"
+        raise
     except Exception as e:
         # Log error but return empty list to prevent breaking the API
         import logging
@@ -46,3 +232,43 @@ async def retrieve_relevant_chunks(query: str, top_k: int = 5) -> List[Dict[str,
         logger.error(f"Error retrieving chunks: {str(e)}", exc_info=True)
         return []
 
+
+async def retrieve_batch(
+    queries: List[str],
+    top_k: int = 5,
+    mode: Optional[str] = None,
+    filters: Optional[Dict[str, FilterValue]] = None
+) -> List[List[Dict[str, Any]]]:
+    """retrieve_relevant_chunks for many queries at once
+    
+    Cached queries are answered from the retrieval cache; the rest (deduplicated)
+    are embedded with one get_embeddings call and searched with one multi-query
+    collection.query. Results are in the order of queries. Unlike the
+    single-query path, errors are raised to the caller.
+    """
+    mode = resolve_mode(mode)
+    filters = normalize_filters(filters)
+    collection = get_chroma_collection()
+    generation = retrieval_cache.get_generation(collection.name)
+    
+    results: List[Optional[List[Dict[str, Any]]]] = [None] * len(queries)
+    pending: Dict[str, List[int]] = {}  # query text -> positions
+    for i, query in enumerate(queries):
+        if not query or not query.strip():
+            results[i] = []
+            continue
+        cached = retrieval_cache.lookup(collection.name, query, top_k, filters, mode=mode)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.setdefault(query, []).append(i)
+    
+    if pending:
+        texts = list(pending)
+        query_matrix = await embeddings.get_embeddings(texts)
+        found = await _search(collection, texts, query_matrix, top_k, mode, filters)
+        for text, chunks in zip(texts, found):
+            retrieval_cache.store(collection.name, text, top_k, filters, chunks, generation, mode=mode)
+            for i in pending[text]:
+                results[i] = chunks if len(pending[text]) == 1 else copy.deepcopy(chunks)
+    return results
@@ -0,0 +1,161 @@
+"""Semantic cache: answer paraphrases of already answered questions
+
+The query embeddings of answered questions are kept in a small in-memory
+matrix per collection. A new question whose embedding has cosine similarity
+of at least SEMANTIC_CACHE_THRESHOLD to a cached one (same filters and
+budget, same collection write generation) gets the cached answer, skipping
+retrieval and the Claude call. Every hit is logged with its similarity, and
+the best similarity of every lookup is recorded as a metric, to tune the
+threshold against real traffic.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+from config import SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL
+from lib import metrics
+from lib.admission import AdmissionRejected
+from lib.retry import CircuitOpen
+from rag import chroma_client, retrieval_cache
+from rag.query_batcher import embed_query
+
+logger = logging.getLogger(__name__)
+
+
+class Probe(NamedTuple):
+    """State of one lookup, needed to store the answer computed after a miss"""
+    collection_name: str
+    generation: int
+    scope: str
+    query: str
+    vector: np.ndarray
+    hit: Optional[Dict[str, Any]]  # {"answer", "sources", "query", "similarity"} on a hit
+
+
+class _Index:
+    """Normalized query vectors of one collection with their answers"""
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.vectors: Optional[np.ndarray] = None
+        self.entries: List[Dict[str, Any]] = []
+
+
+_indexes: Dict[str, _Index] = {}
+_lock = threading.Lock()
+
+
+def scope_key(filters: Optional[Dict[str, Any]] = None, max_context_tokens: Optional[int] = None) -> str:
+    """Request options that must match for a cached answer to apply"""
+    return json.dumps({"filters": filters or None, "max_context_tokens": max_context_tokens}, sort_keys=True)
+
+
+def _normalize(vector) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _current_index(collection_name: str, generation: int) -> _Index:
+    index = _indexes.get(collection_name)
+    if index is None or index.generation != generation:
+        # Documents changed since these answers were cached
+        index = _indexes[collection_name] = _Index(generation)
+    return index
+
+
+def find(collection_name: str, generation: int, scope: str, vector) -> Optional[Dict[str, Any]]:
+    """Closest cached answer within the threshold, or None"""
+    query = _normalize(vector)
+    with _lock:
+        if generation != retrieval_cache.get_generation(collection_name):
+            return None
+        index = _current_index(collection_name, generation)
+        if index.vectors is None:
+            return None
+        similarities = index.vectors @ query
+        now = time.monotonic()
+        for i, entry in enumerate(index.entries):
+            if entry["scope"] != scope or now - entry["stored_at"] > SEMANTIC_CACHE_TTL:
+                similarities[i] = -np.inf
+        best = int(np.argmax(similarities))
+        similarity = float(similarities[best])
+        if not np.isfinite(similarity):
+            return None
+        metrics.observe("semantic_cache.best_similarity", similarity)
+        if similarity < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        entry = index.entries[best]
+        return {"answer": entry["answer"], "sources": entry["sources"], "query": entry["query"], "similarity": similarity}
+
+
+def add(collection_name: str, generation: int, scope: str, query: str, vector, answer: str, sources: List[Dict[str, Any]]) -> None:
+    """Cache an answer computed under the given generation"""
+    with _lock:
+        if generation != retrieval_cache.get_generation(collection_name):
+            return
+        index = _current_index(collection_name, generation)
+        row = _normalize(vector).reshape(1, -1)
+        index.vectors = row if index.vectors is None else np.vstack([index.vectors, row])
+        index.entries.append({
+            "scope": scope, "query": query, "answer": answer, "sources": sources, "stored_at": time.monotonic()
+        })
+        if len(index.entries) > SEMANTIC_CACHE_MAX_ENTRIES:
+            # Oldest first
+            drop = len(index.entries) - SEMANTIC_CACHE_MAX_ENTRIES
+            index.vectors = index.vectors[drop:]
+            index.entries = index.entries[drop:]
+        metrics.set_gauge("semantic_cache.entries", sum(len(i.entries) for i in _indexes.values()))
+
+
+async def probe(query: str, scope: str) -> Optional[Probe]:
+    """Embed the query and look it up; None when the cache is disabled or unavailable"""
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    try:
+        collection_name = chroma_client.get_chroma_collection().name
+        # Captured before retrieval so an answer racing a write is never cached as current
+        generation = retrieval_cache.get_generation(collection_name)
+        vector = np.asarray(await embed_query(query), dtype=np.float32)
+        hit = find(collection_name, generation, scope, vector)
+    except CircuitOpen as e:
+        logger.warning(f"[SEMANTIC_CACHE] Lookup skipped: {e}")
+        return None
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logger.warning(f"[SEMANTIC_CACHE] Lookup failed: {e}")
+        return None
+    if hit is None:
+        metrics.increment("semantic_cache.misses")
+    else:
+        metrics.increment("semantic_cache.hits")
+        metrics.observe("semantic_cache.hit_similarity", hit["similarity"])
+        logger.info(
+            f"[SEMANTIC_CACHE] Hit similarity={hit['similarity']:.4f} threshold={SEMANTIC_CACHE_THRESHOLD} "
+            f"query={query!r} cached_query={hit['query']!r}"
+        )
+    return Probe(collection_name, generation, scope, query, vector, hit)
+
+
+def remember(probe_result: Optional[Probe], answer: str, sources: List[Dict[str, Any]]) -> None:
+    """Store the answer for a probed query that missed
+
+    Answers without sources are canned (no context reached Claude) and are
+    not remembered, so they are never served for paraphrases.
+    """
+    if probe_result is None or probe_result.hit is not None or not sources:
+        return
+    add(
+        probe_result.collection_name, probe_result.generation, probe_result.scope,
+        probe_result.query, probe_result.vector, answer, sources
+    )
+
+
+def clear() -> None:
+    with _lock:
+        _indexes.clear()
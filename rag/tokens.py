@@ -0,0 +1,14 @@
+"""Token estimates for prompt budgeting
+
+Claude's tokenizer is not available offline; roughly four characters per
+token holds for English prose, and rounding up keeps budgets conservative.
+"""
+import math
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate number of tokens in text"""
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
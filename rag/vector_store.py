@@ -1,5 +1,10 @@
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
+import numpy as np
 from rag.chroma_client import get_chroma_collection
+from rag.retrieval_cache import bump_generation
+from rag import answer_cache
+from rag.bm25 import ensure_index
+import asyncio
 import logging
 
 logger = logging.getLogger(__name__)
@@ -7,14 +12,21 @@ logger = logging.getLogger(__name__)
 async def store_documents(
     doc_id: str, 
     chunks: List[str], 
-    embeddings: List[List[float]], 
-    metadata: Dict[str, Any]
+    embeddings: np.ndarray, 
+    metadata: Dict[str, Any],
+    start_index: int = 0,
+    chunk_metadatas: Optional[List[Dict[str, Any]]] = None
 ) -> None:
-    """Store document chunks in ChromaDB"""
+    """Store document chunks in ChromaDB
+    
+    A large document may be stored in several calls, one per embedded batch;
+    start_index is the position of the first chunk within the document.
+    chunk_metadatas adds per-chunk fields (e.g. char_start/char_end) to metadata.
+    """
     
     logger.info(f"[VECTOR_STORE] Storing {len(chunks)} chunks for doc_id: {doc_id}")
     
-    if not chunks or not embeddings:
+    if not chunks or len(embeddings) == 0:
         logger.error("[VECTOR_STORE] Chunks or embeddings are empty")
         raise ValueError("Chunks and embeddings cannot be empty")
     
@@ -23,10 +35,12 @@ async def store_documents(
         raise ValueError("Number of chunks must match number of embeddings")
     
     # Prepare IDs, documents, embeddings, and metadatas
-    ids = [f"{doc_id}_{i}" for i in range(len(chunks))]
+    ids = [f"{doc_id}_{i}" for i in range(start_index, start_index + len(chunks))]
+    if chunk_metadatas is not None and len(chunk_metadatas) != len(chunks):
+        raise ValueError("Number of chunk metadatas must match number of chunks")
     metadatas = [
-        {**metadata, "chunk_id": i, "doc_id": doc_id}
-        for i in range(len(chunks))
+        {**metadata, **(chunk_metadatas[j] if chunk_metadatas else {}), "chunk_id": i, "doc_id": doc_id}
+        for j, i in enumerate(range(start_index, start_index + len(chunks)))
     ]
     
     logger.info(f"[VECTOR_STORE] Prepared {len(ids)} IDs for storage")
@@ -34,12 +48,18 @@ async def store_documents(
     # Add to collection
     collection = get_chroma_collection()
     try:
-        collection.add(
+        # Index chunks stored before the lexical index existed before adding new ones
+        bm25_index = await asyncio.to_thread(ensure_index, collection)
+        # Run the blocking write off the event loop so embedding can continue
+        await asyncio.to_thread(
+            collection.add,
             ids=ids,
             documents=chunks,
             embeddings=embeddings,
             metadatas=metadatas
         )
+        await asyncio.to_thread(bm25_index.add_chunks, doc_id, ids, chunks, metadata)
+        bump_generation(collection.name)
         logger.info(f"[VECTOR_STORE] Successfully stored {len(chunks)} chunks")
         
         # Verify stored
@@ -49,3 +69,15 @@ async def store_documents(
         logger.error(f"[VECTOR_STORE] Error storing documents: {str(e)}", exc_info=True)
         raise
 
+
+
+async def remove_document(doc_id: str) -> None:
+    """Remove every stored chunk of a document (e.g. after a failed partial upload)"""
+    
+    logger.info(f"[VECTOR_STORE] Removing chunks for doc_id: {doc_id}")
+    collection = get_chroma_collection()
+    bm25_index = await asyncio.to_thread(ensure_index, collection)
+    await asyncio.to_thread(collection.delete, where={"doc_id": doc_id})
+    await asyncio.to_thread(bm25_index.remove_document, doc_id)
+    bump_generation(collection.name)
+    answer_cache.invalidate_documents([doc_id])
@@ -0,0 +1,112 @@
+"""Startup warm-up and readiness tracking for lazily initialized components"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+import numpy as np
+
+from config import READINESS_COMPONENTS, WARMUP_RETRY_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# component name -> {"status": pending|warming|ready|failed, "duration_ms", "error"}
+_state: Dict[str, Dict[str, Any]] = {}
+_task: Optional[asyncio.Task] = None
+
+
+def _reset_state() -> None:
+    _state.clear()
+    for name in ("embeddings", "chroma", "anthropic"):
+        _state[name] = {"status": "pending"}
+
+
+_reset_state()
+
+
+async def _warm(name: str, func: Callable[[], Awaitable[Any]]) -> Any:
+    _state[name] = {"status": "warming"}
+    started = time.perf_counter()
+    try:
+        result = await func()
+    except Exception as e:
+        duration_ms = round((time.perf_counter() - started) * 1000, 1)
+        _state[name] = {"status": "failed", "duration_ms": duration_ms, "error": str(e)}
+        logger.error(f"[WARMUP] {name} failed after {duration_ms} ms: {e}")
+        return None
+    duration_ms = round((time.perf_counter() - started) * 1000, 1)
+    _state[name] = {"status": "ready", "duration_ms": duration_ms}
+    logger.info(f"[WARMUP] {name} ready in {duration_ms} ms")
+    return result
+
+
+async def _warm_embeddings() -> np.ndarray:
+    from rag.embeddings import warm_up_embeddings
+    return await warm_up_embeddings()
+
+
+async def _warm_chroma(vector: Optional[np.ndarray]) -> None:
+    from rag.chroma_client import get_chroma_collection
+
+    def _load_and_query():
+        collection = get_chroma_collection()
+        # A dummy query loads the HNSW index into memory
+        if vector is not None and collection.count() > 0:
+            collection.query(query_embeddings=vector.reshape(1, -1), n_results=1)
+
+    await asyncio.to_thread(_load_and_query)
+
+
+async def _warm_anthropic() -> None:
+    from rag.claude_chain import get_client
+    get_client()
+
+
+async def run_warmup() -> None:
+    """Warm every component that is not ready yet
+
+    The Anthropic client warms in parallel with embeddings + Chroma; Chroma
+    waits for the embedding vector it uses for its dummy query.
+    """
+    async def _embeddings_then_chroma():
+        vector = None
+        if _state["embeddings"]["status"] != "ready":
+            vector = await _warm("embeddings", _warm_embeddings)
+        if _state["chroma"]["status"] != "ready":
+            await _warm("chroma", lambda: _warm_chroma(vector))
+
+    async def _anthropic():
+        if _state["anthropic"]["status"] != "ready":
+            await _warm("anthropic", _warm_anthropic)
+
+    await asyncio.gather(_embeddings_then_chroma(), _anthropic())
+
+
+async def _warmup_loop() -> None:
+    delay = WARMUP_RETRY_INTERVAL
+    await run_warmup()
+    # Keep retrying failed components so a transient startup error doesn't
+    # leave the pod unready forever
+    while any(_state[name]["status"] == "failed" for name in _state):
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+        await run_warmup()
+
+
+def start_warmup() -> asyncio.Task:
+    """Launch warm-up in the background so startup (and /health) is not delayed"""
+    global _task
+    _reset_state()
+    _task = asyncio.create_task(_warmup_loop())
+    return _task
+
+
+def get_readiness() -> Dict[str, Any]:
+    """Readiness of the components that gate traffic, plus per-component state"""
+    required = [name for name in READINESS_COMPONENTS if name in _state]
+    ready = all(_state[name]["status"] == "ready" for name in required)
+    return {
+        "ready": ready,
+        "required": required,
+        "components": {name: dict(state) for name, state in _state.items()}
+    }
@@ -1,23 +1,79 @@
 from fastapi import APIRouter, HTTPException, Request
-from pydantic import BaseModel, Field
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ConfigDict, Field
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
-from rag.retriever import retrieve_relevant_chunks
-from rag.claude_chain import generate_response
-from typing import List, Optional, Dict, Any
+from rag.retriever import RETRIEVAL_MODES, retrieve_batch, retrieve_relevant_chunks
+from rag.claude_chain import generate_response, stream_response
+from rag.relevance import apply_relevance_policy
+from rag import conversations, semantic_cache
+from lib import metrics
+from lib.admission import AdmissionRejected
+from config import RETRIEVE_BATCH_MAX_QUERIES, RETRIEVE_BATCH_SLICE, RETRIEVE_BATCH_STREAM_THRESHOLD
+from typing import AsyncIterator, List, Optional, Dict, Any, Tuple
+from contextlib import aclosing
+import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/chat", tags=["chat"])
 limiter = Limiter(key_func=get_remote_address)
 
+NO_DOCUMENTS_ANSWER = (
+    "I don't have any relevant documents in my knowledge base to answer your question. Please upload some documents first."
+)
+NO_RELEVANT_CONTEXT_ANSWER = (
+    "I couldn't find anything in the uploaded documents that is relevant to your question."
+)
+
+class ChatFilters(BaseModel):
+    """Restrict retrieval to matching chunks; several fields must all match"""
+    model_config = ConfigDict(extra="forbid")
+    
+    doc_id: Optional[List[str]] = Field(None, min_length=1, description="Only these documents")
+    filename: Optional[List[str]] = Field(None, min_length=1, description="Only documents with these filenames")
+    file_type: Optional[List[str]] = Field(None, min_length=1, description="Only these content types")
+
 class ChatRequest(BaseModel):
     message: str = Field(..., min_length=1, max_length=2000, description="User's question")
-    conversation_id: Optional[str] = Field(None, description="Optional conversation ID for context")
+    conversation_id: Optional[str] = Field(
+        None, max_length=128, description="Optional conversation ID; turns with the same ID share history"
+    )
+    filters: Optional[ChatFilters] = Field(None, description="Optional metadata filters for retrieval")
+    max_context_tokens: Optional[int] = Field(
+        None, ge=0, le=100000, description="Token cap for document context within PROMPT_INPUT_TOKEN_BUDGET (default CONTEXT_TOKEN_BUDGET)"
+    )
 
 class ChatResponse(BaseModel):
     response: str = Field(..., description="AI-generated response")
     sources: List[Dict[str, Any]] = Field(..., description="Source documents used")
     conversation_id: str = Field(..., description="Conversation ID")
 
+def _semantic_scope(chat_request: ChatRequest) -> str:
+    filters = chat_request.filters.model_dump(exclude_none=True) if chat_request.filters else None
+    return semantic_cache.scope_key(filters, chat_request.max_context_tokens)
+
+async def _select_context(chat_request: ChatRequest, query: str) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Chunks to answer from, or a canned answer when there is nothing to send to Claude"""
+    
+    # 1. Retrieve relevant chunks
+    relevant_chunks = await retrieve_relevant_chunks(
+        query=query,
+        top_k=5,
+        filters=chat_request.filters.model_dump(exclude_none=True) if chat_request.filters else None
+    )
+    if not relevant_chunks:
+        return [], NO_DOCUMENTS_ANSWER
+    
+    # Keep only chunks that are relevant enough; the token budget is applied when packing the prompt
+    relevant_chunks = apply_relevance_policy(relevant_chunks)
+    if not relevant_chunks or chat_request.max_context_tokens == 0:
+        # Nothing close enough to the question: answer without calling Claude
+        metrics.increment("relevance.short_circuits")
+        return [], NO_RELEVANT_CONTEXT_ANSWER
+    return relevant_chunks, None
+
 @router.post("/message", response_model=ChatResponse)
 @limiter.limit("10/minute")
 async def chat_message(request: Request, chat_request: ChatRequest) -> ChatResponse:
@@ -27,15 +83,26 @@ async def chat_message(request: Request, chat_request: ChatRequest) -> ChatRespo
         if not chat_request.message or not chat_request.message.strip():
             raise HTTPException(status_code=400, detail="Message cannot be empty")
         
-        # 1. Retrieve relevant chunks
-        relevant_chunks = await retrieve_relevant_chunks(
-            query=chat_request.message,
-            top_k=5
-        )
+        conversation = conversations.load(chat_request.conversation_id)
+        history = conversations.history_text(conversation)
+        
+        # A paraphrase of an answered question skips retrieval and Claude
+        # (only outside a conversation: follow-ups depend on the history)
+        probe = None if history else await semantic_cache.probe(chat_request.message, _semantic_scope(chat_request))
+        if probe is not None and probe.hit is not None:
+            conversations.record_turn(chat_request.conversation_id, chat_request.message, probe.hit["answer"])
+            return ChatResponse(
+                response=probe.hit["answer"],
+                sources=probe.hit["sources"],
+                conversation_id=chat_request.conversation_id or "new"
+            )
         
-        if not relevant_chunks:
+        relevant_chunks, canned_answer = await _select_context(
+            chat_request, conversations.rewrite_query(chat_request.message, conversation)
+        )
+        if canned_answer is not None:
             return ChatResponse(
-                response="I don't have any relevant documents in my knowledge base to answer your question. Please upload some documents first.",
+                response=canned_answer,
                 sources=[],
                 conversation_id=chat_request.conversation_id or "new"
             )
@@ -44,8 +111,12 @@ async def chat_message(request: Request, chat_request: ChatRequest) -> ChatRespo
         response = await generate_response(
             query=chat_request.message,
             context=relevant_chunks,
-            conversation_id=chat_request.conversation_id
+            conversation_id=chat_request.conversation_id,
+            history=history,
+            max_context_tokens=chat_request.max_context_tokens
         )
+        semantic_cache.remember(probe, response["answer"], response["sources"])
+        conversations.record_turn(chat_request.conversation_id, chat_request.message, response["answer"])
         
         return ChatResponse(
             response=response["answer"],
@@ -53,8 +124,191 @@ async def chat_message(request: Request, chat_request: ChatRequest) -> ChatRespo
             conversation_id=response["conversation_id"]
         )
         
-    except HTTPException:
+    except (HTTPException, AdmissionRejected):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
 
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    """One Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@router.post("/stream")
+@limiter.limit("10/minute")
+async def chat_stream(request: Request, chat_request: ChatRequest) -> StreamingResponse:
+    """Send message and stream the response as Server-Sent Events
+    
+    Events: `sources` (sources and conversation_id) first, then `delta` events
+    with text fragments, then `usage` (token counts, stop reason). A failure
+    after streaming started is reported as an `error` event. When the client
+    disconnects, the Claude stream is closed so no further tokens are generated.
+    """
+    
+    if not chat_request.message or not chat_request.message.strip():
+        raise HTTPException(status_code=400, detail="Message cannot be empty")
+    
+    conversation = conversations.load(chat_request.conversation_id)
+    history = conversations.history_text(conversation)
+    probe = None if history else await semantic_cache.probe(chat_request.message, _semantic_scope(chat_request))
+    if probe is not None and probe.hit is not None:
+        relevant_chunks, canned_answer, canned_sources = [], probe.hit["answer"], probe.hit["sources"]
+        conversations.record_turn(chat_request.conversation_id, chat_request.message, canned_answer)
+    else:
+        try:
+            relevant_chunks, canned_answer = await _select_context(
+                chat_request, conversations.rewrite_query(chat_request.message, conversation)
+            )
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
+        canned_sources = []
+    conversation_id = chat_request.conversation_id or "new"
+    
+    stream, first_event = None, None
+    if canned_answer is None:
+        # Wait for the first event (sources, sent once a Claude slot is admitted)
+        # before responding, so overload is a 503 rather than an in-band error
+        stream = stream_response(
+            chat_request.message, relevant_chunks, conversation_id, history, chat_request.max_context_tokens
+        )
+        try:
+            first_event = await stream.__anext__()
+        except AdmissionRejected:
+            await stream.aclose()
+            raise
+    
+    async def events() -> AsyncIterator[str]:
+        if canned_answer is not None:
+            yield _sse("sources", {"sources": canned_sources, "conversation_id": conversation_id})
+            yield _sse("delta", {"text": canned_answer})
+            yield _sse("usage", {"input_tokens": 0, "output_tokens": 0, "stop_reason": None, "conversation_id": conversation_id})
+            return
+        try:
+            sources, text = first_event["data"]["sources"], []
+            yield _sse(first_event["event"], first_event["data"])
+            async with aclosing(stream):
+                async for event in stream:
+                    if event["event"] == "sources":
+                        sources = event["data"]["sources"]
+                    elif event["event"] == "delta":
+                        text.append(event["data"]["text"])
+                    elif event["event"] == "usage":
+                        semantic_cache.remember(probe, "".join(text), sources)
+                        conversations.record_turn(chat_request.conversation_id, chat_request.message, "".join(text))
+                    yield _sse(event["event"], event["data"])
+        except Exception as e:
+            logger.error(f"[CHAT] Streaming failed: {str(e)}", exc_info=True)
+            yield _sse("error", {"detail": f"Error generating response: {str(e)}"})
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+class BatchRetrieveRequest(BaseModel):
+    queries: List[str] = Field(..., min_length=1, max_length=RETRIEVE_BATCH_MAX_QUERIES, description="Queries to retrieve for")
+    top_k: int = Field(5, ge=1, le=10, description="Chunks per query")
+    mode: Optional[str] = Field(None, description="Retrieval mode: auto, dense or hybrid")
+    filters: Optional[ChatFilters] = Field(None, description="Optional metadata filters applied to every query")
+    stream: Optional[bool] = Field(
+        None, description="Stream NDJSON lines; by default only batches larger than the stream threshold stream"
+    )
+
+def _batch_result(index: int, query: str, chunks: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        "index": index,
+        "query": query,
+        "chunks": [
+            {
+                "id": chunk.get("id"),
+                "text": chunk["text"],
+                "metadata": chunk["metadata"],
+                "distance": chunk.get("distance"),
+                "score": chunk.get("score")
+            }
+            for chunk in chunks
+        ]
+    }
+
+@router.post("/retrieve/batch")
+@limiter.limit("10/minute")
+async def retrieve_batch_endpoint(request: Request, batch_request: BatchRetrieveRequest):
+    """Retrieve chunks for many queries in one request
+    
+    Queries are processed in slices: each slice is embedded with one call and
+    searched with one multi-query vector search. Small batches return one JSON
+    document; large batches (or stream=true, or Accept: application/x-ndjson)
+    stream one JSON line per query as each slice completes.
+    """
+    
+    queries = batch_request.queries
+    filters = batch_request.filters.model_dump(exclude_none=True) if batch_request.filters else None
+    
+    # Reject bad requests with 400 here; errors raised inside retrieval are server errors
+    if any(not query.strip() for query in queries):
+        raise HTTPException(status_code=400, detail="Queries cannot be empty")
+    if batch_request.mode is not None and batch_request.mode.lower() not in ("auto", *RETRIEVAL_MODES):
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown retrieval mode: {batch_request.mode}. Use one of: auto, {', '.join(RETRIEVAL_MODES)}"
+        )
+    
+    async def run_slice(start: int) -> List[List[Dict[str, Any]]]:
+        return await retrieve_batch(
+            queries[start:start + RETRIEVE_BATCH_SLICE],
+            top_k=batch_request.top_k,
+            mode=batch_request.mode,
+            filters=filters
+        )
+    
+    stream = batch_request.stream
+    if stream is None:
+        stream = (
+            len(queries) > RETRIEVE_BATCH_STREAM_THRESHOLD
+            or "application/x-ndjson" in request.headers.get("accept", "")
+        )
+    
+    # Run the first slice before responding so a failure is a 500, not an error mid-stream
+    try:
+        first = await run_slice(0)
+    except AdmissionRejected:
+        raise
+    except Exception as e:
+        logger.error(f"[RETRIEVE] Batch retrieval failed: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Error retrieving chunks: {str(e)}")
+    
+    if not stream:
+        results = list(first)
+        try:
+            for start in range(RETRIEVE_BATCH_SLICE, len(queries), RETRIEVE_BATCH_SLICE):
+                results.extend(await run_slice(start))
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            logger.error(f"[RETRIEVE] Batch retrieval failed: {str(e)}", exc_info=True)
+            raise HTTPException(status_code=500, detail=f"Error retrieving chunks: {str(e)}")
+        return {
+            "success": True,
+            "count": len(results),
+            "results": [_batch_result(i, query, chunks) for i, (query, chunks) in enumerate(zip(queries, results))]
+        }
+    
+    async def ndjson_lines() -> AsyncIterator[str]:
+        start, results = 0, first
+        while True:
+            for offset, chunks in enumerate(results):
+                yield json.dumps(_batch_result(start + offset, queries[start + offset], chunks)) + "\n"
+            start += RETRIEVE_BATCH_SLICE
+            if start >= len(queries):
+                return
+            try:
+                results = await run_slice(start)
+            except Exception as e:
+                # Headers are already sent; report the failure in-band and stop
+                logger.error(f"[RETRIEVE] Batch retrieval failed at query {start}: {str(e)}", exc_info=True)
+                yield json.dumps({"index": start, "error": str(e)}) + "\n"
+                return
+    
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
@@ -2,7 +2,11 @@ from fastapi import APIRouter, HTTPException, Request
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 from typing import List, Dict, Any
+import asyncio
 from rag.chroma_client import get_chroma_collection
+from rag.retrieval_cache import bump_generation
+from rag import answer_cache
+from rag.bm25 import ensure_index
 
 router = APIRouter(prefix="/api/documents", tags=["documents"])
 limiter = Limiter(key_func=get_remote_address)
@@ -60,8 +64,8 @@ async def delete_document(request: Request, doc_id: str) -> Dict[str, Any]:
     
     try:
         collection = get_chroma_collection()
-        # Get all IDs that match the doc_id prefix
-        results = collection.get()
+        # Get all IDs that match the doc_id prefix (blocking Chroma calls run off the event loop)
+        results = await asyncio.to_thread(collection.get)
         ids_to_delete = []
         
         if results['ids']:
@@ -72,8 +76,13 @@ async def delete_document(request: Request, doc_id: str) -> Dict[str, Any]:
         if not ids_to_delete:
             raise HTTPException(status_code=404, detail="Document not found")
         
-        # Delete from collection
-        collection.delete(ids=ids_to_delete)
+        # Delete from collection (the lexical index is bootstrapped first so it can't miss older chunks)
+        bm25_index = await asyncio.to_thread(ensure_index, collection)
+        await asyncio.to_thread(collection.delete, ids=ids_to_delete)
+        await asyncio.to_thread(bm25_index.remove_chunks, ids_to_delete)
+        bump_generation(collection.name)
+        # Chunk ids are "<doc_id>_<chunk index>"
+        answer_cache.invalidate_documents(chunk_id.rsplit("_", 1)[0] for chunk_id in ids_to_delete)
         
         return {
             "success": True,
@@ -107,7 +116,7 @@ async def get_stats(request: Request) -> Dict[str, Any]:
             "success": True,
             "total_chunks": total_chunks,
             "unique_documents": len(unique_docs),
-            "collection_name": "documents"
+            "collection_name": str(collection.name)
         }
         
     except Exception as e:
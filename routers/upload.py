@@ -1,12 +1,9 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Request
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
-from services.parser import parse_document
-from services.chunker import chunk_text
-from rag.embeddings import get_embeddings
-from rag.vector_store import store_documents
-from config import MAX_FILE_SIZE, ALLOWED_EXTENSIONS, ALLOWED_MIME_TYPES, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
-import uuid
+from rag import ingestion
+from lib.admission import AdmissionRejected
+from config import MAX_FILE_SIZE, ALLOWED_EXTENSIONS, ALLOWED_MIME_TYPES
 import logging
 from typing import Dict, Any
 
@@ -14,10 +11,10 @@ logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/api/upload", tags=["upload"])
 limiter = Limiter(key_func=get_remote_address)
 
-@router.post("/document")
+@router.post("/document", status_code=202)
 @limiter.limit("5/minute")
 async def upload_document(request: Request, file: UploadFile = File(...)) -> Dict[str, Any]:
-    """Upload and process document for RAG"""
+    """Accept a document for RAG; it is processed by a background ingestion job"""
     
     logger.info(f"[UPLOAD] Received upload request for file: {file.filename}")
     logger.info(f"[UPLOAD] Content type: {file.content_type}")
@@ -54,63 +51,35 @@ async def upload_document(request: Request, file: UploadFile = File(...)) -> Dic
         if file_size == 0:
             raise HTTPException(status_code=400, detail="File is empty")
         
-        # Reset file pointer for parsing
-        from io import BytesIO
-        file.file = BytesIO(file_content)
-        
-        # 1. Parse document
-        logger.info("[UPLOAD] Parsing document...")
-        content = await parse_document(file)
-        logger.info(f"[UPLOAD] Parsed content length: {len(content)} characters")
-        
-        if not content or len(content.strip()) == 0:
-            raise HTTPException(
-                status_code=400,
-                detail="Document appears to be empty or could not be parsed"
-            )
-        
-        # 2. Chunk text
-        logger.info("[UPLOAD] Chunking text...")
-        chunks = chunk_text(content, chunk_size=DEFAULT_CHUNK_SIZE, overlap=DEFAULT_CHUNK_OVERLAP)
-        logger.info(f"[UPLOAD] Created {len(chunks)} chunks")
-        
-        if not chunks:
-            raise HTTPException(
-                status_code=400,
-                detail="No chunks generated from document"
-            )
-        
-        # 3. Generate embeddings
-        logger.info("[UPLOAD] Generating embeddings...")
-        embeddings = await get_embeddings(chunks)
-        logger.info(f"[UPLOAD] Generated {len(embeddings)} embeddings")
-        
-        # 4. Store in vector DB
-        doc_id = str(uuid.uuid4())
-        logger.info(f"[UPLOAD] Storing document with ID: {doc_id}")
-        await store_documents(
-            doc_id=doc_id,
-            chunks=chunks,
-            embeddings=embeddings,
-            metadata={"filename": file.filename, "file_type": file.content_type}
-        )
-        logger.info(f"[UPLOAD] Document stored successfully. Returning response.")
+        # Parse, chunk, embed and store in the background; the client polls the job
+        job = await ingestion.submit(file.filename, file.content_type, file_content)
+        logger.info(f"[UPLOAD] Queued ingestion job {job['job_id']} for doc_id {job['doc_id']}")
         
         return {
             "success": True,
-            "doc_id": doc_id,
+            "job_id": job["job_id"],
+            "doc_id": job["doc_id"],
             "filename": file.filename,
-            "chunks": len(chunks),
-            "message": f"Document processed successfully. Created {len(chunks)} chunks."
+            "status": job["status"],
+            "status_url": f"/api/upload/jobs/{job['job_id']}",
+            "message": "Document accepted for processing."
         }
         
-    except HTTPException:
+    except (HTTPException, AdmissionRejected):
         raise
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"Error processing document {file.filename}: {error_msg}", exc_info=True)
+        logger.error(f"Error accepting document {file.filename}: {error_msg}", exc_info=True)
         # Include more detail in error message for debugging
         import traceback
         logger.error(f"Full traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error processing document: {error_msg}")
 
+@router.get("/jobs/{job_id}")
+@limiter.limit("60/minute")
+async def get_ingestion_job(request: Request, job_id: str) -> Dict[str, Any]:
+    """Status and per-stage progress of an ingestion job"""
+    job = ingestion.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return ingestion.public_view(job)
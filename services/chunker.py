@@ -1,8 +1,13 @@
-from typing import List
+from typing import List, Tuple
 
 def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[str]:
     """Split text into overlapping chunks"""
     
+    return [text[start:end] for start, end in chunk_spans(text, chunk_size, overlap)]
+
+def chunk_spans(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[Tuple[int, int]]:
+    """Character ranges [start, end) of the chunks chunk_text produces"""
+    
     if not text or len(text.strip()) == 0:
         return []
     
@@ -18,11 +23,10 @@ def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 200) -> List[st
     
     while start < text_length:
         end = start + chunk_size
-        chunk = text[start:end]
         
         # Only add non-empty chunks
-        if chunk.strip():
-            chunks.append(chunk)
+        if text[start:end].strip():
+            chunks.append((start, min(end, text_length)))
         
         # Move start position with overlap
         start = end - overlap
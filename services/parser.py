@@ -7,17 +7,21 @@ async def parse_document(file: UploadFile) -> str:
     """Parse PDF, TXT, or MD file to text"""
     
     content = await file.read()
+    return parse_content(file.filename, content)
+
+def parse_content(filename: str, content: bytes) -> str:
+    """Parse the raw bytes of a PDF, TXT, MD or DOCX file to text (blocking)"""
     
-    if file.filename.endswith('.pdf'):
+    if filename.endswith('.pdf'):
         return parse_pdf(content)
-    elif file.filename.endswith('.md'):
+    elif filename.endswith('.md'):
         return parse_markdown(content)
-    elif file.filename.endswith('.txt'):
+    elif filename.endswith('.txt'):
         return parse_text(content)
-    elif file.filename.endswith('.docx'):
+    elif filename.endswith('.docx'):
         return parse_docx(content)
     else:
-        raise ValueError(f"Unsupported file type: {file.filename}")
+        raise ValueError(f"Unsupported file type: {filename}")
 
 def parse_pdf(content: bytes) -> str:
     """Extract text from PDF"""
@@ -2,7 +2,7 @@
 import pytest
 import os
 from fastapi.testclient import TestClient
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 
 # Set test environment variables
 os.environ["ANTHROPIC_API_KEY"] = "test_anthropic_key"
@@ -13,16 +13,30 @@ os.environ["ALLOWED_ORIGINS"] = "http://localhost:3000"
 def client():
     """Create test client"""
     from main import app
+    from rag import conversations, semantic_cache
+    from routers import chat, documents, upload
+    semantic_cache.clear()
+    conversations.get_store().clear()
+    # Rate-limit windows are per minute; don't let earlier tests' requests count
+    for limiter in (app.state.limiter, chat.limiter, documents.limiter, upload.limiter):
+        limiter.reset()
     return TestClient(app)
 
 @pytest.fixture
 def mock_anthropic_client():
     """Mock Anthropic client"""
+    from lib import retry
+    from rag import answer_cache
+    answer_cache.clear()
+    retry._breakers.pop("claude", None)
     with patch("rag.claude_chain.get_client") as mock:
         mock_client = MagicMock()
         mock_message = MagicMock()
         mock_message.content = [MagicMock(text="Test response")]
-        mock_client.messages.create.return_value = mock_message
+        mock_message.usage = MagicMock(input_tokens=10, output_tokens=5, cache_creation_input_tokens=0, cache_read_input_tokens=0)
+        # Same mock whether or not the prompt-caching beta endpoint is used
+        mock_client.messages.create = AsyncMock(return_value=mock_message)
+        mock_client.beta.prompt_caching.messages = mock_client.messages
         mock.return_value = mock_client
         yield mock_client
 
@@ -60,8 +74,41 @@ def mock_chroma_collection():
         mock.return_value = mock_collection
         yield mock_collection
 
+@pytest.fixture
+def isolated_store(monkeypatch, tmp_path):
+    """Fresh Chroma client, collections, caches and embedding state under a temp directory"""
+    from rag import answer_cache, bm25, chroma_client, embedding_cache, embeddings, ingestion, mmap_store, retrieval_cache, semantic_cache
+    monkeypatch.setenv("CHROMA_DB_PATH", str(tmp_path))
+    monkeypatch.setattr(ingestion, "_store", None)
+    monkeypatch.setattr(ingestion, "_pending", set())
+    monkeypatch.setattr(bm25, "_indexes", {})
+    monkeypatch.setattr(mmap_store, "_collections", {})
+    monkeypatch.setattr(answer_cache, "_store", None)
+    monkeypatch.setattr(chroma_client, "_chroma_client", None)
+    monkeypatch.setattr(chroma_client, "_collections", {})
+    monkeypatch.setattr(embedding_cache, "_memory_cache", None)
+    monkeypatch.setattr(embedding_cache, "_disk_store", None)
+    for name in ("_embedding_model", "_use_openai", "_embedding_identity"):
+        monkeypatch.setattr(embeddings, name, getattr(embeddings, name))
+    retrieval_cache.clear()
+    semantic_cache.clear()
+    yield tmp_path
+    retrieval_cache.clear()
+    if embedding_cache._disk_store is not None:
+        embedding_cache._disk_store.close()
+    if ingestion._store is not None:
+        ingestion._store.close()
 
+@pytest.fixture
+def hash_store(isolated_store):
+    """Isolated store using hash-based embeddings (no API key or model download needed)"""
+    from rag import embeddings
+    embeddings.set_embedding_provider("hash")
+    yield isolated_store
 
-
-
-
+@pytest.fixture
+def mmap_hash_store(hash_store, monkeypatch):
+    """hash_store with the memory-mapped vector backend instead of Chroma"""
+    import config
+    monkeypatch.setattr(config, "VECTOR_BACKEND", "mmap")
+    yield hash_store
@@ -0,0 +1,55 @@
+"""Tests for upstream admission control"""
+import asyncio
+from unittest.mock import AsyncMock, patch
+import pytest
+from lib import metrics
+from lib.admission import AdmissionController, AdmissionRejected
+
+def test_queue_full_is_rejected_immediately():
+    """Beyond max_concurrent + max_queue callers, admission fails at once"""
+    controller = AdmissionController("test_full", max_concurrent=1, max_queue=1, queue_timeout=5)
+    order = []
+
+    async def call(name, hold):
+        async with controller.slot():
+            order.append(name)
+            await asyncio.sleep(hold)
+
+    async def main():
+        first = asyncio.create_task(call("first", 0.1))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(call("second", 0))
+        await asyncio.sleep(0)
+        assert metrics.snapshot()["gauges"]["admission.test_full.queue_depth"] == 1
+        with pytest.raises(AdmissionRejected) as rejected:
+            await call("third", 0)
+        await asyncio.gather(first, second)
+        return rejected.value
+
+    rejected = asyncio.run(main())
+    assert order == ["first", "second"]
+    assert rejected.reason == "queue_full" and rejected.retry_after >= 1
+    assert metrics.snapshot()["summaries"]["admission.test_full.wait_ms"]["max"] >= 50
+
+def test_queue_deadline():
+    """A queued caller gives up after queue_timeout"""
+    controller = AdmissionController("test_deadline", max_concurrent=1, max_queue=10, queue_timeout=0.05)
+
+    async def main():
+        async with controller.slot():
+            with pytest.raises(AdmissionRejected) as rejected:
+                async with controller.slot():
+                    pass
+        assert controller.waiting == 0 and controller.in_flight == 0
+        return rejected.value
+
+    assert asyncio.run(main()).reason == "queue_timeout"
+
+def test_chat_overload_returns_503_with_retry_after(client):
+    chunks = [{"id": "d_0", "text": "Pump manual.", "metadata": {"filename": "d.txt"}, "distance": 0.1, "score": 0.9}]
+    with patch("routers.chat.retrieve_relevant_chunks", return_value=chunks), \
+            patch("routers.chat.semantic_cache.probe", AsyncMock(return_value=None)), \
+            patch("routers.chat.generate_response", AsyncMock(side_effect=AdmissionRejected("claude", "queue_full", 3))):
+        response = client.post("/api/chat/message", json={"message": "How do I reset the pump?"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "3"
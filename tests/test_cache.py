@@ -0,0 +1,74 @@
+"""Tests for cache primitives"""
+from lib.cache import LRUCache, SQLiteStore
+
+def test_lru_evicts_least_recently_used():
+    """Oldest untouched entry is evicted first"""
+    cache = LRUCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+def test_lru_byte_limit():
+    """Byte accounting evicts entries over the byte budget"""
+    cache = LRUCache(max_entries=100, max_bytes=10, sizeof=len)
+    cache.set("a", "12345")
+    cache.set("b", "123456")
+    assert cache.get("a") is None
+    assert cache.total_bytes == 6
+
+def test_sqlite_store_roundtrip(tmp_path):
+    """Values persist across store instances"""
+    path = str(tmp_path / "kv.sqlite3")
+    store = SQLiteStore(path)
+    store.set_many([("k1", b"v1"), ("k2", b"v2")])
+    store.close()
+    reopened = SQLiteStore(path)
+    assert reopened.get_many(["k1", "k2", "k3"]) == {"k1": b"v1", "k2": b"v2"}
+    reopened.close()
+
+def test_answer_stores_invalidate_by_document(tmp_path):
+    """Both answer stores return entries until a contributing document is invalidated"""
+    from rag.answer_cache import MemoryAnswerStore, SQLiteAnswerStore
+    for store in (MemoryAnswerStore(max_entries=10), SQLiteAnswerStore(str(tmp_path / "answers.sqlite3"))):
+        store.set("k1", {"answer": "a1", "sources": []}, ["doc1", "doc2"])
+        store.set("k2", {"answer": "a2", "sources": []}, ["doc3"])
+        assert store.get("k1")["answer"] == "a1"
+        assert store.invalidate_doc("doc2") == 1
+        assert store.get("k1") is None
+        assert store.get("k2")["answer"] == "a2"
+        assert len(store) == 1
+
+def test_generate_response_answer_cache_hit(mock_anthropic_client, isolated_store):
+    """A repeated question over the same context is answered without calling Claude"""
+    import asyncio
+    from rag import answer_cache
+    from rag.claude_chain import generate_response
+    context = [{"id": "doc1_0", "text": "Reset via settings.", "metadata": {"filename": "f.txt", "doc_id": "doc1"}}]
+
+    first = asyncio.run(generate_response("How do I reset?", context))
+    second = asyncio.run(generate_response("  how do I RESET? ", context, conversation_id="c1"))
+    assert mock_anthropic_client.messages.create.call_count == 1
+    assert second["answer"] == first["answer"] and second["sources"] == first["sources"]
+    assert second["conversation_id"] == "c1"
+
+    changed = [{**context[0], "text": "Reset via the admin panel."}]
+    asyncio.run(generate_response("How do I reset?", changed))
+    assert mock_anthropic_client.messages.create.call_count == 2
+
+    answer_cache.invalidate_documents(["doc1"])
+    asyncio.run(generate_response("How do I reset?", context))
+    assert mock_anthropic_client.messages.create.call_count == 3
+
+def test_sqlite_store_purge_drops_expired_and_oldest(tmp_path):
+    """purge_expired deletes expired rows, then the oldest written rows over max_entries"""
+    store = SQLiteStore(str(tmp_path / "kv.sqlite3"), max_entries=2)
+    store.set("expired", b"x", ttl=-1)
+    store.set_many([("k1", b"v1"), ("k2", b"v2"), ("k3", b"v3")], ttl=60)
+    store.set("k1", b"v1'")  # rewriting makes k1 the newest
+    assert store.purge_expired() == 2
+    assert store.get_many(["expired", "k1", "k2", "k3"]) == {"k1": b"v1'", "k3": b"v3"}
+    store.close()
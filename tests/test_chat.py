@@ -42,3 +42,289 @@ def test_chat_message_no_documents(client, mock_anthropic_client):
 
 
 
+
+def test_chat_message_passes_filters(client):
+    """Filters from the request reach retrieval; unknown filter fields are rejected"""
+    with patch("routers.chat.retrieve_relevant_chunks", return_value=[]) as mock_retrieve:
+        response = client.post(
+            "/api/chat/message",
+            json={"message": "Test question", "filters": {"doc_id": ["doc1"], "file_type": ["text/plain"]}}
+        )
+    assert response.status_code == 200
+    assert mock_retrieve.call_args.kwargs["filters"] == {"doc_id": ["doc1"], "file_type": ["text/plain"]}
+
+    response = client.post("/api/chat/message", json={"message": "Test question", "filters": {"author": ["x"]}})
+    assert response.status_code == 422
+
+def test_retrieve_batch_json_and_ndjson(client, hash_store, monkeypatch):
+    """Small batches return JSON; streamed batches return one NDJSON line per query in order"""
+    import asyncio
+    import json
+    from rag.embeddings import get_embeddings
+    from rag.vector_store import store_documents
+    import routers.chat
+    texts = ["pump manual XJ-9000", "error E-1042 overheating"]
+    asyncio.run(store_documents("doc1", texts, asyncio.run(get_embeddings(texts)), {"filename": "doc1.txt"}))
+
+    response = client.post("/api/chat/retrieve/batch", json={"queries": ["XJ-9000", "E-1042"], "top_k": 1})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["chunks"][0]["id"] for result in results] == ["doc1_0", "doc1_1"]
+    assert results[0]["chunks"][0]["distance"] is not None
+
+    monkeypatch.setattr(routers.chat, "RETRIEVE_BATCH_SLICE", 2)
+    queries = ["XJ-9000", "E-1042", "pump", "overheating", "E-1042"]
+    response = client.post("/api/chat/retrieve/batch", json={"queries": queries, "top_k": 1, "stream": True})
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["index"] for line in lines] == list(range(5))
+    assert [line["query"] for line in lines] == queries
+
+    response = client.post("/api/chat/retrieve/batch", json={"queries": ["x"], "mode": "fuzzy"})
+    assert response.status_code == 400
+    assert client.post("/api/chat/retrieve/batch", json={"queries": ["x", "  "]}).status_code == 400
+
+    # Internal errors are server errors, even when they are ValueErrors
+    with patch("routers.chat.retrieve_batch", side_effect=ValueError("dimension mismatch")):
+        assert client.post("/api/chat/retrieve/batch", json={"queries": ["x"]}).status_code == 500
+
+def test_chat_message_off_topic_skips_claude(client, monkeypatch):
+    """When no chunk passes the relevance policy, Claude is not called"""
+    import rag.relevance
+    monkeypatch.setattr(rag.relevance, "RELEVANCE_MIN_SIMILARITY", "0.5")
+    chunks = [{"id": "d_0", "text": "unrelated", "metadata": {}, "distance": 0.9, "score": 0.1}]
+    with patch("routers.chat.retrieve_relevant_chunks", return_value=chunks), \
+            patch("routers.chat.generate_response") as mock_generate:
+        response = client.post("/api/chat/message", json={"message": "What is the weather?"})
+    assert response.status_code == 200
+    assert response.json()["sources"] == []
+    assert "couldn't find anything" in response.json()["response"]
+    mock_generate.assert_not_called()
+
+class _FakeStream:
+    """Stands in for the AsyncMessageStream returned by messages.stream"""
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.exited = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.exited = True
+
+    @property
+    async def text_stream(self):
+        for delta in self.deltas:
+            yield delta
+
+    async def get_final_message(self):
+        from unittest.mock import MagicMock
+        return MagicMock(usage=MagicMock(input_tokens=12, output_tokens=3, cache_creation_input_tokens=0, cache_read_input_tokens=0), stop_reason="end_turn")
+
+def _fake_async_client(stream):
+    from unittest.mock import MagicMock
+    fake = MagicMock()
+    fake.messages.stream.return_value = stream
+    fake.beta.prompt_caching.messages = fake.messages
+    return fake
+
+def test_chat_stream_emits_sources_deltas_usage(client):
+    """SSE events arrive as sources, then text deltas, then usage"""
+    import json
+    chunks = [{"id": "d_0", "text": "pump manual", "metadata": {"filename": "d.txt"}, "distance": 0.1, "score": 0.9}]
+    stream = _FakeStream(["Hello", " world"])
+    with patch("routers.chat.retrieve_relevant_chunks", return_value=chunks), \
+            patch("rag.claude_chain.get_client", return_value=_fake_async_client(stream)):
+        response = client.post("/api/chat/stream", json={"message": "What is the pump?"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        name, data = block.split("\n")
+        events.append((name[len("event: "):], json.loads(data[len("data: "):])))
+    assert [name for name, _ in events] == ["sources", "delta", "delta", "usage"]
+    assert events[0][1]["sources"][0]["filename"] == "d.txt"
+    assert "".join(data["text"] for name, data in events if name == "delta") == "Hello world"
+    assert events[-1][1]["output_tokens"] == 3
+    assert stream.exited
+
+def test_stream_response_closed_early_closes_claude_stream():
+    """Closing the event iterator mid-answer exits the Claude stream and counts a cancellation"""
+    import asyncio
+    from lib import metrics
+    from rag.claude_chain import stream_response
+    stream = _FakeStream(["a", "b", "c"])
+    cancelled = metrics.snapshot()["counters"].get("claude.streams_cancelled", 0)
+
+    async def consume_one_delta():
+        events = stream_response("q", [{"text": "t", "metadata": {}}])
+        assert (await events.__anext__())["event"] == "sources"
+        assert (await events.__anext__())["event"] == "delta"
+        await events.aclose()
+
+    with patch("rag.claude_chain.get_client", return_value=_fake_async_client(stream)):
+        asyncio.run(consume_one_delta())
+    assert stream.exited
+    assert metrics.snapshot()["counters"]["claude.streams_cancelled"] == cancelled + 1
+
+def test_stream_response_errors_are_not_counted_as_cancellations():
+    """An upstream failure counts as a stream error, not a client cancellation"""
+    import asyncio
+    from lib import metrics
+    from rag.claude_chain import stream_response
+    stream = _FakeStream(["a"])
+
+    async def fail():
+        raise ValueError("boom")
+    stream.get_final_message = fail
+    before = metrics.snapshot()["counters"]
+
+    async def consume():
+        return [event async for event in stream_response("q", [{"text": "t", "metadata": {}}])]
+
+    with patch("rag.claude_chain.get_client", return_value=_fake_async_client(stream)):
+        with pytest.raises(ValueError):
+            asyncio.run(consume())
+    after = metrics.snapshot()["counters"]
+    assert after.get("claude.streams_cancelled", 0) == before.get("claude.streams_cancelled", 0)
+    assert after["claude.stream_errors"] == before.get("claude.stream_errors", 0) + 1
+
+def test_stream_response_without_room_for_context_skips_claude():
+    """When no chunk fits the context cap, the budget answer is streamed without a Claude call"""
+    import asyncio
+    from rag.claude_chain import CONTEXT_BUDGET_ANSWER, stream_response
+
+    async def consume():
+        return [event async for event in stream_response("q", [{"text": "t " * 200, "metadata": {}}], max_context_tokens=1)]
+
+    with patch("rag.claude_chain.get_client") as mock_client:
+        events = asyncio.run(consume())
+    mock_client.assert_not_called()
+    assert [event["event"] for event in events] == ["sources", "delta", "usage"]
+    assert events[0]["data"]["sources"] == [] and events[1]["data"]["text"] == CONTEXT_BUDGET_ANSWER
+
+def test_shared_client_pool_and_close(monkeypatch):
+    """One pooled async client is shared until close_client, which closes its connections"""
+    import asyncio
+    from rag import claude_chain
+    monkeypatch.setattr(claude_chain, "_client", None)
+    monkeypatch.setattr(claude_chain, "ANTHROPIC_MAX_CONNECTIONS", 7)
+    client = claude_chain.get_client()
+    assert claude_chain.get_client() is client
+    pool = client._client._transport._pool
+    assert pool._max_connections == 7
+    assert client.max_retries == 0
+
+    asyncio.run(claude_chain.close_client())
+    assert client._client.is_closed
+    assert claude_chain._client is None
+
+def test_generate_response_is_not_bound_by_thread_pool(mock_anthropic_client, monkeypatch):
+    """Concurrent answers await the async client instead of occupying executor threads"""
+    import asyncio
+    import time
+    from lib import admission
+    from rag.claude_chain import generate_response
+    monkeypatch.setitem(admission._controllers, "claude", admission.AdmissionController("claude", 100, 0, 1))
+    message = mock_anthropic_client.messages.create.return_value
+
+    async def slow_create(**kwargs):
+        await asyncio.sleep(0.2)
+        return message
+    mock_anthropic_client.messages.create.side_effect = slow_create
+
+    async def many():
+        context = [{"text": "t", "metadata": {"filename": "f.txt"}}]
+        return await asyncio.gather(*(generate_response("q", context) for _ in range(100)))
+
+    started = time.perf_counter()
+    answers = asyncio.run(many())
+    assert time.perf_counter() - started < 1.0
+    assert all(answer["answer"] == "Test response" for answer in answers)
+    assert mock_anthropic_client.messages.create.call_args.kwargs["timeout"] is not None
+
+def test_chat_semantic_cache_answers_paraphrases(client, monkeypatch):
+    """A close paraphrase reuses the answer; unrelated questions and document changes miss"""
+    from unittest.mock import AsyncMock
+    from rag import retrieval_cache, semantic_cache
+    vectors = {
+        "how do I reset my password": [1.0, 0.0, 0.0],
+        "password reset steps": [0.99, 0.05, 0.0],
+        "what is the refund policy": [0.0, 1.0, 0.0],
+    }
+    monkeypatch.setattr(semantic_cache, "embed_query", AsyncMock(side_effect=lambda text: vectors[text]))
+    monkeypatch.setattr(semantic_cache.chroma_client, "get_chroma_collection", lambda: type("C", (), {"name": "sc_test"})())
+    chunks = [{"id": "d_0", "text": "Use the reset link.", "metadata": {"filename": "d.txt"}, "distance": 0.1, "score": 0.9}]
+    answer = {"answer": "Click the reset link.", "sources": [{"filename": "d.txt"}], "conversation_id": "new"}
+    with patch("routers.chat.retrieve_relevant_chunks", return_value=chunks) as mock_retrieve, \
+            patch("routers.chat.generate_response", AsyncMock(return_value=answer)) as mock_generate:
+        first = client.post("/api/chat/message", json={"message": "how do I reset my password"})
+        second = client.post("/api/chat/message", json={"message": "password reset steps"})
+        assert second.json()["response"] == first.json()["response"] == "Click the reset link."
+        assert second.json()["sources"] == [{"filename": "d.txt"}]
+        assert mock_generate.call_count == 1 and mock_retrieve.call_count == 1
+
+        client.post("/api/chat/message", json={"message": "what is the refund policy"})
+        assert mock_generate.call_count == 2
+
+        retrieval_cache.bump_generation("sc_test")
+        client.post("/api/chat/message", json={"message": "password reset steps"})
+        assert mock_generate.call_count == 3
+
+    # A canned answer (no sources) is not remembered for paraphrases
+    semantic_cache.clear()
+    canned = {"answer": "No room for context.", "sources": [], "conversation_id": "new"}
+    with patch("routers.chat.retrieve_relevant_chunks", return_value=chunks), \
+            patch("routers.chat.generate_response", AsyncMock(return_value=canned)) as mock_generate:
+        client.post("/api/chat/message", json={"message": "how do I reset my password"})
+        client.post("/api/chat/message", json={"message": "password reset steps"})
+        assert mock_generate.call_count == 2
+
+def test_prompt_caching_against_local_messages_stub(monkeypatch):
+    """Requests carry cache breakpoints on system and context; cache usage reaches metrics"""
+    import asyncio
+    import httpx
+    import json
+    from anthropic import AsyncAnthropic
+    from lib import metrics
+    from rag import answer_cache, claude_chain
+    requests = []
+
+    def messages_api(request):
+        body = json.loads(request.content)
+        requests.append((request.headers, body))
+        cached = len(requests) > 1
+        return httpx.Response(200, json={
+            "id": f"msg_{len(requests)}", "type": "message", "role": "assistant", "model": body["model"],
+            "content": [{"type": "text", "text": "Answer [Source 1]"}],
+            "stop_reason": "end_turn", "stop_sequence": None,
+            "usage": {
+                "input_tokens": 20, "output_tokens": 5,
+                "cache_creation_input_tokens": 0 if cached else 1500,
+                "cache_read_input_tokens": 1500 if cached else 0
+            }
+        })
+
+    stub = AsyncAnthropic(
+        api_key="test", base_url="http://stub", max_retries=0,
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(messages_api))
+    )
+    monkeypatch.setattr(claude_chain, "_client", stub)
+    answer_cache.clear()
+    before = metrics.snapshot()["counters"].get("claude.cache_read_input_tokens", 0)
+    context = [{"id": "d_0", "text": "Reset via settings.", "metadata": {"filename": "d.txt", "doc_id": "d"}}]
+
+    asyncio.run(claude_chain.generate_response("How do I reset?", context))
+    asyncio.run(claude_chain.generate_response("And where is settings?", context))
+
+    headers, body = requests[0]
+    assert "prompt-caching" in headers["anthropic-beta"]
+    assert body["system"][0]["cache_control"] == {"type": "ephemeral"}
+    context_block, question_block = body["messages"][0]["content"]
+    assert context_block["cache_control"] == {"type": "ephemeral"} and "Reset via settings." in context_block["text"]
+    assert "cache_control" not in question_block and "How do I reset?" in question_block["text"]
+    # Follow-up over the same chunks sends an identical prefix
+    assert requests[1][1]["system"] == body["system"]
+    assert requests[1][1]["messages"][0]["content"][0] == context_block
+    assert metrics.snapshot()["counters"]["claude.cache_read_input_tokens"] == before + 1500
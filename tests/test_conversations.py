@@ -0,0 +1,55 @@
+"""Tests for conversation memory"""
+from unittest.mock import AsyncMock, patch
+from rag import conversations
+from rag.conversations import ConversationStore, history_text, rewrite_query
+from rag.tokens import estimate_tokens
+
+def test_history_is_capped_and_old_turns_summarized(monkeypatch):
+    """Old turns are folded into one-line summaries; the history stays under the token cap"""
+    monkeypatch.setattr(conversations, "CONVERSATION_RECENT_TURNS", 2)
+    store = ConversationStore(max_entries=10, max_bytes=1_000_000)
+    for i in range(30):
+        conversation = store.add_turn("c1", f"Question {i}? More detail.", f"Answer {i}. " + "filler " * 100)
+
+    assert len(conversation["turns"]) <= 2
+    assert conversation["turns"][-1]["user"] == "Question 29? More detail."
+    assert conversation["summary"][-1].startswith("Q: Question")
+    assert estimate_tokens(history_text(conversation)) <= conversations.CONVERSATION_HISTORY_TOKENS
+    assert store.get("c1") == conversation
+
+def test_store_evicts_by_bytes():
+    """The in-process tier never holds more than max_bytes of conversations"""
+    store = ConversationStore(max_entries=1000, max_bytes=2000)
+    for i in range(50):
+        store.add_turn(f"c{i}", "question " * 20, "answer " * 20)
+    assert store.stats()["bytes"] <= 2000
+    assert store.get("c0") == conversations.empty_conversation()
+    assert store.get("c49")["turns"]
+
+def test_sqlite_backend_survives_memory_eviction(tmp_path):
+    store = ConversationStore(max_entries=1, path=str(tmp_path / "conversations.sqlite3"))
+    store.add_turn("a", "first?", "yes.")
+    store.add_turn("b", "second?", "no.")
+    assert store.get("a")["turns"] == [{"user": "first?", "assistant": "yes."}]
+
+def test_follow_up_queries_are_rewritten():
+    conversation = {"summary": [], "turns": [{"user": "How do I reset the XJ-9000 pump?", "assistant": "..."}]}
+    assert rewrite_query("What about the filter?", conversation) == "How do I reset the XJ-9000 pump? What about the filter?"
+    standalone = "Which documents describe the warranty terms for European customers?"
+    assert rewrite_query(standalone, conversation) == standalone
+    assert rewrite_query("What about it?", None) == "What about it?"
+
+def test_chat_uses_conversation_history(client):
+    """Second turn sends the first turn as history and retrieves with the rewritten query"""
+    chunks = [{"id": "d_0", "text": "Pump manual.", "metadata": {"filename": "d.txt"}, "distance": 0.1, "score": 0.9}]
+    answer = {"answer": "Hold the reset button.", "sources": [], "conversation_id": "conv-1"}
+    with patch("routers.chat.retrieve_relevant_chunks", return_value=chunks) as mock_retrieve, \
+            patch("routers.chat.generate_response", AsyncMock(return_value=answer)) as mock_generate, \
+            patch("routers.chat.semantic_cache.probe", AsyncMock(return_value=None)):
+        client.post("/api/chat/message", json={"message": "How do I reset the pump?", "conversation_id": "conv-1"})
+        assert mock_generate.call_args.kwargs["history"] == ""
+
+        client.post("/api/chat/message", json={"message": "And the filter?", "conversation_id": "conv-1"})
+    history = mock_generate.call_args.kwargs["history"]
+    assert "User: How do I reset the pump?" in history and "Assistant: Hold the reset button." in history
+    assert mock_retrieve.call_args.kwargs["query"] == "How do I reset the pump? And the filter?"
@@ -0,0 +1,152 @@
+"""Tests for embedding generation and the embedding cache"""
+import asyncio
+import numpy as np
+import pytest
+from unittest.mock import patch
+from rag import embeddings, embedding_cache
+from rag.providers import EmbeddingIdentity
+
+@pytest.fixture
+def hash_embeddings(monkeypatch, tmp_path):
+    """Force hash-based embeddings with a fresh, isolated embedding cache"""
+    monkeypatch.setenv("CHROMA_DB_PATH", str(tmp_path))
+    monkeypatch.setattr(embeddings, "_embedding_model", "hash_based")
+    monkeypatch.setattr(embeddings, "_use_openai", False)
+    monkeypatch.setattr(embeddings, "_embedding_identity", EmbeddingIdentity("hash", "shake256-384", 384))
+    monkeypatch.setattr(embedding_cache, "_memory_cache", None)
+    monkeypatch.setattr(embedding_cache, "_disk_store", None)
+    yield
+    if embedding_cache._disk_store is not None:
+        embedding_cache._disk_store.close()
+
+def test_embedding_cache_serves_repeated_texts(hash_embeddings):
+    """Second call for the same texts must not reach the provider"""
+    first = asyncio.run(embeddings.get_embeddings(["alpha", "beta"]))
+    with patch("rag.embeddings.retry_with_backoff") as mock_retry:
+        second = asyncio.run(embeddings.get_embeddings(["beta", "alpha"]))
+        mock_retry.assert_not_called()
+    assert second[0] == pytest.approx(first[1])
+    assert second[1] == pytest.approx(first[0])
+
+def test_embedding_cache_merges_misses_in_order(hash_embeddings):
+    """Only misses are embedded and results keep input order"""
+    cached = asyncio.run(embeddings.get_embeddings(["alpha"]))[0]
+    result = asyncio.run(embeddings.get_embeddings(["gamma", "alpha", "gamma"]))
+    assert len(result) == 3
+    assert result[1] == pytest.approx(cached)
+    assert np.array_equal(result[0], result[2])
+    stats = embedding_cache.get_cache_stats()
+    assert stats["hits_memory"] >= 1
+
+def test_get_embeddings_returns_float32_matrix(hash_embeddings):
+    """Embeddings travel as one contiguous float32 matrix"""
+    result = asyncio.run(embeddings.get_embeddings(["one", "two", "three"]))
+    assert isinstance(result, np.ndarray)
+    assert result.dtype == np.float32
+    assert result.shape == (3, 384)
+    assert result.flags["C_CONTIGUOUS"]
+
+def test_embedding_cache_quantized_storage(hash_embeddings, monkeypatch):
+    """Quantized cache tiers return close float32 vectors at a fraction of the size"""
+    monkeypatch.setattr(embedding_cache, "EMBEDDING_STORAGE_DTYPE", "int8")
+    first = asyncio.run(embeddings.get_embeddings(["quantized text"]))
+    second = asyncio.run(embeddings.get_embeddings(["quantized text"]))
+    assert second.dtype == np.float32
+    assert np.allclose(second, first, atol=np.abs(first).max() / 127)
+    assert embedding_cache.get_cache_stats()["memory_bytes"] == 4 + 384
+
+def test_embedding_cache_disk_tier(hash_embeddings):
+    """Embeddings survive a cleared memory tier via the on-disk store"""
+    first = asyncio.run(embeddings.get_embeddings(["persisted text"]))
+    embedding_cache.clear()
+    before = embedding_cache.get_cache_stats()["hits_disk"]
+    second = asyncio.run(embeddings.get_embeddings(["persisted text"]))
+    assert second[0] == pytest.approx(first[0], abs=1e-6)
+    assert embedding_cache.get_cache_stats()["hits_disk"] == before + 1
+
+def _legacy_hash_embedding(text):
+    """Reference copy of the original per-dimension hash embedding"""
+    import hashlib
+    import struct
+    hash_bytes = hashlib.sha256(text.encode('utf-8')).digest()
+    embedding = []
+    for i in range(0, len(hash_bytes), 4):
+        val = struct.unpack('>f', hash_bytes[i:i+4])[0]
+        embedding.append(max(-1.0, min(1.0, val)))
+    while len(embedding) < 384:
+        pad_hash = hashlib.sha256((text + str(len(embedding))).encode()).digest()
+        pad_val = struct.unpack('>f', pad_hash[:4])[0]
+        embedding.append(max(-1.0, min(1.0, pad_val)))
+    return embedding
+
+def test_hash_embeddings_compat_matches_legacy():
+    """Compat mode reproduces the original vectors exactly"""
+    from rag.hash_embeddings import hash_embeddings
+    texts = ["", "hello world", "zażółć gęślą jaźń", "x" * 5000] + [f"chunk {i}" for i in range(50)]
+    matrix = hash_embeddings(texts, mode="compat")
+    assert matrix.shape == (len(texts), 384)
+    for row, text in zip(matrix, texts):
+        assert row.tolist() == _legacy_hash_embedding(text)
+
+def test_hash_embeddings_fast_mode():
+    """Fast mode is deterministic, finite and unit-normalized"""
+    import numpy as np
+    from rag.hash_embeddings import hash_embeddings
+    matrix = hash_embeddings(["a", "b", "a"], mode="fast")
+    assert matrix.dtype == np.float32
+    assert np.isfinite(matrix).all()
+    assert np.allclose(np.linalg.norm(matrix, axis=1), 1.0, atol=1e-5)
+    assert np.array_equal(matrix[0], matrix[2])
+    assert not np.array_equal(matrix[0], matrix[1])
+
+def test_iter_embeddings_yields_every_sub_batch(hash_embeddings):
+    """Large inputs are split into sub-batches that cover every text once"""
+    texts = [f"text {i}" for i in range(10)]
+
+    async def collect():
+        return [item async for item in embeddings.iter_embeddings(texts, batch_size=3)]
+
+    batches = asyncio.run(collect())
+    assert sorted(start for start, _ in batches) == [0, 3, 6, 9]
+    merged = {}
+    for start, vectors in batches:
+        for offset, vector in enumerate(vectors):
+            merged[start + offset] = vector
+    expected = asyncio.run(embeddings.get_embeddings(texts))
+    assert np.array_equal(np.stack([merged[i] for i in range(10)]), expected)
+
+def test_get_embeddings_splits_large_inputs(hash_embeddings, monkeypatch):
+    """get_embeddings sends provider-sized sub-batches and keeps input order"""
+    monkeypatch.setattr(embeddings, "EMBEDDING_BATCH_SIZE", 4)
+    sizes = []
+    real_embed_sync = embeddings._embed_sync
+
+    def recording_embed_sync(model, use_openai, texts):
+        sizes.append(len(texts))
+        return real_embed_sync(model, use_openai, texts)
+
+    monkeypatch.setattr(embeddings, "_embed_sync", recording_embed_sync)
+    texts = [f"doc chunk {i}" for i in range(10)]
+    result = asyncio.run(embeddings.get_embeddings(texts))
+    assert sorted(sizes) == [2, 4, 4]
+    from rag.hash_embeddings import hash_embeddings as reference
+    assert np.array_equal(result[7], reference([texts[7]])[0])
+
+def test_worker_results_travel_through_shared_memory(monkeypatch):
+    """Worker output is handed over as a float32 shared memory segment"""
+    import numpy as np
+    from multiprocessing import shared_memory
+    from rag import embedding_workers
+
+    class FakeModel:
+        def encode(self, texts, convert_to_numpy=True, show_progress_bar=False):
+            return np.arange(len(texts) * 4, dtype=np.float64).reshape(len(texts), 4)
+
+    monkeypatch.setattr(embedding_workers, "_worker_model", FakeModel())
+    name, shape = embedding_workers._encode_to_shared_memory(["a", "b", "c"])
+    matrix = embedding_workers._read_shared_array(name, shape)
+    assert matrix.dtype == np.float32
+    assert matrix.shape == (3, 4)
+    assert matrix[2].tolist() == [8.0, 9.0, 10.0, 11.0]
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
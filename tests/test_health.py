@@ -22,3 +22,43 @@ def test_health_endpoint(client):
 
 
 
+
+def test_ready_endpoint_before_warmup(client):
+    """Readiness reports 503 until components are warm"""
+    from rag import warmup
+    warmup._reset_state()
+    response = client.get("/ready")
+    assert response.status_code == 503
+    data = response.json()
+    assert data["status"] == "not_ready"
+    assert data["components"]["embeddings"]["status"] == "pending"
+
+def test_ready_endpoint_after_warmup(client):
+    """Readiness reports 200 with per-component timings once warm-up succeeds"""
+    import asyncio
+    from unittest.mock import patch, AsyncMock
+    from rag import warmup
+    with patch("rag.warmup._warm_embeddings", AsyncMock(return_value=[0.1] * 384)), \
+         patch("rag.warmup._warm_chroma", AsyncMock(return_value=None)), \
+         patch("rag.warmup._warm_anthropic", AsyncMock(return_value=None)):
+        asyncio.run(warmup.run_warmup())
+    response = client.get("/ready")
+    assert response.status_code == 200
+    components = response.json()["components"]
+    assert all(component["status"] == "ready" for component in components.values())
+    assert "duration_ms" in components["chroma"]
+    warmup._reset_state()
+
+def test_ready_endpoint_reports_failed_component(client):
+    """A failing component keeps the pod out of rotation and reports its error"""
+    import asyncio
+    from unittest.mock import patch, AsyncMock
+    from rag import warmup
+    with patch("rag.warmup._warm_embeddings", AsyncMock(return_value=[0.1] * 384)), \
+         patch("rag.warmup._warm_chroma", AsyncMock(side_effect=RuntimeError("index corrupt"))), \
+         patch("rag.warmup._warm_anthropic", AsyncMock(return_value=None)):
+        asyncio.run(warmup.run_warmup())
+    response = client.get("/ready")
+    assert response.status_code == 503
+    assert response.json()["components"]["chroma"]["error"] == "index corrupt"
+    warmup._reset_state()
@@ -0,0 +1,78 @@
+"""Tests for background ingestion jobs"""
+import asyncio
+import os
+from rag import ingestion
+from rag.chroma_client import get_chroma_collection
+
+MANUAL = b"The pump has a reset button on the left side. " * 80
+
+def test_upload_returns_202_and_job_reports_progress(client, hash_store):
+    """Upload only queues the job; the job endpoint reports it through to success"""
+    response = client.post("/api/upload/document", files={"file": ("manual.txt", MANUAL, "text/plain")})
+    assert response.status_code == 202
+    body = response.json()
+    assert body["status"] == "queued" and body["status_url"] == f"/api/upload/jobs/{body['job_id']}"
+
+    queued = client.get(body["status_url"]).json()
+    assert queued["status"] == "queued" and queued["progress"] == 0 and "path" not in queued
+
+    asyncio.run(ingestion.process_job(body["job_id"]))
+    job = client.get(body["status_url"]).json()
+    assert job["status"] == "succeeded" and job["progress"] == 1.0
+    assert all(stage["status"] == "done" for stage in job["stages"].values())
+    assert job["stages"]["store"]["done"] == job["chunks"] > 1
+    stored = get_chroma_collection().get(where={"doc_id": body["doc_id"]})
+    assert len(stored["ids"]) == job["chunks"]
+    assert not os.listdir(hash_store / "uploads")
+
+def test_unknown_job_is_404(client, hash_store):
+    assert client.get("/api/upload/jobs/missing").status_code == 404
+
+def test_interrupted_job_resumes_on_start(hash_store):
+    """A job left running by a restart is started over without duplicate chunks"""
+    async def main():
+        job = await ingestion.submit("manual.txt", "text/plain", MANUAL)
+        # Simulate a previous process that died mid-job
+        job["status"] = "running"
+        ingestion.get_store().put_job(job)
+        ingestion._pending.clear()
+        resumed = await ingestion.start()
+        await ingestion._queue.join()
+        await ingestion.stop()
+        return resumed, ingestion.get_job(job["job_id"])
+
+    resumed, job = asyncio.run(main())
+    assert resumed == 1
+    assert job["status"] == "succeeded" and job["attempts"] == 1
+    assert len(get_chroma_collection().get(where={"doc_id": job["doc_id"]})["ids"]) == job["chunks"]
+
+def test_unparseable_document_fails_job(hash_store):
+    async def main():
+        job = await ingestion.submit("blank.txt", "text/plain", b"   \n  ")
+        return await ingestion.process_job(job["job_id"])
+
+    job = asyncio.run(main())
+    assert job["status"] == "failed" and job["stage"] == "parse"
+    assert "empty" in job["error"]
+    assert not os.path.exists(job["path"])
+
+def test_failed_resume_cleanup_is_retried_then_fails_job(hash_store, monkeypatch):
+    """A job whose partial chunks cannot be removed is retried, then failed, and never stays pending"""
+    async def broken_remove(doc_id):
+        raise ConnectionError("vector store unavailable")
+
+    async def main():
+        job = await ingestion.submit("manual.txt", "text/plain", MANUAL)
+        job["status"] = "running"
+        ingestion.get_store().put_job(job)
+        monkeypatch.setattr(ingestion, "remove_document", broken_remove)
+        first = await ingestion.process_job(job["job_id"])
+        assert first["status"] == "running" and "unavailable" in first["error"]
+        assert job["job_id"] in ingestion._pending
+        monkeypatch.setattr(ingestion, "INGESTION_MAX_ATTEMPTS", 2)
+        return await ingestion.process_job(job["job_id"])
+
+    job = asyncio.run(main())
+    assert job["status"] == "failed" and job["attempts"] == 2
+    assert job["job_id"] not in ingestion._pending
+    assert not os.path.exists(job["path"])
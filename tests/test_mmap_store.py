@@ -0,0 +1,143 @@
+"""Tests for the memory-mapped exact-search vector backend"""
+import asyncio
+import numpy as np
+import pytest
+from rag import mmap_store
+from rag.mmap_store import MmapCollection
+
+def _vectors(n, dim=16, seed=0):
+    return np.random.default_rng(seed).standard_normal((n, dim)).astype(np.float32)
+
+def _add(collection, vectors, start=0, doc_id="doc1"):
+    ids = [f"{doc_id}_{i}" for i in range(start, start + len(vectors))]
+    collection.add(
+        ids=ids,
+        embeddings=vectors,
+        documents=[f"text {i}" for i in range(start, start + len(vectors))],
+        metadatas=[{"doc_id": doc_id, "chunk_id": i} for i in range(start, start + len(vectors))]
+    )
+    return ids
+
+def test_query_matches_brute_force_across_blocks(tmp_path, monkeypatch):
+    """Blocked top-k returns exactly the brute-force cosine ranking"""
+    monkeypatch.setattr(mmap_store, "MMAP_SEARCH_BLOCK_ROWS", 7)
+    collection = MmapCollection(str(tmp_path), "test")
+    vectors = _vectors(50)
+    ids = _add(collection, vectors[:30])
+    ids += _add(collection, vectors[30:], start=30)
+    queries = _vectors(3, seed=1)
+
+    results = collection.query(query_embeddings=queries, n_results=5)
+
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    scores = (queries / np.linalg.norm(queries, axis=1, keepdims=True)) @ normalized.T
+    for q in range(3):
+        expected = np.argsort(-scores[q])[:5]
+        assert results["ids"][q] == [ids[i] for i in expected]
+        assert np.allclose(results["distances"][q], 1 - scores[q][expected], atol=1e-5)
+    assert results["documents"][0][0] == f"text {np.argsort(-scores[0])[0]}"
+
+def test_where_filter_and_delete(tmp_path):
+    """where clauses restrict the search; deleted rows are never returned"""
+    collection = MmapCollection(str(tmp_path), "test")
+    _add(collection, _vectors(10), doc_id="a")
+    _add(collection, _vectors(10, seed=2), doc_id="b")
+    query = _vectors(1, seed=3)
+
+    results = collection.query(query_embeddings=query, n_results=20, where={"doc_id": "b"})
+    assert len(results["ids"][0]) == 10 and all(i.startswith("b_") for i in results["ids"][0])
+
+    collection.delete(where={"doc_id": "b"})
+    collection.delete(ids=["a_0"])
+    assert collection.count() == 9
+    assert "a_0" not in collection.query(query_embeddings=query, n_results=20)["ids"][0]
+    assert collection.get(where={"doc_id": {"$in": ["a", "b"]}}, limit=3, offset=1)["ids"] == ["a_2", "a_3", "a_4"]
+
+def test_persistence_tombstones_and_compaction(tmp_path, monkeypatch):
+    """Data and deletes survive a reload; compaction drops dead rows and keeps results"""
+    monkeypatch.setattr(mmap_store, "MMAP_COMPACTION_RATIO", 1.0)  # compact explicitly below
+    collection = MmapCollection(str(tmp_path), "test", {"hnsw:space": "cosine"})
+    vectors = _vectors(20)
+    _add(collection, vectors)
+    collection.delete(ids=[f"doc1_{i}" for i in range(0, 20, 2)])
+    query = _vectors(1, seed=4)
+    before = collection.query(query_embeddings=query, n_results=5)
+
+    reloaded = MmapCollection(str(tmp_path), "test")
+    assert reloaded.count() == 10
+    assert reloaded.metadata == {"hnsw:space": "cosine"}
+    assert reloaded.query(query_embeddings=query, n_results=5)["ids"] == before["ids"]
+
+    reloaded.compact()
+    assert len(reloaded._rows) == 10
+    assert reloaded.query(query_embeddings=query, n_results=5)["ids"] == before["ids"]
+    assert MmapCollection(str(tmp_path), "test").get(ids=["doc1_1"])["documents"] == ["text 1"]
+
+def test_interrupted_write_is_truncated(tmp_path):
+    """Bytes written after the last committed record are discarded on load"""
+    collection = MmapCollection(str(tmp_path), "test")
+    _add(collection, _vectors(3))
+    with open(collection._path(0, "vectors.bin"), "ab") as f:
+        f.write(b"\x00" * 64)
+    with open(collection._path(0, "records.jsonl"), "a") as f:
+        f.write('{"id": "torn"')
+
+    reloaded = MmapCollection(str(tmp_path), "test")
+    assert reloaded.count() == 3
+    _add(reloaded, _vectors(1, seed=5), start=3)
+    assert reloaded.get(ids=["doc1_3"], include=["embeddings"])["embeddings"].shape == (1, 16)
+
+def test_int8_storage(tmp_path, monkeypatch):
+    """Quantized storage returns nearly the float32 ranking"""
+    monkeypatch.setattr(mmap_store, "EMBEDDING_STORAGE_DTYPE", "int8")
+    collection = MmapCollection(str(tmp_path), "test")
+    vectors = _vectors(30)
+    ids = _add(collection, vectors)
+    results = collection.query(query_embeddings=vectors[7:8], n_results=1)
+    assert results["ids"][0] == [ids[7]]
+    assert results["distances"][0][0] < 1e-3
+
+def test_upsert_replaces_rows(tmp_path):
+    """upsert tombstones the old row of an id and appends the new one"""
+    collection = MmapCollection(str(tmp_path), "test")
+    _add(collection, _vectors(2))
+    collection.upsert(ids=["doc1_0"], embeddings=_vectors(1, seed=6), documents=["new"], metadatas=[{"doc_id": "doc1"}])
+    assert collection.count() == 2
+    assert collection.get(ids=["doc1_0"])["documents"] == ["new"]
+
+def test_upsert_survives_reload(tmp_path):
+    """After a reload, an upserted id still maps to its live row"""
+    collection = MmapCollection(str(tmp_path), "test")
+    _add(collection, _vectors(2))
+    collection.upsert(ids=["doc1_0"], embeddings=_vectors(1, seed=6), documents=["new"], metadatas=[{"doc_id": "doc1"}])
+
+    reloaded = MmapCollection(str(tmp_path), "test")
+    assert reloaded.get(ids=["doc1_0"])["documents"] == ["new"]
+    reloaded.add(ids=["doc1_0"], embeddings=_vectors(1, seed=7), documents=["dup"], metadatas=[{"doc_id": "doc1"}])
+    assert reloaded.count() == 2
+    reloaded.delete(ids=["doc1_0"])
+    assert reloaded.get(ids=["doc1_0"])["ids"] == [] and reloaded.count() == 1
+
+def test_dimension_mismatch_is_rejected(tmp_path):
+    collection = MmapCollection(str(tmp_path), "test")
+    _add(collection, _vectors(2))
+    with pytest.raises(ValueError):
+        _add(collection, _vectors(2, dim=8), start=2)
+
+@pytest.mark.parametrize("mode", ["dense", "hybrid"])
+def test_retrieval_with_mmap_backend(mmap_hash_store, mode):
+    """The service's store/retrieve/remove path works unchanged on the mmap backend"""
+    from rag.chroma_client import get_chroma_collection
+    from rag.embeddings import get_embeddings
+    from rag.retriever import retrieve_relevant_chunks
+    from rag.vector_store import remove_document, store_documents
+    texts = ["fault code E-1042 on the XJ-9000 pump", "cleaning instructions"]
+    asyncio.run(store_documents("doc1", texts, asyncio.run(get_embeddings(texts)), {"filename": "doc1.txt"}))
+    assert isinstance(get_chroma_collection(), MmapCollection)
+
+    chunks = asyncio.run(retrieve_relevant_chunks("E-1042", top_k=1, mode=mode))
+    assert chunks[0]["id"] == "doc1_0"
+    assert chunks[0]["metadata"]["filename"] == "doc1.txt"
+
+    asyncio.run(remove_document("doc1"))
+    assert asyncio.run(retrieve_relevant_chunks("E-1042", top_k=1, mode=mode)) == []
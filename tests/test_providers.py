@@ -0,0 +1,61 @@
+"""Tests for the embedding provider registry and collection migration"""
+import asyncio
+import numpy as np
+import pytest
+from rag import chroma_client, embeddings, migrate
+from rag.providers import EmbeddingIdentity, create_provider, ProviderUnavailable
+
+def test_collection_name_from_identity():
+    """Collection names encode provider, model and dimension within Chroma's limits"""
+    identity = EmbeddingIdentity("openai", "text-embedding-3-small", 1536)
+    assert identity.collection_name == "documents_openai_text-embedding-3-small_1536"
+    long_name = EmbeddingIdentity("custom", "org/" + "m" * 80, 768).collection_name
+    assert len(long_name) <= 63
+    assert "/" not in long_name
+
+def test_openai_provider_requires_key(monkeypatch):
+    """An unavailable provider raises instead of silently falling back"""
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    with pytest.raises(ProviderUnavailable):
+        create_provider("openai")
+    with pytest.raises(ValueError):
+        create_provider("does-not-exist")
+
+def test_explicit_provider_does_not_fall_back(isolated_store, monkeypatch):
+    """EMBEDDING_PROVIDER pins the provider; failure is an error"""
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setattr(embeddings, "EMBEDDING_PROVIDER", "openai")
+    monkeypatch.setattr(embeddings, "_embedding_model", None)
+    with pytest.raises(ProviderUnavailable):
+        embeddings.get_embedding_identity()
+
+def test_collections_are_separated_by_identity(isolated_store):
+    """Queries and writes go to the active provider's collection"""
+    embeddings.set_embedding_provider("hash")
+    collection = chroma_client.get_chroma_collection()
+    assert collection.name == embeddings.get_embedding_identity().collection_name
+    assert collection.metadata["embedding_dimension"] == 384
+
+def test_migrate_collection(isolated_store):
+    """Migration re-embeds every chunk into the target collection and is resumable"""
+    legacy = chroma_client.get_chroma_collection(chroma_client.LEGACY_COLLECTION_NAME)
+    texts = [f"legacy chunk {i}" for i in range(7)]
+    legacy.add(
+        ids=[f"doc_{i}" for i in range(7)],
+        documents=texts,
+        embeddings=np.ones((7, 384), dtype=np.float32),
+        metadatas=[{"doc_id": "doc", "chunk_id": i} for i in range(7)]
+    )
+
+    result = asyncio.run(migrate.migrate_collection("documents", "hash", batch_size=3, delay=0))
+    assert result["migrated"] == 7
+    target = chroma_client.get_chroma_collection()
+    stored = target.get(ids=["doc_4"], include=["documents", "embeddings", "metadatas"])
+    assert stored["documents"] == ["legacy chunk 4"]
+    assert stored["metadatas"][0]["chunk_id"] == 4
+    expected = asyncio.run(embeddings.get_embeddings(["legacy chunk 4"]))[0]
+    assert np.allclose(stored["embeddings"][0], expected, atol=1e-6)
+
+    again = asyncio.run(migrate.migrate_collection("documents", "hash", batch_size=3, delay=0))
+    assert again["migrated"] == 0
+    assert again["skipped"] == 7
@@ -0,0 +1,26 @@
+"""Tests for compact vector encodings"""
+import numpy as np
+import pytest
+from rag.quantization import encode_vectors, decode_vectors, to_bytes, from_bytes
+
+@pytest.mark.parametrize("dtype,atol", [("float32", 0.0), ("float16", 1e-3), ("int8", 1e-2)])
+def test_encode_decode_roundtrip(dtype, atol):
+    """Decoded vectors stay within the encoding's precision"""
+    rng = np.random.default_rng(0)
+    matrix = rng.standard_normal((20, 64)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    data, scales = encode_vectors(matrix, dtype)
+    decoded = decode_vectors(data, scales)
+    assert decoded.dtype == np.float32
+    assert np.allclose(decoded, matrix, atol=atol)
+
+def test_int8_zero_vector():
+    """All-zero vectors survive int8 encoding"""
+    blob = to_bytes(np.zeros(8, dtype=np.float32), "int8")
+    assert len(blob) == 4 + 8
+    assert not from_bytes(blob, "int8").any()
+
+def test_unknown_dtype():
+    """Unknown encodings are rejected"""
+    with pytest.raises(ValueError):
+        encode_vectors(np.zeros((1, 4), dtype=np.float32), "bfloat16")
@@ -11,12 +11,12 @@ def test_rate_limiting_upload(client):
             files={"file": ("test.txt", b"test content", "text/plain")}
         )
         if i < 5:
-            # First 5 should work (or fail validation, but not rate limit)
-            assert response.status_code in [200, 400, 422]
+            # First 5 should be accepted for ingestion (or fail validation, but not rate limit)
+            assert response.status_code in [202, 400, 422]
         else:
             # 6th request might be rate limited
             # Note: Rate limiting might not trigger in test environment
-            assert response.status_code in [200, 400, 422, 429]
+            assert response.status_code in [202, 400, 422, 429]
 
 def test_rate_limiting_chat(client):
     """Test rate limiting on chat endpoint"""
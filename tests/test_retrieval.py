@@ -0,0 +1,334 @@
+"""Tests for query embedding and retrieval"""
+import asyncio
+import pytest
+from unittest.mock import patch
+from rag import query_batcher
+
+def test_query_batcher_coalesces_concurrent_queries():
+    """Concurrent queries share one get_embeddings call and get their own vectors"""
+    calls = []
+
+    async def fake_get_embeddings(texts):
+        calls.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+    async def run():
+        return await asyncio.gather(*(query_batcher.embed_query("q" * n) for n in range(1, 6)))
+
+    with patch("rag.embeddings.get_embeddings", side_effect=fake_get_embeddings):
+        results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert results == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+
+def test_query_batcher_respects_max_batch_size():
+    """Batches are flushed as soon as they reach the maximum size"""
+    calls = []
+
+    async def fake_get_embeddings(texts):
+        calls.append(len(texts))
+        return [[0.0] for _ in texts]
+
+    async def run():
+        batcher = query_batcher.QueryEmbeddingBatcher(asyncio.get_running_loop(), window=0.05, max_batch_size=2)
+        return await asyncio.gather(*(batcher.embed(str(i)) for i in range(5)))
+
+    with patch("rag.embeddings.get_embeddings", side_effect=fake_get_embeddings):
+        asyncio.run(run())
+
+    assert calls == [2, 2, 1]
+
+def test_query_batcher_propagates_errors():
+    """A failed batch fails every waiting query"""
+    async def failing_get_embeddings(texts):
+        raise RuntimeError("provider down")
+
+    async def run():
+        return await asyncio.gather(
+            query_batcher.embed_query("a"), query_batcher.embed_query("b"), return_exceptions=True
+        )
+
+    with patch("rag.embeddings.get_embeddings", side_effect=failing_get_embeddings):
+        results = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+def _store(doc_id, texts):
+    from rag.embeddings import get_embeddings
+    from rag.vector_store import store_documents
+    vectors = asyncio.run(get_embeddings(texts))
+    asyncio.run(store_documents(doc_id, texts, vectors, {"filename": f"{doc_id}.txt"}))
+
+def test_retrieval_cache_serves_repeated_queries(hash_store):
+    """Identical (normalized) queries skip embedding and the vector search"""
+    from rag.retriever import retrieve_relevant_chunks
+    _store("doc1", ["alpha text", "beta text"])
+    first = asyncio.run(retrieve_relevant_chunks("Alpha text", top_k=2))
+    with patch("rag.retriever.embed_query") as mock_embed:
+        second = asyncio.run(retrieve_relevant_chunks("  alpha   TEXT ", top_k=2))
+        mock_embed.assert_not_called()
+    assert second == first
+
+def test_retrieval_cache_invalidated_by_writes(hash_store):
+    """Uploads and deletes bump the generation so stale results are never served"""
+    from rag.retriever import retrieve_relevant_chunks
+    from rag.vector_store import remove_document
+    _store("doc1", ["alpha text"])
+    assert len(asyncio.run(retrieve_relevant_chunks("alpha text", top_k=5))) == 1
+
+    _store("doc2", ["alpha text again"])
+    assert len(asyncio.run(retrieve_relevant_chunks("alpha text", top_k=5))) == 2
+
+    asyncio.run(remove_document("doc1"))
+    chunks = asyncio.run(retrieve_relevant_chunks("alpha text", top_k=5))
+    assert [chunk["metadata"]["doc_id"] for chunk in chunks] == ["doc2"]
+
+def test_retrieval_cache_ignores_results_from_older_generation():
+    """A result computed before a write is not cached under the new generation"""
+    from rag import retrieval_cache
+    generation = retrieval_cache.get_generation("test-collection")
+    retrieval_cache.bump_generation("test-collection")
+    retrieval_cache.store("test-collection", "q", 5, None, [{"text": "old"}], generation)
+    assert retrieval_cache.lookup("test-collection", "q", 5) is None
+
+def test_bm25_tokenizer_keeps_compound_tokens():
+    """Part numbers are indexed whole and by their parts"""
+    from rag.bm25 import tokenize
+    assert tokenize("Error E-1042 on XJ-9000") == ["error", "e-1042", "e", "1042", "on", "xj-9000", "xj", "9000"]
+
+def test_bm25_index_incremental_and_persisted(tmp_path):
+    """Adds and removes are reflected in search and survive a reload"""
+    from rag.bm25 import BM25Index
+    index = BM25Index(str(tmp_path))
+    index.add_chunks("doc1", ["doc1_0", "doc1_1"], ["pump model XJ-9000 manual", "general safety notes"])
+    index.add_chunks("doc2", ["doc2_0"], ["replacement filter for pump"])
+    assert index.search("XJ-9000", 5)[0][0] == "doc1_0"
+
+    index.remove_document("doc1")
+    assert index.search("XJ-9000", 5) == []
+    reloaded = BM25Index(str(tmp_path))
+    assert len(reloaded) == 1
+    assert [chunk_id for chunk_id, _ in reloaded.search("pump", 5)] == ["doc2_0"]
+
+def test_reciprocal_rank_fusion_prefers_agreement():
+    """Items ranked by both lists outrank items ranked by one"""
+    from rag.retriever import reciprocal_rank_fusion
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "b", "d"]])
+    assert [item_id for item_id, _ in fused] == ["c", "b", "a", "d"]
+
+def test_hybrid_retrieval_finds_exact_keywords(hash_store):
+    """With hash embeddings, hybrid mode still surfaces the chunk containing the part number"""
+    from rag.retriever import retrieve_relevant_chunks
+    _store("doc1", [f"filler paragraph number {i} about maintenance" for i in range(30)])
+    _store("doc2", ["fault code E-1042 means the XJ-9000 pump overheated"])
+    chunks = asyncio.run(retrieve_relevant_chunks("what does E-1042 mean", top_k=3, mode="hybrid"))
+    assert chunks[0]["id"] == "doc2_0"
+    assert chunks[0]["text"].startswith("fault code E-1042")
+
+def test_bm25_bootstraps_before_first_incremental_write(hash_store):
+    """Chunks stored before the lexical index existed are indexed when the next upload arrives"""
+    from rag import bm25
+    from rag.chroma_client import get_chroma_collection
+    from rag.embeddings import get_embeddings
+    collection = get_chroma_collection()
+    old_text = "the XJ-9000 pump needs a new seal"
+    collection.add(
+        ids=["old_0"], documents=[old_text], embeddings=asyncio.run(get_embeddings([old_text])),
+        metadatas=[{"doc_id": "old", "chunk_id": 0}]
+    )
+    _store("new", ["unrelated maintenance notes"])
+    index = bm25.get_bm25_index(collection.name)
+    assert len(index) == 2
+    assert [chunk_id for chunk_id, _ in index.search("XJ-9000", 5)] == ["old_0"]
+    bm25.reset()
+    assert bm25.get_bm25_index(collection.name).bootstrapped
+
+def test_hybrid_index_follows_deletes(hash_store):
+    """Deleted documents disappear from the lexical index too"""
+    from rag import bm25
+    from rag.chroma_client import get_chroma_collection
+    from rag.retriever import retrieve_relevant_chunks
+    from rag.vector_store import remove_document
+    _store("doc1", ["fault code E-1042 explained"])
+    _store("doc2", ["other content"])
+    asyncio.run(remove_document("doc1"))
+    assert bm25.get_bm25_index(get_chroma_collection().name).search("E-1042", 5) == []
+    chunks = asyncio.run(retrieve_relevant_chunks("E-1042", top_k=3, mode="hybrid"))
+    assert all(chunk["id"] != "doc1_0" for chunk in chunks)
+
+def test_mmr_order_skips_near_duplicates():
+    """A near-duplicate of the first pick loses to a less relevant but distinct candidate"""
+    import numpy as np
+    from rag.diversify import mmr_order
+    vectors = np.array([[1.0, 0.0], [0.99, 0.01], [0.0, 1.0]])
+    relevance = np.array([0.9, 0.89, 0.5])
+    assert mmr_order(relevance, vectors, 2, lambda_mult=0.5) == [0, 2]
+    assert mmr_order(relevance, vectors, 3, lambda_mult=1.0) == [0, 1, 2]
+
+def test_merge_overlapping_chunks_of_same_document():
+    """Overlapping ranges of one document become a single chunk; other documents are untouched"""
+    from rag.diversify import merge_overlapping
+    text = "0123456789" * 3
+    chunks = [
+        {"id": "d_1", "text": text[8:20], "metadata": {"doc_id": "d", "char_start": 8, "char_end": 20}},
+        {"id": "e_0", "text": text[0:10], "metadata": {"doc_id": "e", "char_start": 0, "char_end": 10}},
+        {"id": "d_0", "text": text[0:10], "metadata": {"doc_id": "d", "char_start": 0, "char_end": 10}},
+        {"id": "d_2", "text": text[12:18], "metadata": {"doc_id": "d", "char_start": 12, "char_end": 18}},
+    ]
+    merged = merge_overlapping(chunks)
+    assert [chunk["id"] for chunk in merged] == ["d_1", "e_0"]
+    assert merged[0]["text"] == text[0:20]
+    assert (merged[0]["metadata"]["char_start"], merged[0]["metadata"]["char_end"]) == (0, 20)
+
+def test_retrieval_returns_distinct_context(hash_store):
+    """Adjacent overlapping chunks of a document come back merged, not repeated"""
+    from rag.embeddings import get_embeddings
+    from rag.retriever import retrieve_relevant_chunks
+    from rag.vector_store import store_documents
+    from services.chunker import chunk_spans
+    content = " ".join(f"pump{i}" for i in range(60))
+    spans = chunk_spans(content, chunk_size=100, overlap=20)
+    chunks = [content[start:end] for start, end in spans]
+    vectors = asyncio.run(get_embeddings(chunks))
+    asyncio.run(store_documents(
+        "doc1", chunks, vectors, {"filename": "doc1.txt"},
+        chunk_metadatas=[{"char_start": start, "char_end": end} for start, end in spans]
+    ))
+    results = asyncio.run(retrieve_relevant_chunks("pump1 pump2 pump3", top_k=5))
+    covered = sorted((c["metadata"]["char_start"], c["metadata"]["char_end"]) for c in results)
+    assert all(prev_end < start for (_, prev_end), (start, _) in zip(covered, covered[1:]))
+    for chunk in results:
+        assert chunk["text"] == content[chunk["metadata"]["char_start"]:chunk["metadata"]["char_end"]]
+
+def test_merge_overlapping_respects_max_chars():
+    """An overlapping chunk that would grow the merged range past max_chars is dropped"""
+    from rag.diversify import merge_overlapping
+    chunks = [
+        {"id": "d_0", "text": "a" * 10, "metadata": {"doc_id": "d", "char_start": 0, "char_end": 10}},
+        {"id": "d_1", "text": "b" * 10, "metadata": {"doc_id": "d", "char_start": 8, "char_end": 18}},
+    ]
+    assert [chunk["text"] for chunk in merge_overlapping(chunks, max_chars=15)] == ["a" * 10]
+
+def test_filters_translate_to_chroma_where():
+    """Single values become equality, lists become $in, several fields are AND-ed"""
+    from rag.filters import normalize_filters, to_where
+    assert to_where(normalize_filters({"doc_id": "a"})) == {"doc_id": "a"}
+    assert to_where(normalize_filters({"file_type": ["b", "a"], "doc_id": ["x"]})) == {
+        "$and": [{"doc_id": "x"}, {"file_type": {"$in": ["a", "b"]}}]
+    }
+    with pytest.raises(ValueError):
+        normalize_filters({"author": "x"})
+
+@pytest.mark.parametrize("mode", ["dense", "hybrid"])
+def test_filtered_retrieval_only_returns_matching_documents(hash_store, mode):
+    """Filtered queries search only the selected documents, in both retrieval modes"""
+    from rag.retriever import retrieve_relevant_chunks
+    _store("doc1", ["pump manual part XJ-9000", "pump wiring"])
+    _store("doc2", ["pump warranty XJ-9000"])
+    chunks = asyncio.run(retrieve_relevant_chunks("XJ-9000 pump", top_k=5, mode=mode, filters={"doc_id": "doc2"}))
+    assert [chunk["id"] for chunk in chunks] == ["doc2_0"]
+    chunks = asyncio.run(retrieve_relevant_chunks("XJ-9000 pump", top_k=5, mode=mode, filters={"filename": ["doc1.txt"]}))
+    assert sorted(chunk["id"] for chunk in chunks) == ["doc1_0", "doc1_1"]
+
+def test_retrieve_batch_embeds_once_and_matches_single_queries(hash_store):
+    """A batch makes one embedding call and returns what single queries would"""
+    from rag import embeddings, retrieval_cache
+    from rag.retriever import retrieve_batch, retrieve_relevant_chunks
+    _store("doc1", ["pump manual XJ-9000", "error E-1042 overheating", "cleaning the filter"])
+    queries = ["XJ-9000", "E-1042", "", "XJ-9000", "filter"]
+
+    real_get_embeddings = embeddings.get_embeddings
+    calls = []
+
+    async def counting_get_embeddings(texts):
+        calls.append(list(texts))
+        return await real_get_embeddings(texts)
+
+    with patch("rag.embeddings.get_embeddings", side_effect=counting_get_embeddings):
+        batch = asyncio.run(retrieve_batch(queries, top_k=2))
+    assert calls == [["XJ-9000", "E-1042", "filter"]]
+    assert batch[2] == []
+    assert batch[0] == batch[3]
+    assert all("distance" in chunk for chunk in batch[0])
+
+    retrieval_cache.clear()
+    for query, chunks in zip(queries, batch):
+        assert asyncio.run(retrieve_relevant_chunks(query, top_k=2)) == chunks
+
+def _scored(*scores, text="x" * 40):
+    return [{"id": f"c{i}", "text": text, "metadata": {}, "score": score} for i, score in enumerate(scores)]
+
+def test_relevance_policy_threshold_and_gap():
+    """Low scores and everything past a large score drop are dropped (budgeting is the packer's job)"""
+    from rag.relevance import apply_relevance_policy
+    kept = apply_relevance_policy(_scored(0.8, 0.75, 0.72, 0.4, 0.1), min_similarity=0.2, gap=0.15)
+    assert [chunk["id"] for chunk in kept] == ["c0", "c1", "c2"]
+    kept = apply_relevance_policy(_scored(0.8, 0.75, 0.72, text="x" * 40000), min_similarity=0.2, gap=0.15)
+    assert [chunk["id"] for chunk in kept] == ["c0", "c1", "c2"]
+    assert apply_relevance_policy(_scored(0.15, 0.1), min_similarity=0.25, gap=0.15) == []
+
+def test_relevance_policy_skips_scores_for_hash_embeddings(hash_store):
+    """Hash similarities are meaningless, so only the token budget applies"""
+    from rag.relevance import apply_relevance_policy
+    kept = apply_relevance_policy(_scored(0.05, -0.3))
+    assert [chunk["id"] for chunk in kept] == ["c0", "c1"]
+
+def test_retrieved_chunks_carry_scores(hash_store):
+    from rag.retriever import retrieve_relevant_chunks
+    _store("doc1", ["alpha text"])
+    chunk = asyncio.run(retrieve_relevant_chunks("alpha text", top_k=1, mode="dense"))[0]
+    assert abs(chunk["score"] - (1 - chunk["distance"])) < 1e-6
+    assert chunk["score"] > 0.99
+
+def test_pack_context_keeps_retrieval_order_and_trims_sentences():
+    """Chunks are packed in retrieval order whatever their scores; one that overflows is cut at a sentence boundary"""
+    from rag.context_packer import pack_context, split_sentences
+    long_text = "First sentence here. " * 40
+    chunks = [
+        {"id": "bm25_hit", "text": "y" * 400, "metadata": {}, "score": 0.2},
+        {"id": "mid", "text": long_text, "metadata": {}, "score": 0.5},
+        {"id": "high", "text": "x" * 400, "metadata": {}, "score": 0.9},
+    ]
+    packed = pack_context(chunks, prompt_tokens=100, budget=400)
+
+    assert [chunk["id"] for chunk in packed.chunks] == ["bm25_hit", "mid"]
+    assert packed.available == 300
+    assert packed.tokens <= packed.available
+    trimmed = packed.chunks[1]
+    assert trimmed["trimmed"] and trimmed["text"].endswith("here.")
+    assert len(trimmed["text"]) < len(long_text)
+    assert "trimmed" not in chunks[1]
+    assert split_sentences("A. B?\n\nC") == ["A. ", "B?\n\n", "C"]
+
+def test_pack_context_applies_context_cap():
+    """The context cap (CONTEXT_TOKEN_BUDGET / max_context_tokens) bounds chunk text within the prompt budget"""
+    from rag.context_packer import pack_context
+    chunks = [{"id": f"c{i}", "text": "Sentence. " * 100, "metadata": {}} for i in range(3)]
+    assert pack_context(chunks, prompt_tokens=100, budget=10000, max_context_tokens=400).available == 400
+    assert pack_context(chunks, prompt_tokens=100, budget=450, max_context_tokens=4000).available == 350
+    assert pack_context(chunks, budget=10000, max_context_tokens=0).chunks == []
+
+def test_generate_response_prompt_fits_budget(mock_anthropic_client, monkeypatch):
+    """The prompt sent to Claude stays within PROMPT_INPUT_TOKEN_BUDGET"""
+    from rag import context_packer
+    from rag.claude_chain import generate_response
+    from rag.tokens import estimate_tokens
+    monkeypatch.setattr(context_packer, "PROMPT_INPUT_TOKEN_BUDGET", 1000)
+    context = [{"text": "Some sentence. " * 200, "metadata": {"filename": f"f{i}.txt"}, "score": 0.5} for i in range(10)]
+
+    response = asyncio.run(generate_response("question?", context))
+
+    kwargs = mock_anthropic_client.messages.create.call_args.kwargs
+    prompt = "".join(block["text"] for block in kwargs["system"] + kwargs["messages"][0]["content"])
+    assert estimate_tokens(prompt) <= 1000
+    assert 0 < len(response["sources"]) < 10
+
+def test_generate_response_without_room_for_context_skips_claude(mock_anthropic_client):
+    """When no chunk fits the context cap, the budget answer is returned without a Claude call"""
+    from rag.claude_chain import CONTEXT_BUDGET_ANSWER, generate_response
+    context = [{"text": "Some sentence. " * 50, "metadata": {"filename": "f.txt"}, "score": 0.5}]
+
+    response = asyncio.run(generate_response("question?", context, max_context_tokens=1))
+
+    assert response["answer"] == CONTEXT_BUDGET_ANSWER and response["sources"] == []
+    mock_anthropic_client.messages.create.assert_not_called()
@@ -0,0 +1,64 @@
+"""Tests for the retry policy and circuit breaker"""
+import asyncio
+import time
+from unittest.mock import AsyncMock, patch
+import httpx
+import pytest
+from lib import retry
+from lib.retry import CircuitBreaker, CircuitOpen, Deadline, retry_with_backoff
+
+def _status_error(status, headers=None):
+    request = httpx.Request("POST", "https://api.example.com/v1/messages")
+    response = httpx.Response(status, headers=headers, request=request)
+    return httpx.HTTPStatusError(f"HTTP {status}", request=request, response=response)
+
+def test_classification():
+    """Timeouts, connection errors, 429 and 5xx are retried; 4xx and missing keys are not"""
+    assert retry.classify(TimeoutError()) == retry.OUTAGE
+    assert retry.classify(httpx.ConnectError("refused")) == retry.OUTAGE
+    assert retry.classify(_status_error(529)) == retry.OUTAGE
+    assert retry.classify(_status_error(429)) == retry.THROTTLED
+    assert retry.classify(_status_error(400)) == retry.FATAL
+    assert retry.classify(ValueError("ANTHROPIC_API_KEY environment variable is not set")) == retry.FATAL
+    assert retry.classify(CircuitOpen("claude", 5)) == retry.FATAL
+
+def test_fatal_errors_are_not_retried():
+    func = AsyncMock(side_effect=[_status_error(400), "ok"])
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(retry_with_backoff(func, max_retries=3, initial_delay=0))
+    assert func.await_count == 1
+
+def test_retry_after_is_honored():
+    """A 429's Retry-After replaces the jittered delay"""
+    func = AsyncMock(side_effect=[_status_error(429, {"retry-after": "2"}), "ok"])
+    with patch("lib.retry.asyncio.sleep", AsyncMock()) as sleep:
+        assert asyncio.run(retry_with_backoff(func, max_retries=3)) == "ok"
+    sleep.assert_awaited_once_with(2.0)
+
+def test_deadline_is_shared_by_attempts():
+    """Slow attempts are cut off at the deadline instead of each getting a full timeout"""
+    async def slow():
+        await asyncio.sleep(10)
+
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(retry_with_backoff(slow, max_retries=3, initial_delay=0.01, deadline=Deadline(0.2)))
+    assert time.monotonic() - started < 1
+
+def test_circuit_opens_and_recovers():
+    """Consecutive outages open the circuit; a successful trial after the reset timeout closes it"""
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_timeout=0.1)
+    failing = AsyncMock(side_effect=httpx.ConnectError("refused"))
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(retry_with_backoff(failing, max_retries=1, initial_delay=0, breaker=breaker))
+    assert breaker.state == CircuitBreaker.OPEN
+
+    healthy = AsyncMock(return_value="ok")
+    with pytest.raises(CircuitOpen) as rejected:
+        asyncio.run(retry_with_backoff(healthy, breaker=breaker))
+    assert rejected.value.retry_after >= 1
+    healthy.assert_not_awaited()
+
+    time.sleep(0.15)
+    assert asyncio.run(retry_with_backoff(healthy, breaker=breaker)) == "ok"
+    assert breaker.state == CircuitBreaker.CLOSED
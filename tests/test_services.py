@@ -42,3 +42,12 @@ def test_parse_markdown():
 
 
 
+
+def test_chunk_spans_match_chunks():
+    """Spans are the character ranges of the chunks"""
+    from services.chunker import chunk_spans
+    text = "word " * 70
+    spans = chunk_spans(text, chunk_size=100, overlap=20)
+    assert [text[start:end] for start, end in spans] == chunk_text(text, chunk_size=100, overlap=20)
+    assert spans[0] == (0, 100) and spans[1][0] == 80
+    assert spans[-1][1] == len(text)